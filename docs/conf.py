@@ -221,6 +221,8 @@ man_pages = [
      AUTHORS, 1),
     ('manpages/ibid-plugin.1', 'ibid-plugin',
      u'Plugin testing developer environment for Ibid', AUTHORS, 1),
+    ('manpages/ibid-replay.1', 'ibid-replay',
+     u'Captured event replay benchmark for Ibid', AUTHORS, 1),
     ('manpages/ibid-setup.1', 'ibid-setup',
      u'Create a basic configuration file and database for an Ibid bot',
      AUTHORS, 1),
@@ -14,6 +14,7 @@ sys.path.insert(0, '%s/lib' % dirname(__file__))
 import twisted.python.log
 
 import ibid.core
+from ibid import stats
 from ibid.compat import defaultdict
 from ibid.config import FileConfig
 
@@ -82,11 +83,13 @@ class MultiSet(object):
 sources = InsensitiveDict()
 config = {}
 dispatcher = None
+scheduler = None
 processors = []
 categories = {}
 reloader = None
 databases = {}
 auth = None
+cluster = None
 service = None
 options = {
         'base': '.',
@@ -129,12 +132,26 @@ def setup(opts, service=None):
         create_logdirs(ibid.config['logging'])
         logging.config.fileConfig(join(options['base'], expanduser(ibid.config['logging'])))
 
+    if options.get('profile-startup', False):
+        stats.startup = stats.StartupProfile()
+
     ibid.reload_reloader()
-    ibid.reloader.reload_dispatcher()
-    ibid.reloader.reload_databases()
-    ibid.reloader.load_processors()
-    ibid.reloader.load_sources(service)
-    ibid.reloader.reload_auth()
+    ibid.reloader.load_cluster()
+    stats.profile_startup('phase', 'dispatcher',
+                          ibid.reloader.reload_dispatcher)
+    stats.profile_startup('phase', 'databases',
+                          ibid.reloader.reload_databases)
+    stats.profile_startup('phase', 'plugins', ibid.reloader.load_processors)
+    stats.profile_startup('phase', 'scheduler', ibid.reloader.reload_scheduler)
+    stats.profile_startup('phase', 'sources', ibid.reloader.load_sources,
+                          service)
+    stats.profile_startup('phase', 'auth', ibid.reloader.reload_auth)
+    if ibid.cluster is not None:
+        stats.profile_startup('phase', 'cluster', ibid.cluster.start, service)
+
+    if stats.startup is not None:
+        print u'\n'.join(stats.startup.report())
+        stats.startup = None
 
 def reload_reloader():
     try:
@@ -1,7 +1,6 @@
 # Copyright (c) 2008-2009, Michael Gorven
 # Released under terms of the MIT/X/Expat Licence. See COPYING for details.
 
-from time import time
 from random import choice
 import string
 import logging
@@ -12,6 +11,7 @@ from sqlalchemy import or_
 import ibid
 from ibid.compat import hashlib
 from ibid.db.models import Credential, Permission
+from ibid.utils import LRUCache
 
 def hash(password, salt=None):
     if salt:
@@ -21,6 +21,37 @@ def hash(password, salt=None):
         salt = ''.join([choice(chars) for i in xrange(8)])
     return unicode(salt + hashlib.sha1(salt + password).hexdigest())
 
+permission_re = re.compile(r'^([+-]?)(\S+)$')
+permission_prefixes = {'+': 'yes', '-': 'no', '': 'auth'}
+
+# Lowercased source name -> {permission name: value}
+permission_tables = {}
+
+def permission_table(source):
+    """Return the permissions granted to everyone on source by the
+    configuration. The first mention of a permission wins.
+    """
+    table = permission_tables.get(source.lower(), None)
+    if table is None:
+        permissions = []
+        permissions.extend(ibid.sources[source].permissions)
+        permissions.extend(ibid.config.get('auth', {}).get('permissions', []))
+
+        table = {}
+        for permission in permissions:
+            match = permission_re.match(permission)
+            if match:
+                table.setdefault(match.group(2),
+                                 permission_prefixes[match.group(1)])
+        permission_tables[source.lower()] = table
+    return table
+
+def build_permission_tables():
+    "Recompute the permission tables of every source, on config reload"
+    permission_tables.clear()
+    for source in ibid.sources.keys():
+        permission_table(source)
+
 def permission(name, account, source, session):
     if account:
         permission = session.query(Permission) \
@@ -30,35 +61,38 @@ def permission(name, account, source, session):
         if permission:
             return permission.value
 
-    permissions = []
-    permissions.extend(ibid.sources[source].permissions)
-    if 'permissions' in ibid.config.auth:
-        permissions.extend(ibid.config.auth['permissions'])
-
-    permission_re = re.compile('^([+-]?)(\S+)$')
-    for permission in permissions:
-        match = permission_re.match(permission)
-        if match and match.group(2) == name :
-            if match.group(1) == '+':
-                return 'yes'
-            elif match.group(1) == '-':
-                return 'no'
-            else:
-                return 'auth'
-
-    return 'no'
+    return permission_table(source).get(name, 'no')
 
 class Auth(object):
 
     def __init__(self):
-        self.authentication_cache = {}
-        self.authorisation_cache = {}
+        self.authentication_cache = LRUCache(0, 'authentication')
+        self.authorisation_cache = LRUCache(0, 'authorisation')
         self.log = logging.getLogger('core.auth')
-
-    def drop_caches(self):
-        "Authentication / Authorisation data changed"
-        self.authentication_cache = {}
-        self.authorisation_cache = {}
+        self.configure()
+
+    def configure(self):
+        "Size the caches from the configuration"
+        config = ibid.config.get('auth', {})
+        size = config.get('cache_size', 1000)
+        self.authentication_cache.ttl = config.get('timeout', 300)
+        self.authentication_cache.resize(size)
+        self.authorisation_cache.resize(size)
+
+    def drop_caches(self, account=None):
+        """Authentication / Authorisation data changed for account,
+        or for everyone (e.g. in the configuration) if account is None.
+        """
+        if account is None:
+            self.authentication_cache.clear()
+            self.authorisation_cache.clear()
+            self.configure()
+            return
+
+        self.authentication_cache.discard_matching(
+                lambda connection, authenticated: authenticated == account)
+        self.authorisation_cache.discard_matching(
+                lambda key, value: key[1] == account)
 
     def authenticate(self, event, credential=None):
         if 'account' not in event or not event.account:
@@ -70,13 +104,11 @@ class Auth(object):
         methods.extend(ibid.sources[event.source].auth)
         methods.extend(config['methods'])
 
-        if event.sender['connection'] in self.authentication_cache:
-            timestamp = self.authentication_cache[event.sender['connection']]
-            if time() - timestamp < ibid.config.auth['timeout']:
-                self.log.debug(u"Authenticated %s/%s (%s) from cache", event.account, event.identity, event.sender['connection'])
-                return True
-            else:
-                del self.authentication_cache[event.sender['connection']]
+        # The cache holds the account each connection authenticated as
+        if self.authentication_cache.get(event.sender['connection']) \
+                == event.account:
+            self.log.debug(u"Authenticated %s/%s (%s) from cache", event.account, event.identity, event.sender['connection'])
+            return True
 
         for method in methods:
             if hasattr(ibid.sources[event.source], 'auth_%s' % method):
@@ -90,7 +122,7 @@ class Auth(object):
             try:
                 if function(event, credential):
                     self.log.info(u"Authenticated %s/%s (%s) using %s", event.account, event.identity, event.sender['connection'], method)
-                    self.authentication_cache[event.sender['connection']] = time()
+                    self.authentication_cache[event.sender['connection']] = event.account
                     return True
             except:
                 self.log.exception(u"Exception occured in %s auth method", method)
@@ -101,14 +133,14 @@ class Auth(object):
     def authorise(self, event, name):
         "Check if event comes from a user with permission 'name'"
         key = (name, event.account, event.source)
-        if key not in self.authorisation_cache:
+        value = self.authorisation_cache.get(key)
+        if value is None:
             value = permission(session=event.session, *key)
             self.authorisation_cache[key] = value
             self.log.info(u"Checking %s permission for %s/%s (%s): %s",
                     name, event.account, event.identity,
                     event.sender['connection'], value)
         else:
-            value = self.authorisation_cache[key]
             self.log.debug(u"Checking %s permission for %s/%s (%s) from cache: %s",
                     name, event.account, event.identity,
                     event.sender['connection'], value)
@@ -0,0 +1,68 @@
+# Copyright (c) 2011, Stefano Rivera
+# Released under terms of the MIT/X/Expat Licence. See COPYING for details.
+
+from datetime import datetime
+import gzip
+import logging
+from threading import Lock
+from time import time
+
+from ibid.compat import json
+from ibid.event import Event
+
+# Added during processing, not by sources
+_skip = ('responses', 'processed', 'session')
+
+def _default(value):
+    if isinstance(value, datetime):
+        return value.isoformat()
+    return unicode(value)
+
+class EventCapture(object):
+    """Write incoming events to a gzipped file, one JSON object per line.
+    Each line holds the event's keys and a "captured" timestamp.
+    """
+
+    def __init__(self, filename):
+        self.log = logging.getLogger('core.capture')
+        self.filename = filename
+        self.lock = Lock()
+        self.file = gzip.open(filename, 'ab')
+        self.log.info(u'Capturing events to %s', filename)
+
+    def write(self, event):
+        record = dict((key, value) for key, value in event.iteritems()
+                      if key not in _skip)
+        record['captured'] = time()
+        line = json.dumps(record, default=_default) + '\n'
+        self.lock.acquire()
+        try:
+            if self.file is not None:
+                self.file.write(line)
+        finally:
+            self.lock.release()
+
+    def close(self):
+        self.lock.acquire()
+        try:
+            if self.file is not None:
+                self.file.close()
+                self.file = None
+        finally:
+            self.lock.release()
+
+def read_events(filename):
+    "Yield (captured timestamp, Event) for each event in a capture file"
+    capture = gzip.open(filename, 'rb')
+    try:
+        for line in capture:
+            record = json.loads(line)
+            event = Event(record.pop('source'), record.pop('type'))
+            captured = record.pop('captured')
+            for key, value in record.iteritems():
+                event[key] = value
+            yield captured, event
+    finally:
+        capture.close()
+
+# vi: set et sta sw=4 ts=4:
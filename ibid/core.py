@@ -3,80 +3,550 @@
 # Released under terms of the MIT/X/Expat Licence. See COPYING for details.
 
 from cgi import parse_qs
+from datetime import datetime, timedelta
+from heapq import heapify, heappop, heappush
 import inspect
+from itertools import count
 import re
 import logging
 import socket
+import sre_constants
+import sre_parse
 from os.path import join, expanduser
+from Queue import Queue
 import sys
+from threading import Lock, Thread, currentThread, local
+from time import sleep, time
 
-from twisted.internet import reactor, threads
+from twisted.internet import defer, error, reactor
+from twisted.python import failure
+from twisted.python.threadable import isInIOThread
 from twisted.python.modules import getModule
+from twisted.web.error import Error as HTTPError
 from sqlalchemy import create_engine
+from sqlalchemy.interfaces import ConnectionProxy
 from sqlalchemy.orm import sessionmaker, scoped_session
 from sqlalchemy.exc import IntegrityError
 
 import ibid
+from ibid.capture import EventCapture
 from ibid.event import Event
-from ibid.db import SchemaVersionException, schema_version_check
-from ibid.utils import JSONException
+from ibid.manifest import Manifest, LazyProcessor, load_lock
+from ibid import offload, stats
+from ibid.db import SchemaVersionException, schema_version_check, \
+                    IbidSession
+from ibid.utils import JSONException, LRUCache, hold_reactor_calls, \
+                       release_reactor_calls, reactor_call
 
 import auth
 
-def process(event, log):
-    for processor in ibid.processors:
+network_errors = (IOError, socket.error, JSONException, HTTPError,
+                  error.ConnectError, error.DNSLookupError,
+                  error.TimeoutError)
+
+class DispatchIndex(object):
+    """The loaded processors, grouped by the event types they act on.
+
+    Processors that use the standard Processor.process() filtering are only
+    listed against their event_types (and clock, if they have periodic
+    handlers). Anything else is listed against every event type.
+    Each entry is a (processor, addressed, processed, offload) tuple, in
+    priority order, where addressed and processed are the filters to apply
+    before calling the processor, and offload says whether to run it in a
+    worker process.
+    """
+
+    def __init__(self, processors):
+        self.processors = list(processors)
+        self._entries = [self._entry(processor)
+                         for processor in self.processors]
+        self._by_type = {}
+
+    def _entry(self, processor):
+        if getattr(processor, 'stand_in', False):
+            return (processor, frozenset(processor.event_types),
+                    processor.addressed, processor.processed, False, False)
+
+        base = ibid.plugins.Processor.process.im_func
+        if getattr(getattr(processor, 'process', None), 'im_func',
+                   None) is not base:
+            return (processor, None, False, True, False, False)
+
+        periodic = False
+        for method in processor._get_periodic_handlers():
+            periodic = True
+            break
+
+        return (processor, frozenset(processor.event_types),
+                bool(processor.addressed), bool(processor.processed),
+                periodic, bool(processor.offload))
+
+    def lookup(self, event_type):
+        "Return the entries for processors that can act on event_type"
         try:
-            processor.process(event)
-        except Exception, e:
-            log.exception(
-                    u'Exception occured in %s processor of %s plugin.\n'
-                    u'Event: %s',
-                    processor.__class__.__name__,
-                    processor.name,
-                    event)
-            event.complain = isinstance(e, (IOError, socket.error, JSONException)) and u'network' or u'exception'
-            event.exc_info = sys.exc_info()
-            event.processed = True
-            if 'session' in event:
-                event.session.rollback()
-                event.session.close()
-                del event['session']
+            return self._by_type[event_type]
+        except KeyError:
+            pass
+
+        entries = []
+        for processor, types, addressed, processed, periodic, offload \
+                in self._entries:
+            if types is None:
+                entries.append((processor, False, True, False))
+            elif periodic and event_type == u'clock':
+                # Periodic handlers run before the filters are applied
+                entries.append((processor, False, True, False))
+            elif event_type in types:
+                entries.append((processor, addressed, processed, offload))
+
+        self._by_type[event_type] = entries
+        return entries
+
+    def current(self):
+        "Is this index up to date with ibid.processors?"
+        return self.processors == ibid.processors
+
+_dispatch_index = None
+
+def rebuild_dispatch_index():
+    """Rebuild the dispatch index and @match prefilter after ibid.processors
+    or config changes"""
+    global _dispatch_index
+    __import__('ibid.plugins')
+    _time_budgets.clear()
+    _dispatch_index = DispatchIndex(ibid.processors)
+    ibid.plugins.rebuild_match_index(ibid.processors)
+    if ibid.scheduler is not None:
+        reactor_call(ibid.scheduler.reschedule)
+    return _dispatch_index
+
+def dispatch_index():
+    "Return the current dispatch index, rebuilding it if it is stale"
+    index = _dispatch_index
+    if index is None or not index.current():
+        index = rebuild_dispatch_index()
+    return index
+
+class HandlerTimeout(Exception):
+    "A processor ran for longer than its time budget"
+
+class _Abandoned(Exception):
+    "Raised in a worker thread whose event the watchdog has taken over"
+
+# The Deferred for the result of what each worker thread is running
+_worker = local()
+
+def _run_in_thread(result, callable, args, kw):
+    """Call callable, in the current (worker) thread, and fire the Deferred
+    result in the reactor thread with its return value.
+    If callable returns a Deferred, result is chained to it.
+    Returns True if the watchdog took over, and will fire result itself.
+    """
+    hold_reactor_calls()
+    _worker.result = result
+    abandoned = False
+    try:
+        value = callable(*args, **kw)
+    except _Abandoned:
+        abandoned = True
+    except:
+        reactor.callFromThread(result.errback, failure.Failure())
+    else:
+        if isinstance(value, defer.Deferred):
+            reactor.callFromThread(value.chainDeferred, result)
+        else:
+            reactor.callFromThread(result.callback, value)
+    _worker.result = None
+    release_reactor_calls()
+    return abandoned
+
+def defer_to_thread(callable, *args, **kw):
+    """Like twisted.internet.threads.deferToThread(), but callable may
+    return a Deferred, which the returned Deferred will be chained to.
+    Reactor calls made by ibid.utils.reactor_call() are held until callable
+    returns.
+    """
+    result = defer.Deferred()
+    reactor.callInThread(_run_in_thread, result, callable, args, kw)
+    return result
+
+# Keyed on processor, cleared when the dispatch index is rebuilt
+_time_budgets = {}
+
+def _time_budget(processor):
+    "Seconds that processor may run for, or 0 for no limit"
+    budget = _time_budgets.get(processor, None)
+    if budget is None:
+        budget = getattr(processor, 'time_budget', None)
+        if budget is None:
+            budget = ibid.config.get('plugins', {}).get('time_budget', 120)
+        budget = _time_budgets[processor] = float(budget)
+    return budget
+
+class _Watch(object):
+    "A processor call that the watchdog is timing"
+    __slots__ = ('result', 'event', 'log', 'processor', 'entries', 'thread',
+                 'start', 'deadline', 'abandoned', 'dispatcher')
+
+class Watchdog(object):
+    """Abandons processors that run for longer than their time budget.
+
+    Python threads can't be killed, so the stuck thread is left to it, and
+    another thread takes over a copy of its event: the processor is treated
+    as having failed, and the rest of the processor chain is run on the copy.
+    The stuck processor keeps the original, with its database session, which
+    only flushes from then on and is rolled back when it returns.
+    The dispatcher starts another worker thread to replace the stuck one.
+    """
+
+    interval = 1.0
 
-        if 'session' in event and (event.session.dirty or event.session.deleted):
+    def __init__(self):
+        self.log = logging.getLogger('core.watchdog')
+        self.lock = Lock()
+        self.watches = set()
+        self.abandoned = 0
+        self.thread = None
+
+    def watch(self, event, log, processor, entries):
+        """Start timing processor, running on entries' processor chain in
+        this worker thread. Returns a watch for finished(), or None.
+        """
+        result = getattr(_worker, 'result', None)
+        budget = _time_budget(processor)
+        if result is None or not budget:
+            return None
+
+        watch = _Watch()
+        watch.result = result
+        watch.event = event
+        watch.log = log
+        watch.processor = processor
+        watch.entries = entries
+        watch.thread = currentThread()
+        watch.start = time()
+        watch.deadline = watch.start + budget
+        watch.abandoned = False
+        watch.dispatcher = None
+
+        self.lock.acquire()
+        try:
+            self.watches.add(watch)
+            if self.thread is None:
+                self.thread = Thread(target=self._run, name='ibid-watchdog')
+                self.thread.setDaemon(True)
+                self.thread.start()
+        finally:
+            self.lock.release()
+        return watch
+
+    def finished(self, watch):
+        """Stop timing watch's processor.
+        Raises _Abandoned if the event has been taken over.
+        """
+        self.lock.acquire()
+        try:
+            if not watch.abandoned:
+                self.watches.discard(watch)
+                return
+            self.abandoned -= 1
+            reactor.callFromThread(self._returned, watch)
+        finally:
+            self.lock.release()
+
+        processor = watch.processor
+        self.log.warning(u'Abandoned %s processor of %s plugin returned '
+                         u'after %.1fs', processor.__class__.__name__,
+                         processor.name, time() - watch.start)
+        session = watch.event.pop('session', None)
+        if session is not None:
+            session.rollback()
+            session.close()
+        raise _Abandoned()
+
+    def _run(self):
+        while True:
+            sleep(self.interval)
+            now = time()
+            self.lock.acquire()
             try:
-                event.session.commit()
-            except IntegrityError:
-                log.exception(u"Exception occured committing session from the %s processor of %s plugin",
-                        processor.__class__.__name__, processor.name)
-                event.complain = u'exception'
-                event.exc_info = sys.exc_info()
-                event.session.rollback()
-                event.session.close()
-                del event['session']
-
+                if not self.watches:
+                    self.thread = None
+                    return
+                for watch in [watch for watch in self.watches
+                              if watch.deadline <= now]:
+                    self.watches.discard(watch)
+                    watch.abandoned = True
+                    self.abandoned += 1
+                    reactor.callFromThread(self._take_over, watch)
+            finally:
+                self.lock.release()
+
+    def _take_over(self, watch):
+        "Fail watch's processor, and run the rest of the chain"
+        processor = watch.processor
+        event = watch.event
+        elapsed = time() - watch.start
+        self.log.error(u'%s processor of %s plugin has run for %.1fs, '
+                       u'abandoning its worker thread. Event: %s',
+                       processor.__class__.__name__, processor.name,
+                       elapsed, event)
+        stats.increment('stuck_handlers', plugin=processor.name,
+                        processor=processor.__class__.__name__)
+
+        # The stuck processor is left with the original event, and its
+        # session. Nothing it does to them from now on is used.
+        taken = Event(event.source, event.type)
+        taken.update(event)
+        taken.responses = list(event.responses)
+        taken.pop('session', None)
+        event.unit_of_work = True
+        if 'session' in event:
+            event.session.deferring_commits = True
+
+        error = HandlerTimeout(u'%s processor of %s plugin ran for %.1fs'
+                % (processor.__class__.__name__, processor.name, elapsed))
+        taken.complain = u'exception'
+        taken.exc_info = (HandlerTimeout, error, None)
+        taken.processed = True
+
+        watch.dispatcher = ibid.dispatcher
+        if watch.dispatcher is not None:
+            watch.dispatcher._replace_worker(watch.thread)
+        defer_to_thread(_run_chain, taken, watch.log, watch.entries, True) \
+                .addCallback(lambda result: taken) \
+                .chainDeferred(watch.result)
+
+    def _returned(self, watch):
+        "Called after _take_over(), when the stuck processor returns"
+        if watch.dispatcher is not None:
+            watch.dispatcher._worker_returned(watch.thread)
+
+_watchdog = Watchdog()
+
+def _finished_event(result, event):
+    """The event that a processor chain finished with: event, unless the
+    watchdog took it over, in which case result is its copy.
+    """
+    if isinstance(result, Event):
+        return result
+    return event
+
+def _close_session(event):
     if 'session' in event:
+        event.session.deferring_commits = False
         event.session.close()
         del event['session']
 
+def _savepoint(event):
+    """In a unit of work, isolate the next processor's changes from the
+    earlier ones.
+    """
+    if event.get('unit_of_work', False) and 'session' in event:
+        return event.session.begin_nested()
+    return None
+
+def _release(event, savepoint):
+    if savepoint is not None and event.session.transaction is savepoint:
+        savepoint.commit()
+
+def _processor_failed(event, log, processor, exc_info, savepoint=None):
+    log.error(u'Exception occured in %s processor of %s plugin.\n'
+              u'Event: %s',
+              processor.__class__.__name__, processor.name, event,
+              exc_info=exc_info)
+    event.complain = issubclass(exc_info[0], network_errors) \
+            and u'network' or u'exception'
+    event.exc_info = exc_info
+    event.processed = True
+    if 'session' in event:
+        if savepoint is not None and event.session.transaction is savepoint:
+            savepoint.rollback()
+        else:
+            event.session.rollback()
+            _close_session(event)
+
+def _commit(event, log, processor):
+    if 'session' in event and (event.session.dirty or event.session.deleted):
+        start = time()
+        try:
+            try:
+                event.session.commit()
+            finally:
+                stats.timer('db_commit').observe_since(start)
+        except IntegrityError:
+            log.exception(u"Exception occured committing session from the %s processor of %s plugin",
+                    processor.__class__.__name__, processor.name)
+            event.complain = u'exception'
+            event.exc_info = sys.exc_info()
+            event.session.rollback()
+            _close_session(event)
+
+def _commit_unit(event, log):
+    "Commit the unit of work, when the chain ends or waits for a Deferred"
+    if 'session' in event and event.get('unit_of_work', False):
+        event.session.deferring_commits = False
+        start = time()
+        try:
+            try:
+                event.session.commit()
+            finally:
+                stats.timer('db_commit').observe_since(start)
+        except IntegrityError:
+            log.exception(u"Exception occured committing session for event")
+            event.complain = u'exception'
+            event.exc_info = sys.exc_info()
+            event.session.rollback()
+            _close_session(event)
+
+def _run_chain(event, log, entries, watched=False):
+    """Run the processors in entries on event.
+    If watched, the chain's result is the worker thread's result, so the
+    watchdog can take over the event if a processor gets stuck.
+    """
+    processes = getattr(ibid.dispatcher, 'processes', None)
+    for processor, addressed, processed, offload in entries:
+        if addressed and not event.get('addressed', False):
+            continue
+        if not processed and event.processed:
+            continue
+
+        savepoint = _savepoint(event)
+        hist = stats.histogram(processor.name, processor.__class__.__name__)
+        watch = watched and _watchdog.watch(event, log, processor, entries) \
+                or None
+        start = time()
+        try:
+            if (offload and processes is not None
+                    and processor.may_handle(event)):
+                result = processes.process(processor, event)
+            else:
+                result = processor.process(event)
+        except Exception:
+            exc_info = sys.exc_info()
+        else:
+            exc_info = None
+
+        if watch is not None:
+            _watchdog.finished(watch)
+
+        if exc_info is None:
+            result = stats.observe_result(hist, start, result)
+            _release(event, savepoint)
+        else:
+            hist.observe_since(start)
+            _processor_failed(event, log, processor, exc_info, savepoint)
+            result = None
+
+        if not event.get('unit_of_work', False):
+            _commit(event, log, processor)
+
+        if isinstance(result, defer.Deferred):
+            _commit_unit(event, log)
+            _close_session(event)
+            return _resume_later(result, event, log, processor, entries)
+
+    _commit_unit(event, log)
+    _close_session(event)
+
+def _resume_later(deferred, event, log, processor, entries):
+    """Continue the processor chain in a worker thread when deferred fires.
+    Workers of an OrderedWorkerPool resume it themselves, so that their
+    queue waits for the event. Others leave it to the reactor's pool.
+    """
+    run = getattr(_worker, 'resume', None) or defer_to_thread
+
+    def failed(fail):
+        if fail.check(defer.FirstError):
+            fail = fail.value.subFailure
+        _processor_failed(event, log, processor,
+                          (fail.type, fail.value, fail.getTracebackObject()))
+
+    def resume(result):
+        return run(_run_chain, event, log, entries, True)
+
+    return deferred.addErrback(failed).addCallback(resume)
+
+def process(event, log, watched=False):
+    """Pass event through the processor chain.
+    Returns None, or a Deferred if a processor is waiting for one to fire.
+    The rest of the chain is run in a worker thread once it does.
+    If watched, the result is returned straight from a worker thread, and
+    processors that overrun their time budget are abandoned.
+    If a processor is abandoned, the chain finishes with a copy of event,
+    see _finished_event().
+    """
+    event.unit_of_work = ibid.config.get('dispatcher', {}) \
+            .get('commit', 'processor') == 'event'
+    entries = dispatch_index().lookup(event.type)
+    target = event.get('periodic_for', None)
+    if target is not None:
+        # A clock event for one processor's periodic handlers
+        entries = [entry for entry in entries if entry[0] is target]
+    return _run_chain(event, log, iter(entries), watched)
+
+def _send_many(source, responses):
+    "Send responses to source, a batch at a time if it supports that"
+    send_many = getattr(source, 'send_many', None)
+    if send_many is not None:
+        return send_many(responses)
+    for response in responses:
+        source.send(response)
+
 class Dispatcher(object):
 
     def __init__(self):
         self.log = logging.getLogger('core.dispatcher')
+        config = ibid.config.get('dispatcher', {})
+        self._outbox = {}
+        self._outbox_lock = Lock()
+        self._flush_pending = False
+        self._abandoned = set()
+        self.capture = None
+        capture = config.get('capture', None)
+        if capture:
+            self.capture = EventCapture(
+                    join(ibid.options['base'], expanduser(capture)))
+
+        self.processes = None
+        processes = int(config.get('processes', 0))
+        if processes > 0:
+            if offload.multiprocessing is None:
+                self.log.warning(u"Can't start worker processes without the "
+                                 u"multiprocessing module")
+            else:
+                self.processes = offload.ProcessPool(processes,
+                        float(config.get('process_timeout', 60)))
+
+    def shutdown(self):
+        if self.capture is not None:
+            self.capture.close()
+        if self.processes is not None:
+            self.processes.stop()
 
     def _process(self, event):
-        process(event, self.log)
+        pending = process(event, self.log)
+        if pending is not None:
+            return pending.addCallback(
+                    lambda result: self._finish(_finished_event(result, event)))
+        return self._finish(event)
 
+    def _finish(self, event):
         log_level = logging.DEBUG
         if event.type == u'clock' and not event.processed:
             log_level -= 5
         self.log.log(log_level, event)
 
         filtered = []
+        others = []
         for response in event['responses']:
+            stats.increment('responses', source=response['source'])
             if response['source'] == event.source:
                 filtered.append(response)
             else:
-                self.send(response)
+                others.append(response)
+        if others:
+            self.send_many(others)
 
         event.responses = filtered
         self.log.log(log_level, u"Returning event to %s source", event.source)
@@ -84,20 +554,95 @@ class Dispatcher(object):
         return event
 
     def send(self, response):
-        source = response['source']
-        if source in ibid.sources:
-            reactor.callFromThread(ibid.sources[source].send, response)
-            self.log.debug(u"Sent response to non-origin source %s: %s", response['source'], response['reply'])
-        else:
-            self.log.warning(u'Received response for invalid source %s: %s', response['source'], response['reply'])
+        self.send_many([response])
 
-    def dispatch(self, event):
+    def send_many(self, responses):
+        """Queue responses for delivery to their sources.
+        Responses queued before the reactor gets to them are delivered
+        together, with one call to each source's send_many().
+        In the reactor thread, they are delivered immediately.
+        """
+        self._outbox_lock.acquire()
+        try:
+            for response in responses:
+                self._outbox.setdefault(response['source'].lower(), []) \
+                        .append(response)
+            pending = self._flush_pending
+            self._flush_pending = True
+        finally:
+            self._outbox_lock.release()
+        if isInIOThread():
+            self._flush()
+        elif not pending:
+            reactor.callFromThread(self._flush)
+
+    def _flush(self):
+        "Deliver the queued responses. Called in the reactor thread"
+        self._outbox_lock.acquire()
+        try:
+            outbox = self._outbox
+            self._outbox = {}
+            self._flush_pending = False
+        finally:
+            self._outbox_lock.release()
+
+        for source, responses in outbox.iteritems():
+            if source in ibid.sources:
+                _send_many(ibid.sources[source], responses)
+                self.log.debug(u"Sent %i responses to non-origin source %s",
+                               len(responses), source)
+            elif ibid.cluster is not None and ibid.cluster.route(source):
+                for response in responses:
+                    ibid.cluster.send(response)
+                self.log.debug(u"Forwarded %i responses for %s source to "
+                               u"node %s", len(responses), source,
+                               ibid.cluster.route(source))
+            else:
+                for response in responses:
+                    self.log.warning(u'Received response for invalid source '
+                                     u'%s: %s', source, response['reply'])
+
+    def _received(self, event):
+        "Log, count and capture an incoming event. Returns the log level"
         log_level = logging.DEBUG
         if event.type == u'clock':
             log_level -= 5
         self.log.log(log_level, u"Received event from %s source", event.source)
+        stats.increment('events', source=event.source, type=event.type)
+        if self.capture is not None and event.type != u'clock':
+            self.capture.write(event)
+        return log_level
 
-        return threads.deferToThread(self._process, event)
+    def dispatch(self, event):
+        self._received(event)
+        return defer_to_thread(process, event, self.log, True) \
+                .addCallback(
+                    lambda result: self._finish(_finished_event(result, event)))
+
+    def pool_stats(self):
+        """Return the number of queued and running events, worker threads,
+        and worker threads abandoned by the watchdog
+        """
+        pool = reactor.getThreadPool()
+        return {
+            'queued': pool.q.qsize(),
+            'working': len(pool.working),
+            'threads': len(pool.threads),
+            'abandoned': _watchdog.abandoned,
+        }
+
+    def _replace_worker(self, thread):
+        "Make up for a worker thread abandoned by the watchdog"
+        pool = reactor.getThreadPool()
+        pool.adjustPoolsize(pool.min, pool.max + 1)
+        self._abandoned.add(thread)
+
+    def _worker_returned(self, thread):
+        "An abandoned worker thread has returned from its processor"
+        if thread in self._abandoned:
+            self._abandoned.discard(thread)
+            pool = reactor.getThreadPool()
+            pool.adjustPoolsize(pool.min, pool.max - 1)
 
     def call_later(self, delay, callable, oldevent, *args, **kw):
         "Run callable after delay seconds. Pass args and kw to it"
@@ -106,20 +651,309 @@ class Dispatcher(object):
         event.sender = oldevent.sender
         event.channel = oldevent.channel
         event.public = oldevent.public
-        return reactor.callLater(delay, threads.deferToThread, self.delayed_call, callable, event, *args, **kw)
+        return reactor.callLater(delay, defer_to_thread, self.delayed_call, callable, event, *args, **kw)
 
     def delayed_call(self, callable, event, *args, **kw):
         # Twisted doesn't catch exceptions here, so we must do it ourselves
         try:
             callable(event, *args, **kw)
-            self._process(event)
-            reactor.callFromThread(self.delayed_response, event)
+            pending = self._process(event)
         except:
             self.log.exception(u'Call Later')
+            return
+
+        if isinstance(pending, defer.Deferred):
+            return pending.addCallback(self.delayed_response) \
+                          .addErrback(lambda fail: self.log.error(
+                              u'Call Later\n%s', fail.getTraceback()))
+        reactor.callFromThread(self.delayed_response, event)
 
     def delayed_response(self, event):
-        for response in event.responses:
-            ibid.sources[event.source].send(response)
+        if event.responses:
+            _send_many(ibid.sources[event.source], event.responses)
+
+class OrderedWorkerPool(object):
+    """A fixed set of worker threads, each draining its own FIFO queue.
+    Work submitted to the same queue is run in order. If it returns a
+    Deferred, the queue waits for that to fire, and anything resumed through
+    _worker.resume in the meantime is run on the queue's thread.
+    """
+
+    def __init__(self, workers):
+        self.log = logging.getLogger('core.workers')
+        self.queues = [Queue() for i in xrange(workers)]
+        self.working = set()
+        self.threads = [self._start(i) for i in xrange(workers)]
+
+    def queue_for(self, key):
+        "Return the queue that work for key is run on"
+        return self.queues[hash(key) % len(self.queues)]
+
+    def run(self, queue, callable, *args, **kw):
+        """Run callable on queue's worker thread.
+        Returns a Deferred that fires in the reactor thread with the result.
+        """
+        deferred = defer.Deferred()
+        queue.put((deferred, callable, args, kw))
+        return deferred
+
+    def stop(self):
+        for queue in self.queues:
+            queue.put(None)
+
+    def _start(self, i):
+        thread = Thread(target=self._work, args=(self.queues[i],),
+                        name='ibid-worker-%i' % i)
+        thread.setDaemon(True)
+        thread.start()
+        return thread
+
+    def replace(self, thread):
+        """Start a new thread to drain the queue that thread was draining.
+        Returns False if thread isn't one of ours.
+        """
+        if thread not in self.threads:
+            return False
+        i = self.threads.index(thread)
+        self.threads[i] = self._start(i)
+        return True
+
+    def _work(self, queue):
+        # Work resumed while the current item waits for a Deferred,
+        # and None when it has finished
+        resumed = Queue()
+        lock = Lock()
+
+        def resume(callable, *args, **kw):
+            # Called in the reactor thread
+            deferred = defer.Deferred()
+            resumed.put((deferred, callable, args, kw))
+            return deferred
+
+        _worker.resume = resume
+        while True:
+            item = queue.get()
+            if item is None:
+                return
+            deferred, callable, args, kw = item
+            # [returned a Deferred, finished]
+            state = [False, False]
+
+            def finished(result, state=state):
+                lock.acquire()
+                try:
+                    state[1] = True
+                    if state[0]:
+                        resumed.put(None)
+                finally:
+                    lock.release()
+                return result
+
+            def call(*args, **kw):
+                value = callable(*args, **kw)
+                if isinstance(value, defer.Deferred):
+                    lock.acquire()
+                    try:
+                        state[0] = not state[1]
+                    finally:
+                        lock.release()
+                return value
+
+            result = defer.Deferred()
+            result.addBoth(finished)
+            result.chainDeferred(deferred)
+            self.working.add(queue)
+            try:
+                if _run_in_thread(result, call, args, kw):
+                    # The watchdog has replaced this thread
+                    return
+                if not state[0]:
+                    continue
+                while True:
+                    item = resumed.get()
+                    if item is None:
+                        break
+                    if _run_in_thread(*item):
+                        return
+            finally:
+                self.working.discard(queue)
+
+class OrderedDispatcher(Dispatcher):
+    """Dispatcher that keeps events from each (source, channel) in order.
+    Events are hashed onto a fixed pool of worker queues, so channels are
+    processed in parallel, but one channel's events never overtake each
+    other. When a queue is deeper than queue_depth, events in the overflow
+    categories are dropped:
+    clock: Timer events
+    public: Public messages, actions, notices and state changes
+    """
+
+    public_types = (u'message', u'action', u'notice', u'state')
+
+    def __init__(self):
+        super(OrderedDispatcher, self).__init__()
+        config = ibid.config.get('dispatcher', {})
+        self.queue_depth = int(config.get('queue_depth', 100))
+        self.overflow = config.get('overflow', ['clock', 'public'])
+        if isinstance(self.overflow, basestring):
+            self.overflow = [self.overflow]
+        self.pool = OrderedWorkerPool(int(config.get('workers', 4)))
+
+    def shutdown(self):
+        super(OrderedDispatcher, self).shutdown()
+        self.pool.stop()
+
+    def pool_stats(self):
+        return {
+            'queued': sum(queue.qsize() for queue in self.pool.queues),
+            'working': len(self.pool.working),
+            'threads': len(self.pool.threads),
+            'abandoned': _watchdog.abandoned,
+        }
+
+    def _replace_worker(self, thread):
+        if not self.pool.replace(thread):
+            # It was running a chain resumed in the shared thread pool
+            super(OrderedDispatcher, self)._replace_worker(thread)
+
+    def _sheddable(self, event):
+        if event.type == u'clock':
+            return 'clock' in self.overflow
+        if event.get('public', False) and event.type in self.public_types:
+            return 'public' in self.overflow
+        return False
+
+    def dispatch(self, event):
+        log_level = self._received(event)
+
+        channel = event.get('channel', None)
+        if isinstance(channel, basestring):
+            channel = channel.lower()
+        if event.type == u'clock':
+            # Each processor's periodic handlers have their own queue, so
+            # they don't wait for each other
+            channel = event.get('periodic_for', None)
+        queue = self.pool.queue_for((event.source, channel))
+
+        if queue.qsize() >= self.queue_depth:
+            if self._sheddable(event):
+                self.log.log(log_level,
+                        u'Dropped %s event from %s source: worker queue full',
+                        event.type, event.source)
+                stats.increment('dropped_events', source=event.source,
+                                type=event.type)
+                return defer.succeed(event)
+            self.log.warning(u'Worker queue for %s on %s source is %i deep',
+                             channel, event.source, queue.qsize())
+
+        return self.pool.run(queue, process, event, self.log, True) \
+                .addCallback(
+                    lambda result: self._finish(_finished_event(result, event)))
+
+def _seconds(delta):
+    return delta.days * 86400 + delta.seconds + delta.microseconds / 1e6
+
+class Scheduler(object):
+    """Runs @periodic handlers when they are due.
+    The next due time of every periodic handler is kept in a heap, and the
+    scheduler sleeps until the earliest one. It then dispatches a clock
+    event for each processor with handlers due, and Processor.process()
+    runs the handlers that are due.
+    Must only be used from the reactor thread.
+    """
+
+    source = u'scheduler'
+
+    def __init__(self):
+        self.log = logging.getLogger('core.scheduler')
+        self.heap = []
+        self.call = None
+        self.generation = 0
+        self._sequence = count()
+
+    def reschedule(self):
+        "Rebuild the schedule from the loaded processors"
+        self.generation += 1
+        self.heap = []
+        now = datetime.utcnow()
+        for processor in ibid.processors:
+            if isinstance(processor, ibid.plugins.Processor):
+                for method in processor._get_periodic_handlers():
+                    self._push(processor, method, now)
+        heapify(self.heap)
+        self._wake()
+
+    def stop(self):
+        self.generation += 1
+        self.heap = []
+        if self.call is not None and self.call.active():
+            self.call.cancel()
+        self.call = None
+
+    def _push(self, processor, method, now, ran=False):
+        if method.disabled or method.interval <= timedelta(0):
+            return
+
+        if method.last_called is None:
+            # The first interval starts now, as with the first clock event
+            method.im_func.last_called = now
+        due = method.last_called + (method.initial_delay or method.interval)
+        if ran and due <= now:
+            # It didn't run (e.g. still running from last time), back off
+            due = now + min(method.interval, timedelta(seconds=1))
+
+        heappush(self.heap, (due, self._sequence.next(), processor,
+                             method.__name__))
+
+    def _wake(self):
+        if self.call is not None and self.call.active():
+            self.call.cancel()
+        self.call = None
+
+        if self.heap:
+            delay = _seconds(self.heap[0][0] - datetime.utcnow())
+            self.call = reactor.callLater(max(delay, 0), self._fire)
+
+    def _fire(self):
+        self.call = None
+        now = datetime.utcnow()
+        due = {}
+        while self.heap and self.heap[0][0] <= now:
+            processor, name = heappop(self.heap)[2:]
+            due.setdefault(processor, []).append((processor, name))
+
+        if due:
+            self.log.log(logging.DEBUG - 5, u'Running %i periodic handlers',
+                         sum(len(handlers) for handlers in due.itervalues()))
+        for processor, handlers in due.iteritems():
+            event = Event(self.source, u'clock')
+            event.time = now
+            event.periodic_for = processor
+            ibid.dispatcher.dispatch(event) \
+                    .addErrback(self._failed) \
+                    .addCallback(self._ran, handlers, self.generation)
+
+        self._wake()
+
+    def _failed(self, fail):
+        self.log.error(u'Dispatching clock event failed:\n%s',
+                       fail.getTraceback())
+
+    def _ran(self, result, due, generation):
+        if generation != self.generation:
+            # Rescheduled while it was running
+            return
+
+        now = datetime.utcnow()
+        for processor, name in due:
+            if processor in ibid.processors:
+                self._push(processor, getattr(processor, name), now, True)
+        self._wake()
+
+def shutdown_dispatcher():
+    "Shut down the current dispatcher"
+    if hasattr(ibid.dispatcher, 'shutdown'):
+        ibid.dispatcher.shutdown()
 
 class Reloader(object):
 
@@ -135,7 +969,16 @@ class Reloader(object):
     def reload_dispatcher(self):
         try:
             reload(ibid.core)
-            dispatcher = ibid.core.Dispatcher()
+            if ibid.dispatcher is None:
+                # Only once, as it shuts down whichever dispatcher is current
+                reactor.addSystemEventTrigger('before', 'shutdown',
+                                              shutdown_dispatcher)
+            if ibid.config.get('dispatcher', {}).get('mode') == 'ordered':
+                dispatcher = ibid.core.OrderedDispatcher()
+            else:
+                dispatcher = ibid.core.Dispatcher()
+            if hasattr(ibid.dispatcher, 'shutdown'):
+                ibid.dispatcher.shutdown()
             ibid.dispatcher = dispatcher
             self.log.info(u"Reloaded reloader")
             return True
@@ -143,25 +986,40 @@ class Reloader(object):
             self.log.error(u"Failed to reload reloader: %s", unicode(e))
             return False
 
+    def reload_scheduler(self):
+        "Replace the scheduler for periodic handlers"
+        if ibid.scheduler is not None:
+            ibid.scheduler.stop()
+        ibid.scheduler = ibid.core.Scheduler()
+        reactor_call(ibid.scheduler.reschedule)
+        self.log.info(u"Reloaded scheduler")
+        return True
+
     def load_source(self, name, service=None):
         type = 'type' in ibid.config.sources[name] and ibid.config.sources[name]['type'] or name
 
         module = 'ibid.source.%s' % type
         factory = 'ibid.source.%s.SourceFactory' % type
         try:
-            __import__(module)
+            stats.profile_startup('import', module, __import__, module)
             moduleclass = eval(factory)
         except:
             self.log.exception(u"Couldn't import %s and instantiate %s", module, factory)
             return
 
-        ibid.sources[name] = moduleclass(name)
-        ibid.sources[name].setServiceParent(service)
+        ibid.sources[name] = stats.profile_startup('init', name, moduleclass,
+                                                   name)
+        stats.profile_startup('connect', name,
+                              ibid.sources[name].setServiceParent, service)
         self.log.info(u"Loaded %s source %s", type, name)
         return True
 
     def load_sources(self, service=None):
         for source in ibid.config.sources.keys():
+            if ibid.cluster is not None and not ibid.cluster.owns_source(source):
+                self.log.debug(u"Skipping %s source, it runs on node %s",
+                               source, ibid.cluster.source_owner(source))
+                continue
             if not ibid.config.sources[source].get('disabled', False):
                 self.load_source(source, service)
 
@@ -209,11 +1067,98 @@ class Reloader(object):
             all_plugins |= set(plugin.name.replace('ibid.plugins.', '')
                     for plugin in getModule('ibid.plugins').iterModules())
 
+        manifest = None
+        if ibid.config.plugins.get('lazy', False):
+            manifest = Manifest(join(ibid.options['base'], expanduser(
+                    ibid.config.plugins.get('manifest', 'plugins.manifest'))))
+
         for plugin in all_plugins:
             load_processors = [p.split('.')[1] for p in load if p.startswith(plugin + '.')]
             noload_processors = [p.split('.')[1] for p in noload if p.startswith(plugin + '.')]
+            if ibid.cluster is not None and not ibid.cluster.runs_plugin(plugin):
+                self.log.debug(u"Skipping %s plugin, it runs on node %s",
+                               plugin, ibid.cluster.plugin_owner(plugin))
+                continue
             if plugin not in noload or load_processors:
-                self.load_processor(plugin, noload=noload_processors, load=load_processors, load_all=(plugin in load), noload_all=(plugin in noload))
+                selection = {
+                    'noload': noload_processors,
+                    'load': load_processors,
+                    'load_all': plugin in load,
+                    'noload_all': plugin in noload,
+                }
+                if manifest is None or (ibid.cluster is not None
+                        and ibid.cluster.plugin_owner(plugin) is not None):
+                    # Plugins that only run here are described to the other
+                    # nodes, so they can't be left to load lazily
+                    self.load_processor(plugin, **selection)
+                else:
+                    self._load_from_manifest(manifest, plugin, selection)
+
+        if manifest is not None:
+            manifest.save()
+
+    def _load_from_manifest(self, manifest, name, selection):
+        """Put LazyProcessors in place of plugin name's processors, if the
+        manifest describes them. Otherwise load it now, and describe it.
+        """
+        entry = manifest.lookup(name, selection)
+        if entry is None:
+            if self.load_processor(name, **selection):
+                manifest.record(name, selection,
+                        [processor for processor in ibid.processors
+                         if processor.name == name],
+                        sys.modules['ibid.plugins.' + name])
+            return
+
+        self._install_processors(name, [
+                LazyProcessor(name, description, selection, entry['features'])
+                for description in entry['processors']])
+        self.log.debug(u"Deferred loading %s plugin", name)
+
+    def load_lazy_plugin(self, name):
+        """Import plugin name, replacing the LazyProcessors standing in for
+        it. Called by them, in a worker thread.
+        """
+        load_lock.acquire()
+        try:
+            stubs = [processor for processor in ibid.processors
+                     if processor.name == name
+                     and getattr(processor, 'lazy', False)]
+            if not stubs:
+                # Another thread got here first
+                return
+
+            start = time()
+            if not self.load_processor(name, **stubs[0].selection):
+                self._install_processors(name, [])
+                return
+
+            loaded = dict((processor.__class__.__name__, processor)
+                          for processor in ibid.processors
+                          if processor.name == name)
+            for stub in stubs:
+                stub.real = loaded.get(stub.classname, None)
+            self.log.info(u"Loaded %s plugin on demand in %.0fms", name,
+                          (time() - start) * 1000)
+        finally:
+            load_lock.release()
+
+    def _install_processors(self, name, processors):
+        """Add processors to ibid.processors, replacing any stand-ins (e.g.
+        LazyProcessors) for plugin name.
+        Worker threads may be reading ibid.processors, so it's replaced in
+        one go, rather than sorted in place.
+        """
+        load_lock.acquire()
+        try:
+            ibid.processors[:] = sorted([processor
+                    for processor in ibid.processors
+                    if processor.name != name
+                    or not getattr(processor, 'stand_in', False)] + processors,
+                key=lambda x: x.priority)
+            rebuild_dispatch_index()
+        finally:
+            load_lock.release()
 
     def load_processor(self, name, noload=[], load=[], load_all=False, noload_all=False):
         """Load processor <name>.
@@ -224,9 +1169,8 @@ class Reloader(object):
         """
         module = 'ibid.plugins.' + name
         try:
-            __import__(module)
-            m = eval(module)
-            reload(m)
+            m = stats.profile_startup('import', module, self._import_plugin,
+                                      module)
         except Exception, e:
             if isinstance(e, ImportError):
                 error = u"Couldn't load %s plugin because it requires module %s" % (name, e.args[0].replace('No module named ', ''))
@@ -235,6 +1179,7 @@ class Reloader(object):
                 self.log.exception(u"Couldn't load %s plugin", name)
             return False
 
+        processors = []
         for classname, klass in inspect.getmembers(m, inspect.isclass):
             if (issubclass(klass, ibid.plugins.Processor)
                     and klass != ibid.plugins.Processor):
@@ -243,7 +1188,8 @@ class Reloader(object):
                     self.log.debug("Loading Processor: %s.%s", name,
                                    klass.__name__)
                     try:
-                        ibid.processors.append(klass(name))
+                        processors.append(stats.profile_startup('init',
+                                u'%s.%s' % (name, classname), klass, name))
                     except Exception, e:
                         self.log.exception(u"Couldn't instantiate %s "
                                            u"processor of %s plugin",
@@ -254,16 +1200,23 @@ class Reloader(object):
                                    klass.__name__)
 
         try:
-            schema_version_check(ibid.databases['ibid'])
+            stats.profile_startup('schema', name, schema_version_check,
+                                  ibid.databases['ibid'])
         except SchemaVersionException, e:
             self.log.error(u'Tables out of date: %s. Run "ibid-db --upgrade"',
                            e.message)
 
-        ibid.processors.sort(key=lambda x: x.priority)
+        self._install_processors(name, processors)
 
         self.log.debug(u"Loaded %s plugin", name)
         return True
 
+    def _import_plugin(self, module):
+        __import__(module)
+        m = eval(module)
+        reload(m)
+        return m
+
     def unload_processor(self, name):
         processors = []
 
@@ -275,13 +1228,26 @@ class Reloader(object):
             for processor in processors:
                 processor.shutdown()
                 ibid.processors.remove(processor)
+            rebuild_dispatch_index()
 
             self.log.info(u"Unloaded %s plugin", name)
             return True
 
+    def load_cluster(self):
+        "Set up cluster mode, if this bot is a node in a cluster"
+        config = ibid.config.get('cluster', {})
+        if not config.get('node', None):
+            ibid.cluster = None
+            return False
+        from ibid.nodes import Cluster
+        ibid.cluster = Cluster(config)
+        self.log.info(u"Running as node %s of a cluster", ibid.cluster.node)
+        return True
+
     def reload_databases(self):
         reload(ibid.core)
-        ibid.databases = DatabaseManager()
+        ibid.databases = stats.profile_startup('databases', 'all',
+                                               DatabaseManager)
         return True
 
     def reload_auth(self):
@@ -298,12 +1264,140 @@ class Reloader(object):
     def reload_config(self):
         for processor in ibid.processors:
             processor.setup()
+        rebuild_dispatch_index()
         for source in ibid.sources:
             ibid.sources[source].setup()
+        auth.build_permission_tables()
         self.log.info(u"Notified all processors of config reload")
 
-def regexp(pattern, item):
-    return re.search(pattern, item, re.I) and True or False
+def _sequence_literals(items):
+    "Yield literal strings that a match of the parsed regex must contain"
+    run = []
+    for op, av in items:
+        if op == sre_constants.LITERAL:
+            run.append(unichr(av))
+            continue
+        if run:
+            yield u''.join(run)
+            run = []
+        if op == sre_constants.SUBPATTERN:
+            for literal in _sequence_literals(av[-1]):
+                yield literal
+        elif (op in (sre_constants.MAX_REPEAT, sre_constants.MIN_REPEAT)
+                and av[0] >= 1):
+            for literal in _sequence_literals(av[2]):
+                yield literal
+    if run:
+        yield u''.join(run)
+
+def required_literal(pattern):
+    """Return the longest lower-case literal string that every match of the
+    regex pattern must contain, or None if there isn't one.
+    """
+    literals = list(_sequence_literals(sre_parse.parse(pattern, re.I)))
+    if not literals:
+        return None
+    return max(literals, key=len).lower()
+
+class RegexpFunction(object):
+    """The REGEXP function of a SQLite connection.
+
+    Compiled patterns are kept in a bounded LRU. Unless literal_check is
+    False, rows that lack a literal the pattern requires are rejected
+    without running the regex. The time spent is accumulated until flush().
+    """
+
+    log = logging.getLogger('core.databases')
+
+    def __init__(self, cache_size=64, literal_check=True):
+        self.patterns = LRUCache(cache_size, 'regexp')
+        self.literal_check = literal_check
+        # The current query's pattern
+        self.pattern = None
+        self.compiled = None
+        self.literal = None
+        self.rows = 0
+        self.elapsed = 0.0
+
+    def compile(self, pattern):
+        "Return (compiled regex, required literal) for pattern"
+        entry = self.patterns.get(pattern)
+        if entry is None:
+            compiled = re.compile(pattern, re.I)
+            literal = self.literal_check and required_literal(pattern) or None
+            entry = self.patterns[pattern] = (compiled, literal)
+        return entry
+
+    def __call__(self, pattern, item):
+        start = time()
+        try:
+            if pattern != self.pattern:
+                self.compiled, self.literal = self.compile(pattern)
+                self.pattern = pattern
+            if item is None:
+                return False
+            if self.literal is not None and self.literal not in item.lower():
+                return False
+            return self.compiled.search(item) is not None
+        finally:
+            self.rows += 1
+            self.elapsed += time() - start
+
+    def flush(self):
+        "Report the time spent since the last flush()"
+        if self.rows:
+            stats.timer('sqlite_regexp').observe(self.elapsed)
+            self.log.debug(u'REGEXP %r: %i rows in %.1f ms', self.pattern,
+                           self.rows, self.elapsed * 1000)
+            self.rows = 0
+            self.elapsed = 0.0
+
+class SQLiteRegexpListener(object):
+    "Gives each SQLite connection its RegexpFunction"
+
+    def connect(self, dbapi_con, con_record):
+        function = con_record.info['regexp'] = RegexpFunction()
+        dbapi_con.create_function('regexp', 2, function)
+
+    def checkin(self, dbapi_con, con_record):
+        function = con_record.info.get('regexp', None)
+        if function is not None:
+            function.flush()
+
+class SQLiteProxy(ConnectionProxy):
+    """Begins transactions explicitly, and reports the time spent in REGEXP
+    by each query, before the next one
+    """
+
+    # sqlite_creator() turns off pysqlite's transaction handling, which
+    # commits before SAVEPOINT statements. Like pysqlite, we only begin
+    # before the first statement that isn't a SELECT, so that reading
+    # doesn't hold a lock that blocks other connections' writes.
+
+    def begin(self, conn, begin):
+        conn.connection.info['begin'] = True
+        return begin()
+
+    def commit(self, conn, commit):
+        conn.connection.info['begin'] = False
+        return commit()
+
+    def rollback(self, conn, rollback):
+        conn.connection.info['begin'] = False
+        return rollback()
+
+    def cursor_execute(self, execute, cursor, statement, parameters,
+                       context, executemany):
+        if context is not None:
+            info = context.connection.connection.info
+            function = info.get('regexp', None)
+            if function is not None:
+                function.flush()
+            if (info.get('begin', False)
+                    and not statement.lstrip().upper().startswith('SELECT')):
+                info['begin'] = False
+                cursor.execute('BEGIN')
+        return execute(cursor, statement, parameters, context)
 
 def sqlite_creator(database, synchronous=True):
     try:
@@ -313,7 +1407,8 @@ def sqlite_creator(database, synchronous=True):
 
     def connect():
         connection = sqlite.connect(database)
-        connection.create_function('regexp', 2, regexp)
+        # SQLiteProxy begins transactions
+        connection.isolation_level = None
         if not synchronous:
             connection.execute('PRAGMA synchronous = OFF')
         connection.execute('PRAGMA foreign_keys=ON')
@@ -330,7 +1425,8 @@ class DatabaseManager(dict):
 
         if check_schema_versions:
             try:
-                schema_version_check(self['ibid'])
+                stats.profile_startup('schema', 'core', schema_version_check,
+                                      self['ibid'])
             except SchemaVersionException, e:
                 self.log.error(u'Tables out of date: %s. Run "ibid-db --upgrade"', e.message)
                 raise
@@ -345,8 +1441,9 @@ class DatabaseManager(dict):
                         expanduser(uri.replace('sqlite:///', '', 1))),
                     self.sqlite_synchronous),
                 encoding='utf-8', convert_unicode=True,
-                echo=echo
+                echo=echo, proxy=SQLiteProxy()
             )
+            engine.pool.add_listener(SQLiteRegexpListener())
 
         elif uri.startswith(u'mysql://'):
             if u'?' not in uri:
@@ -390,7 +1487,8 @@ class DatabaseManager(dict):
 
             engine.pool.add_listener(PGSQLModeListener())
 
-        self[name] = scoped_session(sessionmaker(bind=engine))
+        self[name] = scoped_session(sessionmaker(bind=engine,
+                                                 class_=IbidSession))
 
         self.log.info(u"Loaded %s database", name)
 
@@ -1,6 +1,8 @@
 # Copyright (c) 2009-2011, Stefano Rivera
 # Released under terms of the MIT/X/Expat Licence. See COPYING for details.
+import re as _re
 import warnings as _warnings
+from weakref import WeakKeyDictionary as _WeakKeyDictionary
 
 from ibid.db.types import Integer, DateTime, Boolean, \
                           IbidUnicode, IbidUnicodeText
@@ -8,7 +10,11 @@ from ibid.db.types import Integer, DateTime, Boolean, \
 from sqlalchemy import Table, Column, ForeignKey, Index, UniqueConstraint, \
                        PassiveDefault, or_, and_, MetaData as _MetaData
 from sqlalchemy.orm import eagerload, relation, synonym
-from sqlalchemy.sql import func
+from sqlalchemy.orm.session import Session as _Session
+from sqlalchemy.orm.interfaces import SessionExtension as _SessionExtension
+from sqlalchemy.sql import func, literal_column as _literal_column, \
+                           select as _select, table as _table, \
+                           column as _column
 from sqlalchemy.ext.declarative import declarative_base as _declarative_base
 
 from sqlalchemy.exc import IntegrityError, SADeprecationWarning
@@ -17,13 +23,134 @@ metadata = _MetaData()
 Base = _declarative_base(metadata=metadata)
 
 from ibid.db.versioned_schema import VersionedSchema, SchemaVersionException, \
-                                     schema_version_check, upgrade_schemas
+                                     schema_version_check, upgrade_schemas, \
+                                     fulltext_index_name
+from ibid.db.writebehind import write_behind
 
 def get_regexp_op(session):
-    "Return a regexp operator"
+    """Return a regexp operator.
+    On SQLite, an invalid pattern raises re.error here, rather than an
+    opaque error from the query.
+    """
     if session.bind.engine.name in ('postgres', 'postgresql'):
         return lambda x, y: x.op('~')(y)
+    elif session.bind.engine.name == 'sqlite':
+        def regexp(x, y):
+            _re.compile(y, _re.I)
+            return x.op('REGEXP')(y)
+        return regexp
     else:
         return lambda x, y: x.op('REGEXP')(y)
 
+_word_re = _re.compile(r'[^\W_]+', _re.UNICODE)
+
+def fulltext_words(text):
+    "Split text into the words that a full-text index would hold"
+    return [word.lower() for word in _word_re.findall(text)]
+
+# engine -> {index name: does it exist?}
+# (SQLite engines all have the URL sqlite:///, see DatabaseManager.load())
+_fulltext_indexes = _WeakKeyDictionary()
+
+def has_fulltext_index(session, column):
+    "Was VersionedSchema.add_fulltext_index() able to index column?"
+    name = fulltext_index_name(column.table.name, column.name)
+    indexes = _fulltext_indexes.setdefault(session.bind.engine, {})
+    if name not in indexes:
+        engine = session.bind.engine.name
+        if engine == 'sqlite':
+            query = "SELECT 1 FROM sqlite_master WHERE name = :name"
+        elif engine in ('postgres', 'postgresql'):
+            query = "SELECT 1 FROM pg_indexes WHERE indexname = :name"
+        else:
+            query = None
+        indexes[name] = query is not None and \
+                session.execute(query, {'name': name}).scalar() is not None
+    return indexes[name]
+
+def fulltext_match(session, column, words):
+    """Return a clause selecting the rows where column contains a word
+    starting with each of words, using its full-text index.
+    Returns None if column isn't indexed, or there are no words.
+    """
+    if not words or not has_fulltext_index(session, column):
+        return None
+    if session.bind.engine.name == 'sqlite':
+        name = fulltext_index_name(column.table.name, column.name)
+        index = _table(name, _column('docid'), _column(column.name))
+        key = list(column.table.primary_key)[0]
+        return key.in_(_select([index.c.docid],
+            index.c[column.name].op('MATCH')(
+                u' '.join(word + u'*' for word in words))))
+    else:
+        # The configuration must be a literal, to match the index
+        config = _literal_column("'simple'")
+        return func.to_tsvector(config, column).op('@@')(
+                func.to_tsquery(config,
+                                u' & '.join(word + u':*' for word in words)))
+
+def _depth(session):
+    "How many transactions and savepoints deep is session?"
+    depth = 0
+    transaction = session.transaction
+    while transaction is not None:
+        if transaction._is_transaction_boundary:
+            depth += 1
+        transaction = transaction._parent
+    return depth
+
+class _AfterCommitExtension(_SessionExtension):
+    "Runs IbidSession.after_commit() callbacks, or drops them"
+
+    def after_commit(self, session):
+        depth = _depth(session)
+        if depth == 1:
+            callbacks, session.after_commit_callbacks = \
+                    session.after_commit_callbacks, []
+            for registered, callback, args, kwargs in callbacks:
+                callback(*args, **kwargs)
+        else:
+            # A savepoint was released, its callbacks now wait on the
+            # enclosing transaction
+            session.after_commit_callbacks = [
+                    (min(registered, depth - 1), callback, args, kwargs)
+                    for registered, callback, args, kwargs
+                    in session.after_commit_callbacks]
+
+    def after_rollback(self, session):
+        depth = _depth(session)
+        session.after_commit_callbacks = [
+                callback for callback in session.after_commit_callbacks
+                if callback[0] < depth]
+
+class IbidSession(_Session):
+    """A Session that can defer commits to the end of a unit of work.
+    While deferring_commits is set, commit() only flushes.
+    """
+
+    deferring_commits = False
+
+    def __init__(self, *args, **kwargs):
+        self.after_commit_callbacks = []
+        _Session.__init__(self, *args, **kwargs)
+        self.extensions.append(_AfterCommitExtension())
+
+    def commit(self):
+        if self.deferring_commits:
+            self.flush()
+        else:
+            _Session.commit(self)
+
+    def after_commit(self, callback, *args, **kwargs):
+        """Call callback(*args, **kwargs) once the changes made so far have really
+        been committed, i.e. not just flushed in a unit of work.
+        If they are rolled back, it is never called.
+        """
+        self.after_commit_callbacks.append((_depth(self), callback, args,
+                                            kwargs))
+
+    def close(self):
+        self.after_commit_callbacks = []
+        _Session.close(self)
+
 # vi: set et sta sw=4 ts=4:
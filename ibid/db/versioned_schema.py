@@ -37,6 +37,9 @@ class VersionedSchema(object):
     For column parameters, while you can point to columns in the table
     definition, it is better style to repeat the Column() specification as the
     column might be altered in a future version.
+
+    Anything that table creation can't express, such as full-text indexes,
+    should be added both in an upgrade method and in created().
     """
 
     def __init__(self, table, version):
@@ -91,6 +94,7 @@ class VersionedSchema(object):
                 log.info(u"Creating table %s", self.table.name)
 
                 self._create_table()
+                self.created()
 
                 schema = Schema(unicode(self.table.name), self.version)
                 session.add(schema)
@@ -119,6 +123,10 @@ class VersionedSchema(object):
         session.close()
         del self.upgrade_session
 
+    def created(self):
+        "Called after creating the table at the latest version"
+        pass
+
     def _index_name(self, col):
         """
         We'd like not to duplicate an existing index so try to abide by the
@@ -279,6 +287,67 @@ class VersionedSchema(object):
                 return
             raise
 
+    def add_fulltext_index(self, col):
+        """Add a full-text index over col, if the database supports one.
+        Returns True if the index was created.
+
+        On SQLite, this is an external content FTS4 table, kept up to date
+        by triggers. Rebuilding the table (e.g. in alter_column()) drops
+        the triggers, so call this again afterwards. On PostgreSQL, it is a
+        GIN index over to_tsvector('simple', col).
+        """
+
+        session = self.upgrade_session
+        engine = session.bind.engine.name
+        name = fulltext_index_name(self.table.name, col.name)
+        key = list(self.table.primary_key)[0].name
+
+        if engine == 'sqlite':
+            for trigger in ('ai', 'au', 'bu', 'bd'):
+                session.execute('DROP TRIGGER IF EXISTS "%s_%s";'
+                                % (name, trigger))
+            session.execute('DROP TABLE IF EXISTS "%s";' % name)
+            try:
+                session.execute('CREATE VIRTUAL TABLE "%s" USING fts4('
+                                'content="%s", "%s", tokenize=unicode61);'
+                                % (name, self.table.name, col.name))
+            except OperationalError, e:
+                log.warning(u"Couldn't create full-text index on %s.%s: %s",
+                            self.table.name, col.name, unicode(e))
+                return False
+            session.execute('INSERT INTO "%s"("%s") VALUES (\'rebuild\');'
+                            % (name, name))
+            for trigger, when, action in (
+                    ('bu', 'BEFORE UPDATE', 'delete'),
+                    ('bd', 'BEFORE DELETE', 'delete'),
+                    ('au', 'AFTER UPDATE', 'insert'),
+                    ('ai', 'AFTER INSERT', 'insert')):
+                if action == 'delete':
+                    body = 'DELETE FROM "%s" WHERE docid = old."%s";' % (
+                            name, key)
+                else:
+                    body = ('INSERT INTO "%s"(docid, "%s") '
+                            'VALUES (new."%s", new."%s");'
+                            % (name, col.name, key, col.name))
+                session.execute('CREATE TRIGGER "%s_%s" %s ON "%s" '
+                                'BEGIN %s END;' % (name, trigger, when,
+                                                   self.table.name, body))
+            return True
+
+        elif engine == pg_engine:
+            try:
+                session.execute('CREATE INDEX "%s" ON "%s" USING '
+                                'gin(to_tsvector(\'simple\', "%s"))'
+                                % (name, self.table.name, col.name))
+            except ProgrammingError, e:
+                if u'already exists' not in unicode(e):
+                    raise
+            return True
+
+        log.warning(u"Full-text indexes aren't supported on %s, "
+                    u"not indexing %s.%s", engine, self.table.name, col.name)
+        return False
+
     def drop_index(self, col):
         "Drop an index from the table"
 
@@ -480,6 +549,10 @@ class SchemaVersionException(Exception):
     pass
 
 
+def fulltext_index_name(table, column):
+    "The name of the full-text index on table.column"
+    return '%s_%s_fts' % (table, column)
+
 def schema_version_check(sessionmaker):
     """Pass through all tables, log out of date ones,
     and except if not all up to date"""
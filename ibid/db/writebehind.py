@@ -0,0 +1,159 @@
+# Copyright (c) 2011, Stefano Rivera
+# Released under terms of the MIT/X/Expat Licence. See COPYING for details.
+
+from itertools import count
+import logging
+from threading import Lock
+from time import time
+
+from sqlalchemy.exc import IntegrityError
+from twisted.internet import reactor
+
+import ibid
+from ibid import stats
+
+class WriteBehind(object):
+    """Buffer frequent bookkeeping writes in memory and flush them in bulk.
+
+    Writes are grouped by writer, a function taking a session and a dict of
+    keys to values, which it writes to the database. Values enqueued with the
+    same key are combined with merge, or replaced if it is None. A key of
+    None never merges.
+
+    Pending writes are flushed in a thread every write_behind.interval
+    seconds, when write_behind.batch_size writes are waiting, and on
+    shutdown.
+    """
+
+    def __init__(self):
+        self.log = logging.getLogger('core.writebehind')
+        self.lock = Lock()
+        self.flush_lock = Lock()
+        self.pending = {}
+        self.flushing = {}
+        self.mergers = {}
+        self.size = 0
+        self.flush_requested = False
+        self.call = None
+        self.trigger = None
+        self._serial = count()
+
+    def _config(self, key, default):
+        return ibid.config.get('write_behind', {}).get(key, default)
+
+    def enqueue(self, writer, key, value, merge=None):
+        "Queue value, to be written by writer"
+        self.lock.acquire()
+        try:
+            if key is None:
+                key = (None, self._serial.next())
+            items = self.pending.setdefault(writer, {})
+            if key not in items:
+                self.size += 1
+            elif merge is not None:
+                value = merge(items[key], value)
+            items[key] = value
+            self.mergers[writer] = merge
+            size = self.size
+            # Only ask for one flush until it takes the batch
+            full = (size >= int(self._config('batch_size', 500))
+                    and not self.flush_requested)
+            if full:
+                self.flush_requested = True
+        finally:
+            self.lock.release()
+
+        if full:
+            reactor.callFromThread(self._flush_now)
+        elif size == 1:
+            reactor.callFromThread(self._schedule)
+
+    def get(self, writer, key):
+        """Return the value waiting to be written by writer for key, merged
+        with any that is being flushed right now, or None.
+        """
+        self.lock.acquire()
+        try:
+            flushing = self.flushing.get(writer, {}).get(key, None)
+            pending = self.pending.get(writer, {}).get(key, None)
+            merge = self.mergers.get(writer, None)
+            if (flushing is not None and pending is not None
+                    and merge is not None):
+                return merge(flushing, pending)
+            return pending is not None and pending or flushing
+        finally:
+            self.lock.release()
+
+    def _schedule(self):
+        if self.trigger is None:
+            self.trigger = reactor.addSystemEventTrigger('before', 'shutdown',
+                                                         self.flush)
+        if self.call is None or not self.call.active():
+            self.call = reactor.callLater(
+                    float(self._config('interval', 5)), self._flush_now)
+
+    def _flush_now(self):
+        if self.call is not None and self.call.active():
+            self.call.cancel()
+        self.call = None
+        reactor.callInThread(self.flush)
+
+    def flush(self):
+        """Write everything that is pending.
+        Must not be called from a thread with an open event session, as
+        SQLite shares the connection between a thread's sessions.
+        """
+        self.flush_lock.acquire()
+        try:
+            self.lock.acquire()
+            try:
+                self.flushing, self.pending = self.pending, {}
+                self.size = 0
+                self.flush_requested = False
+            finally:
+                self.lock.release()
+
+            if not self.flushing:
+                return
+
+            start = time()
+            session = ibid.databases.ibid.session_factory()
+            try:
+                for writer, items in self.flushing.iteritems():
+                    try:
+                        writer(session, items)
+                        session.commit()
+                    except IntegrityError:
+                        # Probably another process got there first. Write
+                        # one at a time, so only the conflicting ones fail
+                        session.rollback()
+                        self._write_each(session, writer, items)
+                    except Exception:
+                        self.log.exception(u'Exception flushing %i writes '
+                                           u'from %s', len(items),
+                                           writer.__name__)
+                        session.rollback()
+            finally:
+                session.close()
+                stats.timer('write_behind_flush').observe_since(start)
+                self.lock.acquire()
+                try:
+                    self.flushing = {}
+                finally:
+                    self.lock.release()
+        finally:
+            self.flush_lock.release()
+
+    def _write_each(self, session, writer, items):
+        for key, value in items.iteritems():
+            try:
+                writer(session, {key: value})
+                session.commit()
+            except Exception:
+                self.log.exception(u'Exception flushing write %r from %s',
+                                   key, writer.__name__)
+                session.rollback()
+
+write_behind = WriteBehind()
+
+# vi: set et sta sw=4 ts=4:
@@ -17,6 +17,8 @@ class Event(dict):
     def __getattr__(self, name):
         if name == 'session' and 'session' not in self:
             self['session'] = ibid.databases.ibid()
+            if self.get('unit_of_work', False):
+                self['session'].deferring_commits = True
         try:
             return self[name]
         except KeyError, e:
@@ -0,0 +1,204 @@
+# Copyright (c) 2011, Stefano Rivera
+# Released under terms of the MIT/X/Expat Licence. See COPYING for details.
+
+import logging
+import os
+from os.path import exists, getmtime
+from threading import RLock
+
+from twisted.python.modules import getModule
+
+import ibid
+from ibid.compat import all, hashlib, json
+
+log = logging.getLogger('core.manifest')
+
+# Held while replacing LazyProcessors with the real thing
+load_lock = RLock()
+
+def plugin_path(name):
+    "Return the file that plugin name would be imported from"
+    return getModule('ibid.plugins.' + name).filePath.path
+
+def config_fingerprint(name):
+    "Hash the configuration that a plugin's setup() could depend on"
+    section = ibid.config.plugins.get(name, {})
+    blob = json.dumps([ibid.config.get('botname', None), section],
+                      sort_keys=True, default=unicode)
+    return hashlib.sha1(blob).hexdigest()
+
+def describe_processor(processor):
+    "Return a JSON-able description of a loaded Processor"
+    # Imported here, as ibid.plugins imports ibid.core, which imports us
+    from ibid.plugins import Processor, RPC, literal_prefixes
+
+    keywords = []
+    for method in processor._get_event_handlers():
+        pattern = getattr(method, 'pattern', None)
+        prefixes = pattern is not None and literal_prefixes(pattern) or None
+        if prefixes is None:
+            keywords = None
+            break
+        keywords.append([method.message_version, sorted(prefixes)])
+
+    periodic = False
+    for method in processor._get_periodic_handlers():
+        periodic = True
+        break
+
+    standard = getattr(processor.process, 'im_func', None) \
+            is Processor.process.im_func
+    rpc = isinstance(processor, RPC)
+
+    return {
+        'class': processor.__class__.__name__,
+        'event_types': list(processor.event_types),
+        'addressed': bool(processor.addressed),
+        'processed': bool(processor.processed),
+        'priority': processor.priority,
+        'keywords': keywords,
+        'standard': standard,
+        'lazy': (standard and bool(processor.addressed) and not periodic
+                 and not rpc),
+        'features': list(getattr(processor, 'features', ())),
+        'usage': getattr(processor, 'usage', None),
+        'permission': getattr(processor, 'permission', None),
+        'permissions': list(getattr(processor, 'permissions', ())),
+    }
+
+class Manifest(object):
+    """A record of what each plugin's processors act on, so plugins can be
+    imported when an event first needs them, instead of at startup.
+
+    Entries are written whenever a plugin is imported, and are only used
+    while the plugin's file, configuration and the processors selected from
+    it are unchanged.
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.plugins = {}
+        self.dirty = False
+        if exists(filename):
+            try:
+                self.plugins = json.load(file(filename, 'r'))
+            except ValueError, e:
+                log.warning(u"Couldn't parse plugin manifest %s: %s",
+                            filename, unicode(e))
+
+    def lookup(self, name, selection):
+        """Return the entry for plugin name, if it is current and all its
+        processors can be loaded lazily. Otherwise None.
+        """
+        entry = self.plugins.get(name, None)
+        if entry is None:
+            return None
+        try:
+            mtime = getmtime(plugin_path(name))
+        except (KeyError, OSError):
+            return None
+        if (entry['mtime'] != mtime
+                or entry['config'] != config_fingerprint(name)
+                or entry['selection'] != selection):
+            return None
+        if not all(processor['lazy'] for processor in entry['processors']):
+            return None
+        return entry
+
+    def record(self, name, selection, processors, module):
+        "Describe the processors of the freshly imported plugin name"
+        self.plugins[name] = {
+            'mtime': getmtime(plugin_path(name)),
+            'config': config_fingerprint(name),
+            'selection': selection,
+            'features': getattr(module, 'features', {}),
+            'processors': [describe_processor(processor)
+                           for processor in processors],
+        }
+        self.dirty = True
+
+    def save(self):
+        if not self.dirty:
+            return
+        temp = self.filename + '.new'
+        try:
+            output = file(temp, 'w')
+            try:
+                json.dump(self.plugins, output, sort_keys=True, indent=1)
+            finally:
+                output.close()
+            os.rename(temp, self.filename)
+        except (IOError, OSError), e:
+            log.warning(u"Couldn't write plugin manifest %s: %s",
+                        self.filename, unicode(e))
+            return
+        self.dirty = False
+
+class LazyProcessor(object):
+    """Stands in for a Processor, until its plugin is imported.
+
+    The dispatcher filters events for it as it would for the real
+    Processor. The plugin is imported when an event starts with one of the
+    keywords of the Processor's @match patterns (or any event, if one of its
+    handlers doesn't have leading keywords), and the event is handed on.
+    """
+
+    lazy = True
+    stand_in = True
+
+    def __init__(self, name, description, selection, plugin_features):
+        self.name = name
+        self.classname = description['class']
+        self.event_types = tuple(description['event_types'])
+        self.addressed = description['addressed']
+        self.processed = description['processed']
+        self.priority = description['priority']
+        self.keywords = description['keywords']
+        self.features = tuple(description['features'])
+        if description['usage'] is not None:
+            self.usage = description['usage']
+        if description['permission'] is not None:
+            self.permission = description['permission']
+        if description['permissions']:
+            self.permissions = tuple(description['permissions'])
+        self.plugin_features = plugin_features
+        self.selection = selection
+        self.real = None
+
+    def setup(self):
+        pass
+
+    def shutdown(self):
+        pass
+
+    def may_match(self, event):
+        "Could event reach one of the real Processor's handlers?"
+        if self.keywords is None:
+            return True
+        if 'message' not in event:
+            return False
+        message = event.message
+        for version, prefixes in self.keywords:
+            if isinstance(message, dict):
+                text = message.get(version, u'')
+            else:
+                text = message
+            text = text.lower()
+            for prefix in prefixes:
+                if text.startswith(prefix):
+                    return True
+        return False
+
+    def process(self, event):
+        if self.real is None:
+            if not self.may_match(event):
+                return None
+            ibid.reloader.load_lazy_plugin(self.name)
+            if self.real is None:
+                return None
+        return self.real.process(event)
+
+    def __repr__(self):
+        return '<LazyProcessor %s.%s>' % (self.name, self.classname)
+
+# vi: set et sta sw=4 ts=4:
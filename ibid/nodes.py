@@ -0,0 +1,323 @@
+# Copyright (c) 2011, Stefano Rivera
+# Released under terms of the MIT/X/Expat Licence. See COPYING for details.
+
+import logging
+import sys
+
+from twisted.application import internet
+from twisted.internet import defer, protocol, reactor
+from twisted.spread import pb
+
+import ibid
+from ibid.core import defer_to_thread
+from ibid.manifest import LazyProcessor, describe_processor
+from ibid.utils import reactor_call
+from ibid import offload
+
+log = logging.getLogger('core.cluster')
+
+# Event keys that a node works out for itself, rather than trusting a peer
+_identifying_keys = ('account', 'identity')
+
+def _names(section, key):
+    return [name.lower() for name in section.get(key, [])]
+
+class RemoteProcessor(LazyProcessor):
+    """Stands in for a Processor of a plugin that runs on another node.
+
+    Events that the real Processor could act on are sent to that node,
+    processed there, and the changes made to them are applied here.
+    """
+
+    lazy = False
+
+    def __init__(self, node, name, description, plugin_features):
+        LazyProcessor.__init__(self, name, description, None, plugin_features)
+        self.node = node
+        if not description.get('standard', True):
+            # It does its own filtering, so we can't
+            self.keywords = None
+
+    def process(self, event):
+        if not self.may_match(event):
+            return None
+        return ibid.cluster.process(self, event)
+
+    def __repr__(self):
+        return '<RemoteProcessor %s.%s on %s>' % (self.name, self.classname,
+                                                  self.node)
+
+class Node(pb.Referenceable):
+    "What a logged in peer node can ask of us"
+
+    def __init__(self, cluster, node):
+        self.cluster = cluster
+        self.node = node
+
+    def remote_describe(self):
+        return self.cluster.describe()
+
+    def remote_process(self, name, classname, source, type, state):
+        return self.cluster.run(name, classname, source, type, state)
+
+    def remote_send(self, response):
+        if response['source'] not in ibid.sources:
+            log.warning(u'Node %s sent a response for %s source, '
+                        u"which doesn't run here: %s", self.node,
+                        response['source'], response['reply'])
+            return False
+        ibid.dispatcher.send(response)
+        return True
+
+class ClusterRoot(pb.Root):
+
+    def __init__(self, cluster):
+        self.cluster = cluster
+
+    def remote_login(self, node, secret):
+        if node not in self.cluster.nodes or secret != self.cluster.secret:
+            log.warning(u'Refused login from node %s', node)
+            raise pb.Error(u'Login refused')
+        log.info(u'Node %s logged in', node)
+        return Node(self.cluster, node)
+
+class PeerFactory(pb.PBClientFactory, protocol.ReconnectingClientFactory):
+    "Connects to another node, reconnecting whenever the connection drops"
+
+    maxDelay = 60
+
+    def __init__(self, cluster, node):
+        pb.PBClientFactory.__init__(self)
+        self.cluster = cluster
+        self.node = node
+
+    def clientConnectionMade(self, broker):
+        self.resetDelay()
+        pb.PBClientFactory.clientConnectionMade(self, broker)
+        self.getRootObject().addCallback(self.cluster._connected, self.node)
+
+    def clientConnectionLost(self, connector, reason):
+        pb.PBClientFactory.clientConnectionLost(self, connector, reason,
+                                                reconnecting=1)
+        self.cluster._disconnected(self.node)
+        protocol.ReconnectingClientFactory.clientConnectionLost(self,
+                connector, reason)
+
+    def clientConnectionFailed(self, connector, reason):
+        pb.PBClientFactory.clientConnectionFailed(self, connector, reason)
+        protocol.ReconnectingClientFactory.clientConnectionFailed(self,
+                connector, reason)
+
+class Cluster(object):
+    """Several nodes sharing one database, each running some of the sources
+    and plugins.
+
+    Sources and plugins that aren't assigned to a node run on all of them.
+    Events that a plugin running on another node could respond to are sent
+    to it over Perspective Broker, and responses for sources running on
+    another node are sent there.
+    """
+
+    def __init__(self, config):
+        self.node = config['node']
+        self.secret = config.get('secret', u'')
+        if not self.secret:
+            raise ibid.IbidException(u'A cluster needs a secret')
+        self.nodes = dict((name, section) for name, section in config.items()
+                          if isinstance(section, dict))
+        if self.node not in self.nodes:
+            raise ibid.IbidException(u'Node %s is not described in [cluster]'
+                                     % self.node)
+
+        self.peers = {}
+        self.factories = {}
+        self.remote_plugins = {}
+
+    def _owner(self, key, name):
+        name = name.lower()
+        for node, section in self.nodes.iteritems():
+            if name in _names(section, key):
+                return node
+        return None
+
+    def source_owner(self, name):
+        "The node that source name runs on, or None if it runs on every node"
+        return self._owner('sources', name)
+
+    def plugin_owner(self, name):
+        "The node that plugin name runs on, or None if it runs on every node"
+        return self._owner('plugins', name)
+
+    def owns_source(self, name):
+        return self.source_owner(name) in (None, self.node)
+
+    def runs_plugin(self, name):
+        return self.plugin_owner(name) in (None, self.node)
+
+    def route(self, source):
+        "The other node that source runs on, if any"
+        owner = self.source_owner(source)
+        if owner == self.node:
+            return None
+        return owner
+
+    def start(self, service=None):
+        "Listen for the other nodes, and connect to them"
+        config = self.nodes[self.node]
+        factory = pb.PBServerFactory(ClusterRoot(self))
+        port = int(config.get('port', 8790))
+        host = config.get('host', 'localhost')
+        if service:
+            internet.TCPServer(port, factory, interface=host) \
+                    .setServiceParent(service)
+        else:
+            reactor.listenTCP(port, factory, interface=host)
+
+        for node, config in self.nodes.iteritems():
+            if node == self.node:
+                continue
+            factory = PeerFactory(self, node)
+            self.factories[node] = factory
+            host = config.get('host', 'localhost')
+            port = int(config.get('port', 8790))
+            if service:
+                internet.TCPClient(host, port, factory) \
+                        .setServiceParent(service)
+            else:
+                reactor.connectTCP(host, port, factory)
+
+        reactor.addSystemEventTrigger('before', 'shutdown', self.stop)
+        log.info(u'Started cluster node %s', self.node)
+
+    def stop(self):
+        for factory in self.factories.itervalues():
+            factory.stopTrying()
+            factory.disconnect()
+        self.factories = {}
+
+    def _connected(self, root, node):
+        def failed(fail):
+            log.error(u"Couldn't join node %s: %s", node,
+                      fail.getErrorMessage())
+        root.callRemote('login', self.node, self.secret) \
+                .addCallback(self._logged_in, node) \
+                .addErrback(failed)
+
+    def _logged_in(self, remote, node):
+        self.peers[node] = remote
+        log.info(u'Connected to node %s', node)
+        return remote.callRemote('describe').addCallback(self._install, node)
+
+    def _install(self, plugins, node):
+        "Put RemoteProcessors in place of node's plugins"
+        installed = []
+        for name, features, descriptions in plugins:
+            if self.plugin_owner(name) != node:
+                log.warning(u'Node %s runs %s plugin, but our '
+                            u'configuration says it belongs on %s',
+                            node, name, self.plugin_owner(name))
+                continue
+            ibid.reloader._install_processors(name, [
+                    RemoteProcessor(node, name, description, features)
+                    for description in descriptions])
+            installed.append(name)
+        self.remote_plugins[node] = installed
+        log.info(u'Using plugins from node %s: %s', node,
+                 u', '.join(sorted(installed)))
+
+    def _disconnected(self, node):
+        if self.peers.pop(node, None) is None:
+            return
+        log.warning(u'Lost connection to node %s', node)
+        for name in self.remote_plugins.pop(node, []):
+            ibid.reloader._install_processors(name, [])
+
+    def describe(self):
+        "Describe the plugins that only run on this node, for the others"
+        plugins = {}
+        for processor in ibid.processors:
+            if (getattr(processor, 'stand_in', False)
+                    or self.plugin_owner(processor.name) != self.node):
+                continue
+            plugins.setdefault(processor.name, []) \
+                    .append(describe_processor(processor))
+
+        return [(name, getattr(sys.modules.get('ibid.plugins.' + name),
+                               'features', {}), descriptions)
+                for name, descriptions in plugins.iteritems()]
+
+    def process(self, processor, event):
+        """Send event to the node that processor stands in for.
+        Called in a worker thread, returns a Deferred that fires when the
+        node has processed it, and its changes have been applied to event.
+        """
+        result = defer.Deferred()
+        result.addCallback(lambda changes: offload.apply_changes(event,
+                                                                 changes))
+        reactor_call(self._forward, result, processor, event.source,
+                     event.type, offload.transferable(event))
+        return result
+
+    def _forward(self, result, processor, source, type, state):
+        peer = self.peers.get(processor.node, None)
+        if peer is None:
+            result.errback(offload.RemoteProcessorError(
+                    u'Not connected to node %s' % processor.node))
+            return
+        peer.callRemote('process', processor.name, processor.classname,
+                        source, type, state).chainDeferred(result)
+
+    def run(self, name, classname, source, type, state):
+        """Process an event sent by another node, returning a Deferred of
+        the changes made to it
+        """
+        for processor in ibid.processors:
+            if (processor.name == name
+                    and processor.__class__.__name__ == classname
+                    and not getattr(processor, 'stand_in', False)):
+                break
+        else:
+            return ({}, [], u'No %s processor in %s plugin on node %s'
+                            % (classname, name, self.node))
+
+        # ibid.auth trusts these, so they are worked out again here
+        state = dict((key, value) for key, value in state.iteritems()
+                     if key not in _identifying_keys)
+        event, before = offload.unpack(source, type, state)
+
+        def failed(fail):
+            return defer_to_thread(offload.changes, event, before,
+                    fail.getTraceback().decode('utf-8', 'replace'))
+
+        def process():
+            self._identify(event)
+            return processor.process(event)
+
+        return defer_to_thread(process).addCallbacks(
+                lambda result: defer_to_thread(offload.changes, event, before),
+                failed)
+
+    def _identify(self, event):
+        "Identify the sender of event, as the identity plugin does"
+        for processor in ibid.processors:
+            if (processor.name == u'identity'
+                    and processor.__class__.__name__ == 'Identify'
+                    and not getattr(processor, 'stand_in', False)):
+                processor.process(event)
+
+    def send(self, response):
+        "Send response to the node running its source"
+        node = self.route(response['source'])
+        peer = self.peers.get(node, None)
+        if peer is None:
+            log.warning(u'Not connected to node %s, dropping response for '
+                        u'%s source: %s', node, response['source'],
+                        response['reply'])
+            return
+
+        def failed(fail):
+            log.error(u"Couldn't send response to node %s: %s", node,
+                      fail.getErrorMessage())
+        peer.callRemote('send', response).addErrback(failed)
+
+# vi: set et sta sw=4 ts=4:
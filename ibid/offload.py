@@ -0,0 +1,160 @@
+# Copyright (c) 2011, Stefano Rivera
+# Released under terms of the MIT/X/Expat Licence. See COPYING for details.
+
+from copy import deepcopy
+import cPickle
+import logging
+import signal
+import sys
+from traceback import format_exception
+
+try:
+    import multiprocessing
+except ImportError:
+    multiprocessing = None
+
+import ibid
+from ibid.event import Event
+
+import auth
+
+# Event keys that can't cross the process boundary
+_local_keys = ('session', 'exc_info')
+
+class RemoteProcessorError(Exception):
+    "A processor raised an exception in a worker process"
+
+def transferable(event):
+    "Return the picklable parts of event, as a dict"
+    state = dict((key, value) for key, value in event.iteritems()
+                 if key not in _local_keys)
+    try:
+        cPickle.dumps(state, cPickle.HIGHEST_PROTOCOL)
+    except Exception:
+        for key, value in state.items():
+            try:
+                cPickle.dumps(value, cPickle.HIGHEST_PROTOCOL)
+            except Exception:
+                del state[key]
+    return state
+
+def _init_worker():
+    "Forget the parent's connections and signal handlers, in a new worker"
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    # The reactor's handler would only log it
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    ibid.sources.clear()
+    ibid.databases = {}
+    ibid.auth = None
+
+# Processors instantiated in this worker process,
+# keyed on (module, class name, plugin name)
+_processors = {}
+
+def _get_processor(module, classname, name):
+    key = (module, classname, name)
+    processor = _processors.get(key, None)
+    if processor is None:
+        __import__(module)
+        processor = getattr(sys.modules[module], classname)(name)
+        _processors[key] = processor
+    return processor
+
+def unpack(source, type, state):
+    """Rebuild an event sent by transferable().
+    Returns the event, and a copy of state to compare it to afterwards.
+    """
+    event = Event(source, type)
+    event.update(state)
+    return event, deepcopy(state)
+
+def changes(event, before, error=None):
+    """Finish with an unpacked event, committing its session unless there
+    was an error. Returns (changed, deleted, error): the keys of the event
+    that were set, the ones that were deleted, and the error.
+    """
+    try:
+        if 'session' in event:
+            if error is None:
+                try:
+                    event.session.deferring_commits = False
+                    event.session.commit()
+                except Exception:
+                    error = u''.join(format_exception(*sys.exc_info()))
+            if error is not None:
+                event.session.rollback()
+    finally:
+        if 'session' in event:
+            event.session.close()
+            del event['session']
+
+    changed = dict((key, value) for key, value in event.iteritems()
+                   if key not in before or before[key] != value)
+    deleted = [key for key in before if key not in event]
+    return changed, deleted, error
+
+def apply_changes(event, result):
+    """Apply the (changed, deleted, error) returned by changes() to event.
+    Raises RemoteProcessorError if there was an error.
+    """
+    changed, deleted, error = result
+    for key in deleted:
+        if key in event:
+            del event[key]
+    event.update(changed)
+
+    if error is not None:
+        raise RemoteProcessorError(error)
+    return event
+
+def _run(module, classname, name, source, type, state):
+    "Process the event described by state, in a worker process"
+    if 'ibid' not in ibid.databases:
+        from ibid.core import DatabaseManager
+        ibid.databases = DatabaseManager(check_schema_versions=False)
+    if ibid.auth is None:
+        ibid.auth = auth.Auth()
+
+    event, before = unpack(source, type, state)
+    try:
+        result = _get_processor(module, classname, name).process(event)
+        if hasattr(result, 'addCallback'):
+            raise RemoteProcessorError(u'%s.%s returned a Deferred, '
+                    u"which can't be waited for in a worker process"
+                    % (name, classname))
+    except Exception:
+        return changes(event, before,
+                       u''.join(format_exception(*sys.exc_info())))
+    return changes(event, before)
+
+class ProcessPool(object):
+    """A pool of worker processes to run Processors in, so that CPU-bound
+    processors don't compete for the GIL.
+
+    Each event is pickled and processed by the worker's own instance of the
+    Processor. The changes the processor made to the event are applied to
+    the original. Workers have their own database sessions, which are
+    committed when the processor finishes, and no sources.
+    """
+
+    def __init__(self, processes, timeout):
+        self.log = logging.getLogger('core.offload')
+        self.timeout = timeout
+        self.pool = multiprocessing.Pool(processes, _init_worker)
+        self.log.info(u'Started %i worker processes', processes)
+
+    def process(self, processor, event):
+        """Run processor on event in a worker process, and wait for it.
+        Raises RemoteProcessorError if the processor raised an exception.
+        """
+        result = self.pool.apply_async(_run, (processor.__class__.__module__,
+                processor.__class__.__name__, processor.name, event.source,
+                event.type, transferable(event)))
+        return apply_changes(event, result.get(self.timeout))
+
+    def stop(self):
+        if self.pool is not None:
+            self.pool.terminate()
+            self.pool = None
+
+# vi: set et sta sw=4 ts=4:
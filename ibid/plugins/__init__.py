@@ -6,8 +6,12 @@ from datetime import timedelta
 from inspect import getargspec, getmembers, ismethod
 import logging
 import re
-from threading import Lock
+import sre_constants
+import sre_parse
+from threading import Lock, local
+from time import time
 
+from twisted.internet import defer
 from twisted.spread import pb
 from twisted.web import resource
 try:
@@ -23,6 +27,7 @@ except ImportError:
             if not os.path.exists(os.path.join(x, *package + ['__init__.py']))]
 
 import ibid
+from ibid import stats
 from ibid.compat import json, defaultdict
 from ibid.utils import url_regex
 
@@ -64,6 +69,12 @@ class Processor(object):
 
     priority: Low priority Processors are handled first
 
+    offload: Run in one of the dispatcher's worker processes, if it has
+    them. For CPU-bound Processors that don't use sources or Deferreds
+
+    time_budget: Seconds the Processor may run for, before the dispatcher
+    gives up on it. None for the [plugins] time_budget, 0 for no limit
+
     autoload: Load this Processor, when loading the plugin, even if not
     explicitly required in the configuration file
     """
@@ -73,6 +84,8 @@ class Processor(object):
     processed = False
     priority = 0
     autoload = True
+    offload = False
+    time_budget = None
     _event_handlers = None
     _periodic_handlers = None
 
@@ -103,7 +116,8 @@ class Processor(object):
 
     def __init__(self, name):
         self.name = name
-        self.setup()
+        stats.profile_startup('setup',
+                u'%s.%s' % (name, self.__class__.__name__), self.setup)
 
     def setup(self):
         "Apply configuration. Called on every config reload"
@@ -116,7 +130,11 @@ class Processor(object):
         pass
 
     def process(self, event):
-        "Process a single event"
+        """Process a single event.
+        Handlers may return a Deferred (from the non-blocking helpers in
+        ibid.utils), in which case a Deferred is returned, and the rest of
+        the processor chain waits for it.
+        """
         if event.type == 'clock':
             for method in self._get_periodic_handlers():
                 self._run_periodic_handler(method, event)
@@ -131,6 +149,8 @@ class Processor(object):
             return
 
         found = False
+        deferreds = []
+        index = match_index
         for method in self._get_event_handlers():
             args = None
             if not hasattr(method, 'pattern'):
@@ -141,7 +161,10 @@ class Processor(object):
                 message = event.message
                 if isinstance(message, dict):
                     message = message[method.message_version]
-                match = method.pattern.search(message)
+                if index.may_match(method, message):
+                    match = method.pattern.search(message)
+                else:
+                    match = None
                 if match is not None:
                     args = match.groups()
                     kwargs = match.groupdict()
@@ -161,18 +184,58 @@ class Processor(object):
             if args is not None:
                 if (not getattr(method, 'auth_required', False)
                         or auth_responses(event, self.permission)):
-                    if isinstance(args, dict):
-                        method(event, **args)
-                    else:
-                        method(event, *args)
+                    hist = stats.histogram(self.name,
+                            self.__class__.__name__, method.__name__)
+                    start = time()
+                    try:
+                        if isinstance(args, dict):
+                            result = method(event, **args)
+                        else:
+                            result = method(event, *args)
+                    except:
+                        hist.observe_since(start)
+                        raise
+                    stats.observe_result(hist, start, result)
+                    if isinstance(result, defer.Deferred):
+                        deferreds.append(result)
                 elif not getattr(method, 'auth_fallthrough', True):
                     event.processed = True
 
         if not found:
             raise RuntimeError(u'No handlers found in %s' % self)
 
+        if len(deferreds) == 1:
+            return deferreds[0]
+        elif deferreds:
+            return defer.DeferredList(deferreds, fireOnOneErrback=True,
+                                      consumeErrors=True)
+
         return event
 
+    def may_handle(self, event):
+        """Could process() do anything with event?
+        A cheap check, run before handing the event to a worker process.
+        """
+        if event.type == 'clock' and list(self._get_periodic_handlers()):
+            return True
+        if event.type not in self.event_types:
+            return False
+        if self.addressed and ('addressed' not in event or not event.addressed):
+            return False
+        if not self.processed and event.processed:
+            return False
+
+        for method in self._get_event_handlers():
+            if not hasattr(method, 'pattern') or not hasattr(event, 'message'):
+                return True
+            message = event.message
+            if isinstance(message, dict):
+                message = message[method.message_version]
+            if (match_index.may_match(method, message)
+                    and method.pattern.search(message) is not None):
+                return True
+        return False
+
     def _get_event_handlers(self):
         "Find all the handlers (regex matching and blind)"
         for handler in self._event_handlers or self.__event_handlers:
@@ -185,7 +248,7 @@ class Processor(object):
 
     def _run_periodic_handler(self, method, event):
         "Run a periodic handler, if appropriate"
-        if (method.interval.seconds > 0
+        if (method.interval > timedelta(0)
                 and not method.disabled
                 and method.lock.acquire(0)):
             try:
@@ -199,7 +262,12 @@ class Processor(object):
                     name = u'%s.%s' % (self.__class__.__name__, method.__name__)
                     try:
                         self.__log.debug(u'Running periodic event: %s', name)
-                        method(event)
+                        start = time()
+                        try:
+                            method(event)
+                        finally:
+                            stats.histogram(self.name, self.__class__.__name__,
+                                    method.__name__).observe_since(start)
                         if method.failing:
                             self.__log.info(u'No longer failing: %s', name)
                             method.im_func.failing = False
@@ -215,13 +283,16 @@ class Processor(object):
                 method.lock.release()
 
 # This is a bit yucky, but necessary since ibid.config imports Processor
-from ibid.config import BoolOption, IntOption
+from ibid.config import BoolOption, FloatOption, IntOption
 options = {
     'addressed': BoolOption('addressed',
         u'Only process events if bot was addressed'),
     'processed': BoolOption('processed',
         u"Process events even if they've already been processed"),
     'priority': IntOption('priority', u'Processor priority'),
+    'offload': BoolOption('offload', u'Run in a worker process'),
+    'time_budget': FloatOption('time_budget',
+        u'Seconds to run for before being abandoned'),
 }
 
 def handler(function):
@@ -280,6 +351,141 @@ def match(regex, version='clean', simple=True):
         return function
     return wrap
 
+_MAX_PREFIXES = 64
+
+def _sequence_prefixes(items):
+    """Return (prefixes, complete) for a parsed regex sequence.
+    prefixes is the set of literal strings that a match must start with,
+    complete is True if the sequence matches nothing beyond them.
+    """
+    prefixes = set([u''])
+    for op, av in items:
+        if op == sre_constants.LITERAL:
+            item, complete = set([unichr(av)]), True
+        elif op == sre_constants.SUBPATTERN:
+            item, complete = _sequence_prefixes(av[-1])
+        elif op == sre_constants.BRANCH:
+            item, complete = set(), True
+            for branch in av[1]:
+                branch_prefixes, branch_complete = _sequence_prefixes(branch)
+                item |= branch_prefixes
+                complete = complete and branch_complete
+        elif (op in (sre_constants.MAX_REPEAT, sre_constants.MIN_REPEAT)
+                and av[0] >= 1):
+            item, complete = _sequence_prefixes(av[2])[0], False
+        else:
+            return prefixes, False
+
+        prefixes = set(prefix + suffix
+                       for prefix in prefixes for suffix in item)
+        if len(prefixes) > _MAX_PREFIXES:
+            return set([u'']), False
+        if not complete:
+            return prefixes, False
+    return prefixes, True
+
+_prefix_cache = {}
+
+def literal_prefixes(pattern):
+    """Return the set of lower-case literal strings that a match of the
+    compiled pattern must start with, or None if there isn't one.
+    """
+    key = (pattern.pattern, pattern.flags)
+    if key in _prefix_cache:
+        return _prefix_cache[key]
+
+    prefixes = None
+    if not pattern.flags & re.MULTILINE:
+        try:
+            items = list(sre_parse.parse(pattern.pattern, pattern.flags))
+            if items and items[0] in (
+                    (sre_constants.AT, sre_constants.AT_BEGINNING),
+                    (sre_constants.AT, sre_constants.AT_BEGINNING_STRING)):
+                prefixes = _sequence_prefixes(items[1:])[0]
+        except (sre_constants.error, ValueError):
+            prefixes = None
+
+    if prefixes is not None:
+        prefixes = set(prefix.lower() for prefix in prefixes)
+        if u'' in prefixes:
+            prefixes = None
+
+    _prefix_cache[key] = prefixes
+    return prefixes
+
+class MatchIndex(object):
+    """Prefilter for @match handlers.
+    Anchored patterns are indexed in a trie by their leading literals, so a
+    message only needs to be searched by the handlers whose literals it
+    starts with. Handlers without a leading literal are always searched.
+    """
+
+    def __init__(self, processors=()):
+        self.patterns = {}
+        self.tries = {}
+        self.depth = 0
+        self._local = local()
+
+        for processor in processors:
+            if not isinstance(processor, Processor):
+                continue
+            for method in processor._get_event_handlers():
+                if hasattr(method, 'pattern'):
+                    self.add(method.im_func)
+
+    def add(self, function):
+        prefixes = literal_prefixes(function.pattern)
+        if prefixes is None:
+            return
+
+        self.patterns[function] = function.pattern
+        root = self.tries.setdefault(function.message_version, {})
+        for prefix in prefixes:
+            node = root
+            for char in prefix:
+                node = node.setdefault(char, {})
+            node.setdefault(None, set()).add(function)
+            self.depth = max(self.depth, len(prefix))
+
+    def candidates(self, version, message):
+        "Return the indexed handler functions that may match message"
+        cache = getattr(self._local, 'cache', None)
+        if cache is None:
+            cache = self._local.cache = {}
+        if version in cache and cache[version][0] is message:
+            return cache[version][1]
+
+        found = set()
+        node = self.tries.get(version, {})
+        for char in message[:self.depth].lower():
+            node = node.get(char)
+            if node is None:
+                break
+            found.update(node.get(None, ()))
+
+        cache[version] = (message, found)
+        return found
+
+    def may_match(self, method, message):
+        "Could method's pattern match message?"
+        function = method.im_func
+        indexed = self.patterns.get(function)
+        if indexed is None:
+            return True
+        if indexed is not function.pattern:
+            # setup() has swapped in a new pattern
+            rebuild_match_index(ibid.processors)
+            return True
+        return function in self.candidates(function.message_version, message)
+
+match_index = MatchIndex()
+
+def rebuild_match_index(processors):
+    "Rebuild the @match prefilter for the given processors"
+    global match_index
+    match_index = MatchIndex(processors)
+    return match_index
+
 def auth_responses(event, permission):
     """Mark an event as having required authorisation, and return True if the
     event sender has permission.
@@ -9,8 +9,9 @@ from twisted.internet import reactor
 
 import ibid
 from ibid.utils import human_join
-from ibid.config import FileConfig, Option
-from ibid.plugins import Processor, match, authorise, auth_responses
+from ibid.config import FileConfig, Option, IntOption
+from ibid.plugins import Processor, match, authorise, auth_responses, RPC
+from ibid import stats
 from ibid.utils import ibid_version
 
 log = logging.getLogger('plugins.admin')
@@ -161,6 +162,53 @@ class Version(Processor):
         else:
             event.addresponse(u"I don't know what version I am :-(")
 
+features['stats'] = {
+    'description': u'Shows how long each plugin takes to handle events.',
+    'categories': ('admin', 'debug'),
+}
+class Stats(Processor, RPC):
+    usage = u"""stats [for <plugin>]
+    reset stats"""
+    features = ('stats',)
+
+    permission = u'core'
+
+    top = IntOption('top', u'Number of processors or handlers to list', 5)
+
+    def __init__(self, name):
+        Processor.__init__(self, name)
+        RPC.__init__(self)
+
+    @match(r'(?:latency )?stats(?: for {chunk})?')
+    def show(self, event, plugin):
+        # Without a plugin, show whole processors. With one, its handlers.
+        entries = [(key, hist) for key, hist in stats.histograms.items()
+                   if (key[2] is None) == (plugin is None)
+                   and plugin in (None, key[0])]
+        if not entries:
+            event.addresponse(u"I haven't timed anything yet")
+            return
+
+        entries.sort(key=lambda (key, hist): hist.total, reverse=True)
+        event.addresponse(u'Slowest: %s', human_join(
+            u'%s: %i calls, mean %s, p95 %s, max %s' % (
+                u'.'.join(part for part in key if part is not None),
+                hist.count, format_ms(hist.mean()),
+                format_ms(hist.quantile(0.95)), format_ms(hist.max))
+            for key, hist in entries[:self.top]), separator=u';')
+
+    @match(r'reset stats')
+    @authorise()
+    def reset(self, event):
+        stats.reset()
+        event.addresponse(True)
+
+    def remote_dump(self):
+        return stats.snapshot()
+
+def format_ms(seconds):
+    return u'%.1fms' % (seconds * 1000)
+
 features['config'] = {
     'description': u'Gets and sets configuration settings, and rereads the '
                    u'configuration file.',
@@ -36,6 +36,7 @@ features['draw-aa'] = {
 class DrawImage(Processor):
     usage = u'draw <url> [in colour] [width <width>] [height <height>]'
     features = ('draw-aa',)
+    offload = True
 
     max_filesize = IntOption('max_filesize', 'Only request this many KiB', 200)
     def_height = IntOption('def_height', 'Default height for libaa output', 10)
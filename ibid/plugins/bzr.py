@@ -100,11 +100,10 @@ class Bazaar(Processor, RPC):
     def remote_committed(self, repository, start, end=None):
         commits = self.get_commits(repository, start, end)
         repo = self.repositories[repository]
-        for commit in commits:
-            ibid.dispatcher.send({'reply': commit,
+        ibid.dispatcher.send_many([{'reply': commit,
                 'source': repo['source'],
                 'target': repo['channel'],
-            })
+            } for commit in commits])
 
         return True
 
@@ -144,6 +144,7 @@ class Calc(Processor):
     features = ('calc',)
 
     priority = 500
+    offload = True
 
     extras = ('abs', 'round', 'min', 'max')
     banned = ('for', 'yield', 'lambda', '__', 'is')
@@ -157,11 +158,34 @@ class Calc(Processor):
     safe['pow'] = limited_pow
     safe['factorial'] = limited_factorial
 
-    @match(r'^(.+)$')
-    def calculate(self, event, expression):
+    def may_handle(self, event):
+        "Only send expressions that parse to a worker process"
+        if not super(Calc, self).may_handle(event):
+            return False
+        if not hasattr(event, 'message'):
+            return True
+        message = event.message
+        if isinstance(message, dict):
+            message = message[self.calculate.message_version]
+        match = self.calculate.pattern.search(message)
+        if match is None or self._banned(match.group(1)):
+            return False
+        try:
+            parse(match.group(1), mode='eval')
+        except Exception:
+            return False
+        return True
+
+    def _banned(self, expression):
         for term in self.banned:
             if term in expression:
-                return
+                return True
+        return False
+
+    @match(r'^(.+)$')
+    def calculate(self, event, expression):
+        if self._banned(expression):
+            return
 
         try:
             # We need to remove all power operators and replace with our limited pow
@@ -287,6 +287,10 @@ class ChannelTracker(Processor):
                 ibid.channels.pop(event.source, None)
             elif event.status == u'left':
                 ibid.channels[event.source].pop(event.channel, None)
+            elif event.status == u'names' and 'identities' in event:
+                channel = ibid.channels[event.source][event.channel]
+                for identity in event.identities:
+                    channel.add(identity)
         elif event.public:
             if event.state == u'online' and hasattr(event, 'othername'):
                 oldid = identify(event.session, event.source, event.othername)
@@ -3,19 +3,23 @@
 
 from datetime import datetime
 import logging
-from random import choice
+from random import choice, random
 import re
+from threading import Lock
+from time import time
 
 from dateutil.tz import tzlocal, tzutc
+from sqlalchemy.sql import select
 
+from ibid import stats
 from ibid.plugins import Processor, match, handler, authorise, auth_responses, \
                          RPC
-from ibid.config import Option, IntOption, ListOption
+from ibid.config import Option, BoolOption, IntOption, ListOption
 from ibid.db import IbidUnicode, IbidUnicodeText, Boolean, Integer, DateTime, \
                     Table, Column, ForeignKey, PassiveDefault, \
-                    relation, synonym, func, or_, \
+                    relation, synonym, func, or_, and_, \
                     Base, VersionedSchema, \
-                    get_regexp_op
+                    get_regexp_op, fulltext_match, fulltext_words
 from ibid.plugins.identity import get_identities
 from ibid.utils import format_date
 
@@ -97,8 +101,13 @@ class FactoidName(Base):
                 self.upgrade_session.delete(row)
                 if len(row.factoid.names) == 0:
                     self.upgrade_session.delete(row.factoid)
+        def upgrade_9_to_10(self):
+            self.add_fulltext_index(self.table.c._name)
 
-    __table__.versioned_schema = FactoidNameSchema(__table__, 9)
+        def created(self):
+            self.add_fulltext_index(self.table.c._name)
+
+    __table__.versioned_schema = FactoidNameSchema(__table__, 10)
 
     def __init__(self, name, identity_id, factoid_id=None, factpack=None):
         self.name = name
@@ -140,8 +149,13 @@ class FactoidValue(Base):
         def upgrade_3_to_4(self):
             self.alter_column(Column('value', IbidUnicodeText, nullable=False),
                               force_rebuild=True)
+        def upgrade_4_to_5(self):
+            self.add_fulltext_index(self.table.c.value)
+
+        def created(self):
+            self.add_fulltext_index(self.table.c.value)
 
-    __table__.versioned_schema = FactoidValueSchema(__table__, 4)
+    __table__.versioned_schema = FactoidValueSchema(__table__, 5)
 
     def __init__(self, value, identity_id, factoid_id=None, factpack=None):
         self.value = value
@@ -179,6 +193,34 @@ class Factoid(Base):
     def __repr__(self):
         return u"<Factoid %s = %s>" % (', '.join([name.name for name in self.names]), ', '.join([value.value for value in self.values]))
 
+class FactoidNamesVersion(Base):
+    """A counter of changes to factoid_names, so that processes can tell
+    when their factoid_index is out of date
+    """
+    __table__ = Table('factoid_names_version', Base.metadata,
+    Column('id', Integer, primary_key=True),
+    Column('version', Integer, nullable=False),
+    useexisting=True)
+
+    __table__.versioned_schema = VersionedSchema(__table__, 1)
+
+def bump_names_version(session):
+    """Record a change to factoid_names, in session's transaction.
+    Returns the new version, to pass to factoid_index.update()
+    after committing, with session.after_commit().
+    """
+    table = FactoidNamesVersion.__table__
+    result = session.execute(table.update().where(table.c.id == 1)
+                             .values(version=table.c.version + 1))
+    if result.rowcount == 0:
+        session.execute(table.insert().values(id=1, version=1))
+    return names_version(session)
+
+def names_version(session):
+    "Return the current version of factoid_names"
+    return session.query(FactoidNamesVersion.version) \
+                  .filter(FactoidNamesVersion.id == 1).scalar() or 0
+
 class Factpack(Base):
     __table__ = Table('factpacks', Base.metadata,
     Column('id', Integer, primary_key=True),
@@ -209,6 +251,188 @@ action_re = re.compile(r'^\s*<action>\s*')
 reply_re = re.compile(r'^\s*<reply>\s*')
 escape_like_re = re.compile(r'([%_#])')
 
+def wild_pattern(escaped):
+    """Compile the LIKE pattern of an escaped wildcard factoid name.
+    Returns the lowercased literal text before the first wildcard, and a
+    regex matching the same names as the pattern.
+    """
+    parts = []
+    prefix = []
+    wild = False
+    i = 0
+    while i < len(escaped):
+        char = escaped[i]
+        if char == u'\\' and i + 1 < len(escaped):
+            i += 1
+            char = escaped[i]
+        elif char in u'_%':
+            wild = True
+            parts.append(char == u'_' and u'.' or u'.*')
+            i += 1
+            continue
+        if not wild:
+            prefix.append(char)
+        parts.append(re.escape(char))
+        i += 1
+    return u''.join(prefix).lower(), re.compile(u''.join(parts) + u'\\Z',
+                                                re.I | re.U | re.DOTALL)
+
+class FactoidIndex(object):
+    """An in-memory index of factoid names, so that looking up a name doesn't
+    need a scan of every wildcard name in the database, and names that don't
+    exist needn't touch the database at all.
+
+    Every escaped name is held as the hash of its lowercased text, counted
+    so that collisions survive removals. The index may claim names that no
+    longer exist, so its results must be confirmed by a query. Changes made
+    in this process are applied with update(). Changes made by other
+    processes are noticed from factoid_names_version, which is checked at
+    most every check_interval seconds, and before the index says that
+    nothing matches.
+    """
+
+    check_interval = 5
+
+    def __init__(self):
+        self.lock = Lock()
+        self.version = None
+        self.checked = 0
+        # hash of lowercased escaped name -> count
+        self.hashes = {}
+        # name id -> (prefix, regex)
+        self.wild = {}
+        # prefix -> set of name ids
+        self.prefixes = {}
+
+    def _add(self, id, escaped, wild):
+        key = hash(escaped.lower())
+        self.hashes[key] = self.hashes.get(key, 0) + 1
+        if wild:
+            prefix, regex = wild_pattern(escaped)
+            self.wild[id] = (prefix, regex)
+            self.prefixes.setdefault(prefix, set()).add(id)
+
+    def _remove(self, id, escaped, wild):
+        key = hash(escaped.lower())
+        count = self.hashes.get(key, 0) - 1
+        if count > 0:
+            self.hashes[key] = count
+        else:
+            self.hashes.pop(key, None)
+        entry = self.wild.pop(id, None)
+        if entry is not None:
+            ids = self.prefixes[entry[0]]
+            ids.discard(id)
+            if not ids:
+                del self.prefixes[entry[0]]
+
+    def load(self, session):
+        version = names_version(session)
+        names = session.query(FactoidName.id, FactoidName._name,
+                              FactoidName.wild).all()
+        self.lock.acquire()
+        try:
+            self.hashes = {}
+            self.wild = {}
+            self.prefixes = {}
+            for id, escaped, wild in names:
+                self._add(id, escaped, wild)
+            self.version = version
+        finally:
+            self.lock.release()
+        log.debug(u'Indexed %i factoid names, %i wildcard', len(names),
+                  len(self.wild))
+
+    def refresh(self, session, force=False):
+        """Reload the index, if factoid_names has been changed elsewhere.
+        Unless force is set, only checks every check_interval seconds.
+        """
+        now = time()
+        if (not force and self.version is not None
+                and now - self.checked < self.check_interval):
+            return
+        self.checked = now
+        if self.version is None or names_version(session) != self.version:
+            self.load(session)
+
+    def update(self, version, added=(), removed=()):
+        """Apply changes committed in this process.
+        added and removed are sequences of (id, escaped name, wild), from
+        index_entries(). version was returned by bump_names_version().
+        """
+        self.lock.acquire()
+        try:
+            if self.version is None:
+                return
+            if version != self.version + 1:
+                # Someone else has changed something, too
+                self.version = None
+                return
+            for entry in removed:
+                self._remove(*entry)
+            for entry in added:
+                self._add(*entry)
+            self.version = version
+        finally:
+            self.lock.release()
+
+    def may_exist(self, session, escaped):
+        "Could there be a name matching escaped exactly?"
+        self.refresh(session)
+        key = hash(escaped.lower())
+        if key in self.hashes:
+            return True
+        # Only trust a negative answer from an up to date index
+        self.refresh(session, force=True)
+        return key in self.hashes
+
+    def wild_matches(self, session, name):
+        "Return the ids of the wildcard names that match name"
+        self.refresh(session)
+        matches = self._wild_matches(name)
+        if not matches:
+            # Only trust a negative answer from an up to date index
+            self.refresh(session, force=True)
+            matches = self._wild_matches(name)
+        return matches
+
+    def _wild_matches(self, name):
+        lowered = name.lower()
+        matches = []
+        self.lock.acquire()
+        try:
+            for end in xrange(len(lowered) + 1):
+                for id in self.prefixes.get(lowered[:end], ()):
+                    if self.wild[id][1].match(name):
+                        matches.append(id)
+        finally:
+            self.lock.release()
+        return matches
+
+factoid_index = FactoidIndex()
+
+def index_entries(names):
+    """Return the (id, escaped name, wild) of the FactoidNames in names, for
+    FactoidIndex.update(). They must have been flushed.
+    """
+    return [(name.id, name._name, name.wild) for name in names]
+
+def random_value(query):
+    """Return a random row of query, or None, in a single query.
+    Rather than having the database sort every row into a random order,
+    picks a random point in the ids of each factoid's values, and takes the
+    first row at or after it. Values that follow gaps in the ids are picked
+    more often, and if several factoids match, the first one wins.
+    """
+    values = FactoidValue.__table__.alias()
+    first, last = func.min(values.c.id), func.max(values.c.id)
+    # The lowest id at or above this is evenly distributed between first
+    # and last, when there are no gaps
+    point = select([first - 1 + (last - first + 1) * random()],
+                   values.c.factoid_id == FactoidValue.factoid_id).as_scalar()
+    return query.filter(FactoidValue.id >= point) \
+                .order_by(FactoidValue.id).first()
+
 def get_factoid(session, name, number, pattern, is_regex, all=False,
                 literal=False):
     """session: SQLAlchemy session
@@ -235,13 +459,22 @@ def get_factoid(session, name, number, pattern, is_regex, all=False,
                 .add_entity(FactoidName).join(Factoid.names)\
                 .add_entity(FactoidValue).join(Factoid.values)
         if wild:
+            candidates = factoid_index.wild_matches(session, name)
+            if not candidates:
+                continue
             # Reversed LIKE because factoid name contains SQL wildcards if
-            # factoid supports arguments
-            query = query.filter(
+            # factoid supports arguments. Confirms the index's candidates.
+            query = query.filter(FactoidName.id.in_(candidates)).filter(
                     'lower(:fact) LIKE lower(name) ESCAPE :escape'
                 ).params(fact=name, escape='\\')
         else:
-            query = query.filter(FactoidName.name == escape_name(name))
+            escaped = escape_name(name)
+            # Literal queries are commands, not chatter, so they always
+            # ask the database
+            if not literal and not factoid_index.may_exist(session, escaped):
+                stats.increment('factoid_lookups_skipped')
+                continue
+            query = query.filter(FactoidName.name == escaped)
         # For normal matches, restrict to the subset applicable
         if not literal:
             query = query.filter(FactoidName.wild == wild)
@@ -271,8 +504,11 @@ def get_factoid(session, name, number, pattern, is_regex, all=False,
                 return [factoid]
             else:
                 factoid = query.all()
-        else:
-            factoid = factoid or query.order_by(func.random()).first()
+        elif factoid is None:
+            if pattern:
+                factoid = query.order_by(func.random()).first()
+            else:
+                factoid = random_value(query)
         if factoid:
             return factoid
     if all:
@@ -332,7 +568,11 @@ class Forget(Processor):
                     if len(filter(lambda x: x.identity_id not in identities, factoid.names)) > 0 and not factoidadmin:
                         return
                     id = factoid.id
+                    removed = index_entries(factoid.names)
                     event.session.delete(factoid)
+                    version = bump_names_version(event.session)
+                    event.session.after_commit(factoid_index.update, version,
+                                               removed=removed)
                     event.session.commit()
                     log.info(u"Deleted factoid %s (%s) by %s/%s (%s)",
                             id, name, event.account, event.identity, event.sender['connection'])
@@ -352,14 +592,22 @@ class Forget(Processor):
                     if len(filter(lambda x: x.identity_id not in identities, factoid.values)) > 0 and not factoidadmin:
                         return
                     id = factoid.id
+                    removed = index_entries(factoid.names)
                     event.session.delete(factoid)
+                    version = bump_names_version(event.session)
+                    event.session.after_commit(factoid_index.update, version,
+                                               removed=removed)
                     event.session.commit()
                     log.info(u"Deleted factoid %s (%s) by %s/%s (%s)",
                             id, name, event.account, event.identity,
                             event.sender['connection'])
                 else:
                     id = factoids[0][1].id
+                    removed = index_entries([factoids[0][1]])
                     event.session.delete(factoids[0][1])
+                    version = bump_names_version(event.session)
+                    event.session.after_commit(factoid_index.update, version,
+                                               removed=removed)
                     event.session.commit()
                     log.info(u"Deleted name %s (%s) of factoid %s (%s) by %s/%s (%s)",
                             id, factoids[0][1].name, factoid.id, factoids[0][0].names[0].name,
@@ -402,6 +650,11 @@ class Forget(Processor):
             name = FactoidName(unicode(target), event.identity)
             factoid.names.append(name)
             event.session.add(factoid)
+            event.session.flush()
+            added = index_entries([name])
+            version = bump_names_version(event.session)
+            event.session.after_commit(factoid_index.update, version,
+                                       added=added)
             event.session.commit()
             event.addresponse(True)
             log.info(u"Added name '%s' to factoid %s (%s) by %s/%s (%s)",
@@ -416,6 +669,11 @@ class Search(Processor):
 
     limit = IntOption('search_limit', u'Maximum number of results to return', 30)
     default = IntOption('search_default', u'Default number of results to return', 10)
+    fulltext = BoolOption('search_fulltext', u'Use the full-text index, if '
+            u'there is one, for non-regex searches. Faster on big '
+            u'databases, but words in the pattern only match the starts of '
+            u'words, so "oo" finds "ooze" and not "foo". Substrings are only '
+            u'searched for when no word matches', False)
 
     regex_re = re.compile(r'^/(.*)/(r?)$')
 
@@ -434,6 +692,11 @@ class Search(Processor):
             pattern = m.group(1)
             is_regex = bool(m.group(2))
 
+        name_words = value_words = ()
+        if self.fulltext and not is_regex:
+            name_words = fulltext_words(pattern.replace(u'$arg', u' '))
+            value_words = fulltext_words(pattern)
+
         # Hack: We replace $arg with _%, but this won't match a partial
         # "$arg" string
         if is_regex:
@@ -444,33 +707,67 @@ class Search(Processor):
             pattern = '%%%s%%' % escape_like_re.sub(r'#\1', pattern)
             name_pattern = pattern.replace('$arg', '#_#%')
 
-        query = event.session.query(Factoid)\
-                             .join(Factoid.names).add_entity(FactoidName)\
-                             .join(Factoid.values)
-
-        if search_type.startswith('fact'):
-            query = query.filter(filter_op(FactoidName.name, name_pattern))
-        elif search_type.startswith('value'):
-            query = query.filter(filter_op(FactoidValue.value, pattern))
-        else:
-            query = query.filter(or_(filter_op(FactoidName.name, name_pattern),
-                                     filter_op(FactoidValue.value, pattern)))
+        try:
+            name_filter = filter_op(FactoidName.name, name_pattern)
+            value_filter = filter_op(FactoidValue.value, pattern)
+        except re.error, e:
+            event.addresponse(u"Couldn't search. Invalid regex: %s", unicode(e))
+            return
 
-        # Pre-evalute the iterable or the if statement will be True in SQLAlchemy 0.4. LP: #383286
-        matches = [match for match in query.all()]
+        # The full-text index narrows down the rows, the pattern confirms
+        name_index = fulltext_match(event.session,
+                                    FactoidName.__table__.c._name, name_words)
+        value_index = fulltext_match(event.session,
+                                     FactoidValue.__table__.c.value,
+                                     value_words)
+
+        query = self._query(event.session, search_type,
+                            name_filter, value_filter, name_index, value_index)
+        bounded_matches = query.order_by(FactoidName.id)[start:start+limit]
+        if (not bounded_matches and (name_index is not None
+                                     or value_index is not None)
+                and not query.count()):
+            # The index only matches the start of words. That's what
+            # search_fulltext asks for, but rather than find nothing, fall
+            # back to a substring search
+            query = self._query(event.session, search_type,
+                                name_filter, value_filter, None, None)
+            bounded_matches = query.order_by(FactoidName.id)[start:start+limit]
 
-        bounded_matches = matches[start:start+limit]
         if bounded_matches:
             event.addresponse(u'; '.join(
                 u'%s [%s]' % (fname.name, len(factoid.values))
                 for factoid, fname in bounded_matches))
-        elif len(matches):
-            event.addresponse(u"I could only find %(number)d things that matched '%(pattern)s'", {
-                u'number': len(matches),
-                u'pattern': origpattern,
-            })
         else:
-            event.addresponse(u"I couldn't find anything that matched '%s'" % origpattern)
+            count = query.count()
+            if count:
+                event.addresponse(u"I could only find %(number)d things that matched '%(pattern)s'", {
+                    u'number': count,
+                    u'pattern': origpattern,
+                })
+            else:
+                event.addresponse(u"I couldn't find anything that matched '%s'" % origpattern)
+
+    def _query(self, session, search_type, name_filter, value_filter,
+               name_index, value_index):
+        "Build the search query, narrowed by any full-text indexes"
+        if name_index is not None:
+            name_filter = and_(name_index, name_filter)
+        if value_index is not None:
+            value_filter = and_(value_index, value_filter)
+        # A subquery, rather than a join, gives one row per name, so that
+        # LIMIT and OFFSET can be left to the database
+        value_filter = Factoid.id.in_(session.query(FactoidValue.factoid_id)
+                                      .filter(value_filter).subquery())
+
+        query = session.query(Factoid).join(Factoid.names) \
+                       .add_entity(FactoidName)
+
+        if search_type.startswith('fact'):
+            return query.filter(name_filter)
+        elif search_type.startswith('value'):
+            return query.filter(value_filter)
+        return query.filter(or_(name_filter, value_filter))
 
 def _interpolate(message, event):
     "Expand factoid variables"
@@ -509,12 +806,16 @@ class Get(Processor, RPC):
 
     interrogatives = ListOption('interrogatives', 'Question words to strip', default_interrogatives)
     verbs = ListOption('verbs', 'Verbs that split name from value', default_verbs)
+    index_check_interval = IntOption('index_check_interval',
+            u'Seconds between checks for factoid names changed by other '
+            u'processes. Lookups that find nothing always check', 5)
 
     def __init__(self, name):
         super(Get, self).__init__(name)
         RPC.__init__(self)
 
     def setup(self):
+        factoid_index.check_interval = self.index_check_interval
         self.get.im_func.pattern = re.compile(
                 r'^(?:(?:%s)\s+(?:(?:%s)\s+)?)?(.+?)(?:\s+#(\d+))?(?:\s+/(.+?)/(r?))?$'
                   % ('|'.join(self.interrogatives),
@@ -591,6 +892,7 @@ class Set(Processor):
             )))
             return
 
+        added = None
         factoid = event.session.query(Factoid).join(Factoid.names)\
                 .filter(FactoidName.name==escape_name(name)).first()
         if factoid:
@@ -609,6 +911,7 @@ class Set(Processor):
             factoid.names.append(fname)
             event.session.add(factoid)
             event.session.flush()
+            added = index_entries([fname])
             log.info(u"Creating factoid %s with name '%s' by %s", factoid.id, fname.name, event.identity)
 
         if not reply_re.match(value) and not action_re.match(value):
@@ -616,6 +919,10 @@ class Set(Processor):
         fvalue = FactoidValue(unicode(value), event.identity)
         factoid.values.append(fvalue)
         event.session.add(factoid)
+        if added is not None:
+            version = bump_names_version(event.session)
+            event.session.after_commit(factoid_index.update, version,
+                                       added=added)
         event.session.commit()
         self.last_set_factoid=factoid.names[0].name
         log.info(u"Added value '%s' to factoid %s (%s) by %s/%s (%s)",
@@ -48,7 +48,7 @@ class Help(Processor):
             categories[k] = v
 
         features = {}
-        processor_modules = set()
+        plugin_features = {}
         for processor in ibid.processors:
             for feature in getattr(processor, 'features', []):
                 if feature not in features:
@@ -64,10 +64,15 @@ class Help(Processor):
                     features[feature]['usage'] += [line.strip()
                             for line in processor.usage.split('\n')
                             if line.strip()]
-            processor_modules.add(sys.modules[processor.__module__])
-
-        for module in processor_modules:
-            for feature, meta in getattr(module, 'features', {}).iteritems():
+            if getattr(processor, 'stand_in', False):
+                plugin_features['ibid.plugins.' + processor.name] = \
+                        processor.plugin_features
+            else:
+                plugin_features[processor.__module__] = getattr(
+                        sys.modules[processor.__module__], 'features', {})
+
+        for module_features in plugin_features.itervalues():
+            for feature, meta in module_features.iteritems():
                 if feature not in features:
                     continue
                 if meta.get('description'):
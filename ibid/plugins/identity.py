@@ -2,23 +2,31 @@
 # Released under terms of the MIT/X/Expat Licence. See COPYING for details.
 
 import string
+from datetime import datetime
 from random import choice
 import logging
 
 import ibid
-from ibid.config import Option
+from ibid.config import Option, IntOption
 from ibid.compat import any
 from ibid.db import eagerload, IntegrityError, and_, or_
 from ibid.db.models import Account, Identity, Attribute, Credential, Permission
 from ibid.plugins import Processor, match, handler, auth_responses, authorise
-from ibid.utils import human_join
+from ibid.utils import human_join, LRUCache
 from ibid.auth import hash
 
 features = {}
-identify_cache = {}
+# (source, lowercased sender id) -> (identity, account)
+identify_cache = LRUCache(1000, 'identity')
 
 log = logging.getLogger('plugins.identity')
 
+def forget(identity=None, account=None):
+    "Drop the cached identification of connections by identity or account"
+    identify_cache.discard_matching(lambda key, value:
+            (identity is not None and value[0] == identity)
+            or (account is not None and value[1] == account))
+
 features['accounts'] = {
     'description': u'Manage users accounts with the bot. An account represents '
                    u'a person. An account has one or more identities, which is '
@@ -66,6 +74,7 @@ class Accounts(Processor):
                 identity.account_id = account.id
                 event.session.add(identity)
                 event.session.commit()
+                forget(identity=identity.id)
                 log.info(u"Attached identity %s (%s on %s) to account %s (%s)",
                         identity.id, identity.identity, identity.source, account.id, account.username)
         else:
@@ -73,10 +82,10 @@ class Accounts(Processor):
             identity.account_id = account.id
             event.session.add(identity)
             event.session.commit()
+            forget(identity=identity.id)
             log.info(u"Attached identity %s (%s on %s) to account %s (%s)",
                     identity.id, identity.identity, identity.source, account.id, account.username)
 
-        identify_cache.clear()
         event.addresponse(True)
 
     @match(r'^delete\s+(?:(my)\s+account|account\s+(.+))$')
@@ -102,7 +111,7 @@ class Accounts(Processor):
 
         event.session.delete(account)
         event.session.commit()
-        identify_cache.clear()
+        forget(account=account.id)
 
         log.info(u"Deleted account %s (%s) by %s/%s (%s)",
                 account.id, account.username, event.account, event.identity, event.sender['connection'])
@@ -134,7 +143,7 @@ class Accounts(Processor):
 
         event.session.add(account)
         event.session.commit()
-        identify_cache.clear()
+        # The cache only holds IDs, which haven't changed
 
         log.info(u"Renamed account %s (%s) to %s by %s/%s (%s)",
                 account.id, oldname, account.username, event.account, event.identity, event.sender['connection'])
@@ -190,11 +199,10 @@ class Identities(Processor):
                     currentidentity.account_id = account.id
                     event.session.add(currentidentity)
 
-                    identify_cache.clear()
-
                     event.addresponse(u"I've created the account %s for you", username)
 
                     event.session.commit()
+                    forget(identity=currentidentity.id)
                     log.info(u"Created account %s (%s) by %s/%s (%s)",
                             account.id, account.username, event.account, event.identity, event.sender['connection'])
                     log.info(u"Attached identity %s (%s on %s) to account %s (%s)",
@@ -253,7 +261,7 @@ class Identities(Processor):
             event.session.add(ident)
             event.session.commit()
 
-            identify_cache.clear()
+            forget(identity=ident.id)
 
             event.addresponse(True)
             log.info(u"Attached identity %s (%s on %s) to account %s (%s) by %s/%s (%s)",
@@ -277,10 +285,10 @@ class Identities(Processor):
                 identity = Identity(source, user)
             identity.account_id = account_id
             event.session.add(identity)
-            identify_cache.clear()
 
             del self.tokens[token]
             event.session.commit()
+            forget(identity=identity.id)
 
             event.addresponse(u'Identity added')
 
@@ -311,7 +319,7 @@ class Identities(Processor):
             event.session.add(identity)
             event.session.commit()
 
-            identify_cache.clear()
+            forget(identity=identity.id)
 
             event.addresponse(True)
             log.info(u"Removed identity %s (%s on %s) from account %s (%s) by %s/%s (%s)",
@@ -451,13 +459,25 @@ class Identify(Processor):
     priority = -1600
     addressed = False
     processed = True
-    event_types = (u'message', u'state', u'action', u'notice', u'invite')
+    event_types = (u'message', u'state', u'action', u'notice', u'invite',
+                   u'source')
+
+    cache_size = IntOption('cache_size',
+            u'Number of users to remember the identities of', 1000)
+
+    def setup(self):
+        super(Identify, self).setup()
+        identify_cache.resize(self.cache_size)
 
     @handler
     def handle(self, event):
         if event.sender:
-            if (event.source, event.sender['connection']) in identify_cache:
-                (event.identity, event.account) = identify_cache[(event.source, event.sender['connection'])]
+            # The identity only depends on the sender's id, so all the
+            # connections of a user share an entry
+            cached = identify_cache.get(
+                    (event.source, event.sender['id'].lower()))
+            if cached is not None:
+                (event.identity, event.account) = cached
                 return
 
             identity = event.session.query(Identity) \
@@ -467,27 +487,82 @@ class Identify(Processor):
                     .first()
             if not identity:
                 identity = Identity(event.source, event.sender['id'])
-                event.session.add(identity)
+                # A savepoint, so that losing the race doesn't roll back
+                # earlier work in this session
+                savepoint = event.session.begin_nested()
                 try:
-                    event.session.commit()
-                    log.info(u'Created identity %s for %s on %s', identity.id, identity.identity, identity.source)
+                    event.session.add(identity)
+                    savepoint.commit()
                 except IntegrityError:
                     event.session.rollback()
-                    event.session.close()
-                    del event['session']
                     log.debug(u'Race encountered creating identity for %s on %s', event.sender['id'], event.source)
                     identity = event.session.query(Identity) \
                             .options(eagerload('account')) \
                             .filter_by(source=event.source,
                                        identity=event.sender['id']) \
                             .one()
+                else:
+                    event.session.commit()
+                    log.info(u'Created identity %s for %s on %s', identity.id, identity.identity, identity.source)
 
             event.identity = identity.id
             if identity.account:
                 event.account = identity.account.id
             else:
                 event.account = None
-            identify_cache[(event.source, event.sender['connection'])] = (event.identity, event.account)
+            identify_cache[(event.source, event.sender['id'].lower())] = (event.identity, event.account)
+
+    @handler
+    def names(self, event):
+        "Identify everyone in a channel listing, all at once"
+        if event.type == u'source' and event.get('status') == u'names':
+            identities = identify_many(event.session, event.source,
+                                       event.names)
+            event.identities = [identity for identity, account
+                                in identities.itervalues()]
+
+def identify_many(session, source, names):
+    """Look up the identities of names on source, in bulk, creating any that
+    don't exist yet. The results are cached for Identify.
+    Returns a dict of lowercased name -> (identity, account).
+    """
+    wanted = dict((name.lower(), name) for name in names)
+    found = {}
+
+    def lookup(names):
+        # Stay well within SQLite's limit on bound parameters
+        for i in xrange(0, len(names), 500):
+            for id, identity, account_id in session.query(
+                    Identity.id, Identity.identity, Identity.account_id) \
+                    .filter(Identity.source == source) \
+                    .filter(Identity.identity.in_(names[i:i + 500])).all():
+                found[identity.lower()] = (id, account_id)
+
+    lookup(wanted.values())
+    missing = [name for key, name in wanted.iteritems() if key not in found]
+    if missing:
+        now = datetime.utcnow()
+        savepoint = session.begin_nested()
+        try:
+            session.execute(Identity.__table__.insert(), [{
+                    'source': source,
+                    'identity': name,
+                    'created': now,
+                } for name in missing])
+            savepoint.commit()
+        except IntegrityError:
+            # Someone else got some of them first, they'll be identified
+            # individually when we next see them
+            session.rollback()
+            log.debug(u'Race encountered creating identities on %s', source)
+        else:
+            session.commit()
+            log.info(u'Created %i identities on %s', len(missing), source)
+        lookup(missing)
+
+    for key, value in found.iteritems():
+        identify_cache[(source, key)] = value
+    return found
 
 def get_identities(event):
     if event.account:
@@ -608,7 +683,7 @@ class Permissions(Processor):
             event.session.add(permission)
 
         event.session.commit()
-        ibid.auth.drop_caches()
+        ibid.auth.drop_caches(account=account.id)
         log.info(u"%s %s permission for account %s (%s) by account %s",
                 actions[action.lower()], name, account.id, account.username, event.account)
 
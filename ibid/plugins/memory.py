@@ -2,7 +2,7 @@
 # Released under terms of the MIT/X/Expat Licence. See COPYING for details.
 
 import csv
-from datetime import datetime, timedelta
+from datetime import datetime
 import gc
 import gzip
 import os
@@ -12,22 +12,19 @@ import objgraph
 import ibid
 from ibid.compat import json
 from ibid.config import Option, IntOption
-from ibid.plugins import Processor, match
+from ibid.plugins import Processor, match, periodic
+from ibid.stats import get_memusage
 
 features = {'memory': {
     'description': u'Debugging module that keeps track of memory usage',
     'categories': ('debug',),
 }}
 
-def get_memusage():
-    status = file('/proc/%i/status' % os.getpid(), 'r').readlines()
-    status = [x.strip().split(':', 1) for x in status if x.startswith('Vm')]
-    return dict((x, int(y.split()[0])) for (x, y) in status)
-
 class MemoryLog(Processor):
 
     features = ('memory',)
     autoload = False
+    event_types = ()
 
     mem_filename = Option('mem_filename', 'Memory log filename', 'logs/memory.log')
     mem_interval = IntOption('mem_interval', 'Interval between memory stat logging', 0)
@@ -35,6 +32,7 @@ class MemoryLog(Processor):
     obj_interval = IntOption('obj_interval', 'Interval between logging object statistics', 0)
 
     def setup(self):
+        super(MemoryLog, self).setup()
         fns = []
         if self.mem_interval:
             fns.append(self.mem_filename)
@@ -60,24 +58,13 @@ class MemoryLog(Processor):
             self.mem_file = file(self.mem_filename, 'w+')
             self.mem_file.write('Ibid Memory Log v2: %s\n' % ibid.config['botname'])
             self.mem_csv = csv.writer(self.mem_file)
-            self.mem_last = datetime.utcnow()
 
         if self.obj_interval:
             self.obj_file = file(self.obj_filename, 'w+')
             self.obj_file.write('Ibid Object Log v1: %s\n' % ibid.config['botname'])
-            self.obj_last = datetime.utcnow()
-
-    def process(self, event):
-        if self.mem_interval and event.time - self.mem_last >= \
-                timedelta(seconds=self.mem_interval):
-            self.mem_log()
-            self.mem_last = event.time
-        if self.obj_interval and event.time - self.obj_last >= \
-                timedelta(seconds=self.obj_interval):
-            self.obj_log()
-            self.obj_last = event.time
-
-    def mem_log(self):
+
+    @periodic(config_key='mem_interval', initial_delay=0)
+    def mem_log(self, event):
         status = get_memusage()
         gc.collect()
 
@@ -89,7 +76,8 @@ class MemoryLog(Processor):
         ))
         self.mem_file.flush()
 
-    def obj_log(self):
+    @periodic(config_key='obj_interval', initial_delay=0)
+    def obj_log(self, event):
         self.obj_file.write('%s %s\n' % (
             datetime.utcnow().isoformat(),
             json.dumps(objgraph.typestats())
@@ -6,7 +6,7 @@ import logging
 
 from ibid.db import IbidUnicode, IbidUnicodeText, Integer, DateTime, \
                     Table, Column, ForeignKey, UniqueConstraint, \
-                    relation, IntegrityError, Base, VersionedSchema
+                    relation, Base, VersionedSchema, write_behind
 from ibid.db.models import Identity, Account
 from ibid.plugins import Processor, match, handler
 from ibid.utils import ago, format_date
@@ -72,29 +72,62 @@ class See(Processor):
 
     @handler
     def see(self, event):
-        sighting = event.session.query(Sighting) \
-                .filter_by(identity_id=event.identity, type=event.type).first()
-        if not sighting:
-            sighting = Sighting(event.identity, event.type)
-
+        update = {'time': event.time, 'count': 1}
         if 'channel' in event:
-            sighting.channel = 'public' in event and event.public and event.channel or None
+            update['channel'] = 'public' in event and event.public and event.channel or None
         if event.type == 'message':
-            sighting.value = event.public and event.message['raw'] or None
+            update['value'] = event.public and event.message['raw'] or None
         elif event.type == 'state':
-            sighting.value = event.state
-        sighting.time = event.time
-        sighting.count = sighting.count + 1
-
-        event.session.add(sighting)
-        try:
-            event.session.commit()
-        except IntegrityError:
-            event.session.rollback()
-            event.session.close()
-            del event['session']
-            log.debug(u'Race encountered updating seen for %s on %s',
-                    event.sender['id'], event.source)
+            update['value'] = event.state
+
+        write_behind.enqueue(write_sightings, (event.identity, event.type),
+                             update, merge_sightings)
+
+def merge_sightings(old, new):
+    merged = dict(old)
+    merged.update(new)
+    merged['count'] = old['count'] + new['count']
+    return merged
+
+def write_sightings(session, updates):
+    "Apply the buffered sighting updates"
+    keys = updates.keys()
+    for i in xrange(0, len(keys), 500):
+        chunk = keys[i:i + 500]
+        sightings = dict(((sighting.identity_id, sighting.type), sighting)
+                for sighting in session.query(Sighting).filter(
+                    Sighting.identity_id.in_(set(identity_id
+                        for identity_id, type in chunk))).all())
+        for key in chunk:
+            sighting = sightings.get(key, None)
+            if sighting is None:
+                sighting = Sighting(*key)
+            apply_sighting(sighting, updates[key])
+            session.add(sighting)
+
+def apply_sighting(sighting, update):
+    for name, value in update.iteritems():
+        if name != 'count':
+            setattr(sighting, name, value)
+    sighting.count = sighting.count + update['count']
+
+def get_sightings(session, identity):
+    """Return identity's sightings, including ones that haven't been written
+    yet. Don't modify them.
+    """
+    sightings = dict((sighting.type, sighting) for sighting in
+            session.query(Sighting).filter_by(identity_id=identity.id).all())
+    for type in (u'message', u'state'):
+        update = write_behind.get(write_sightings, (identity.id, type))
+        if update is not None:
+            sighting = Sighting(identity.id, type)
+            if type in sightings:
+                for name in ('channel', 'value', 'time', 'count'):
+                    setattr(sighting, name, getattr(sightings[type], name))
+            apply_sighting(sighting, update)
+            sighting.identity = identity
+            sightings[type] = sighting
+    return sightings.values()
 
 class Seen(Processor):
     usage = u'seen <who>'
@@ -121,16 +154,11 @@ class Seen(Processor):
         messages = []
         states = []
         if account:
-            for identity in account.identities:
-                for sighting in event.session.query(Sighting) \
-                        .filter_by(identity_id=identity.id).all():
-                    if sighting.type == 'message':
-                        messages.append(sighting)
-                    else:
-                        states.append(sighting)
+            identities = account.identities
         else:
-            for sighting in event.session.query(Sighting) \
-                    .filter_by(identity_id=identity.id).all():
+            identities = [identity]
+        for identity in identities:
+            for sighting in get_sightings(event.session, identity):
                 if sighting.type == 'message':
                     messages.append(sighting)
                 else:
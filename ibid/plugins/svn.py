@@ -430,11 +430,10 @@ class Subversion(Processor, RPC):
     def remote_committed(self, repository, start, end=None):
         commits = self.get_commits(repository, start, end)
         repo = self.repositories[repository]
-        for commit in commits:
-            ibid.dispatcher.send({'reply': commit.strip(),
+        ibid.dispatcher.send_many([{'reply': commit.strip(),
                 'source': repo['source'],
                 'target': repo['channel'],
-            })
+            } for commit in commits])
 
         return True
 
@@ -12,7 +12,8 @@ import ibid
 from ibid.plugins import Processor, handler
 from ibid.config import Option
 from ibid.db import IbidUnicode, IbidUnicodeText, Integer, DateTime, \
-                    Table, Column, ForeignKey, Base, VersionedSchema
+                    Table, Column, ForeignKey, Base, VersionedSchema, \
+                    write_behind
 from ibid.utils import url_regex
 from ibid.utils.html import get_html_parse_tree
 
@@ -51,6 +52,10 @@ class URL(Base):
         self.identity_id = identity_id
         self.time = datetime.utcnow()
 
+def write_urls(session, urls):
+    "Insert the buffered URLs"
+    session.execute(URL.__table__.insert(), urls.values())
+
 class Grab(Processor):
     addressed = False
     processed = True
@@ -75,8 +80,12 @@ class Grab(Processor):
             else:
                 url = 'http://%s' % url
 
-        u = URL(url, event.channel, event.identity)
-        event.session.add(u)
+        write_behind.enqueue(write_urls, None, {
+            'url': url,
+            'channel': event.channel,
+            'identity_id': event.identity,
+            'time': event.time,
+        })
 
         if self.service and self.username:
             self._post_url(event, url)
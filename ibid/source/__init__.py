@@ -58,6 +58,14 @@ class IbidSourceFactory(object):
         "Return a URL describing the source"
         return None
 
+    def send_many(self, responses):
+        """Send responses, in order. Called in the reactor thread, with the
+        responses for this source that were queued since the last call.
+        Override this if a batch can be sent more cheaply than one at a time.
+        """
+        for response in responses:
+            self.send(response)
+
     def logging_name(self, identity):
         "Given an identity or connection, return a name suitable for logging"
         return identity
@@ -12,6 +12,8 @@ from jinja2 import Environment, FileSystemLoader
 import ibid
 from ibid.source import IbidSourceFactory
 from ibid.event import Event
+from ibid import stats
+from ibid.stats import get_memusage
 from ibid.config import Option, IntOption
 from ibid.utils import locate_resource
 
@@ -60,6 +62,37 @@ class Message(resource.Resource):
         request.finish()
         self.log.debug(u"Responded to request from %s: %s", event.sender['connection'], output)
 
+class Metrics(resource.Resource):
+    "Statistics in the Prometheus text exposition format"
+
+    isLeaf = True
+
+    def __init__(self, name, *args, **kwargs):
+        resource.Resource.__init__(self, *args, **kwargs)
+        self.name = name
+        self.log = logging.getLogger('source.%s' % name)
+
+    def gauges(self):
+        gauges = []
+        if ibid.dispatcher is not None:
+            for key, value in ibid.dispatcher.pool_stats().iteritems():
+                gauges.append(('dispatcher_%s' % key,
+                               'Dispatcher thread pool %s' % key, (), value))
+        try:
+            memory = get_memusage()
+        except IOError:
+            pass
+        else:
+            if 'VmRSS' in memory:
+                gauges.append(('resident_memory_bytes',
+                               'Resident set size', (),
+                               memory['VmRSS'] * 1024))
+        return gauges
+
+    def render_GET(self, request):
+        request.setHeader('Content-Type', 'text/plain; version=0.0.4')
+        return stats.prometheus(self.gauges())
+
 class Plugin(resource.Resource):
 
     def __init__(self, name, *args, **kwargs):
@@ -106,6 +139,7 @@ class SourceFactory(IbidSourceFactory):
         root.putChild('static', static.File(locate_resource('ibid', 'static')))
         root.putChild('RPC2', XMLRPC())
         root.putChild('SOAP', SOAP())
+        root.putChild('metrics', Metrics(name))
         self.site = server.Site(root)
 
     def setServiceParent(self, service):
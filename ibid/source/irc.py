@@ -24,6 +24,7 @@ class Ircbot(irc.IRCClient):
 
     _ping_deferred = None
     _reconnect_deferred = None
+    _batch = None
 
     def connectionMade(self):
         self.nickname = self.factory.nick.encode('utf-8')
@@ -39,6 +40,7 @@ class Ircbot(irc.IRCClient):
         self.factory.proto = self
         self.auth_callbacks = {}
         self.mode_prefixes = '@+'
+        self.name_replies = {}
         self._ping_deferred = reactor.callLater(self.factory.ping_interval, self._idle_ping)
         self.factory.log.info(u"Connected")
 
@@ -74,6 +76,9 @@ class Ircbot(irc.IRCClient):
             self._ping_deferred.reset(self.factory.ping_interval)
 
     def sendLine(self, line):
+        if self._batch is not None:
+            self._batch.append(line)
+            return
         irc.IRCClient.sendLine(self, line)
         if self._ping_deferred is not None:
             self._ping_deferred.reset(self.factory.ping_interval)
@@ -187,8 +192,32 @@ class Ircbot(irc.IRCClient):
         ibid.dispatcher.dispatch(event).addCallback(self.respond)
 
     def respond(self, event):
-        for response in event.responses:
-            self.send(response)
+        self.send_many(event.responses)
+
+    def send_many(self, responses):
+        """Send responses, writing all their lines to the transport at once.
+
+        When lineRate is set, lines go through IRCClient's rate-limited queue
+        as usual.
+        """
+        self._batch = []
+        try:
+            for response in responses:
+                self.send(response)
+        finally:
+            lines, self._batch = self._batch, None
+
+        if not lines:
+            return
+        if self.lineRate is not None:
+            for line in lines:
+                self.sendLine(line)
+            return
+
+        self.transport.writeSequence([irc.lowQuote(line) + '\r'
+                                      + self.delimiter for line in lines])
+        if self._ping_deferred is not None:
+            self._ping_deferred.reset(self.factory.ping_interval)
 
     def send(self, response):
         message = response['reply']
@@ -283,12 +312,33 @@ class Ircbot(irc.IRCClient):
                 self.mode_prefixes = option.split(')', 1)[1]
 
     def irc_RPL_NAMREPLY(self, prefix, params):
-        channel = params[2]
+        names = self.name_replies.setdefault(params[2], [])
         for user in params[3].split():
             if user[0] in self.mode_prefixes:
                 user = user[1:]
             if user != self.nickname:
-                self.userJoined(user, channel)
+                names.append(unicode(user, 'utf-8', 'replace'))
+
+    def irc_RPL_ENDOFNAMES(self, prefix, params):
+        # Everyone in the channel is identified by a single event, before
+        # the online state event for each of them
+        channel = unicode(params[1], 'utf-8', 'replace')
+        names = self.name_replies.pop(params[1], [])
+        event = Event(self.factory.name, u'source')
+        event.channel = channel
+        event.status = u'names'
+        event.names = names
+        ibid.dispatcher.dispatch(event) \
+                .addErrback(self._names_failed) \
+                .addCallback(self._names_identified, channel, names)
+
+    def _names_failed(self, fail):
+        self.factory.log.error(u"Couldn't identify channel members:\n%s",
+                               fail.getTraceback())
+
+    def _names_identified(self, result, channel, names):
+        for user in names:
+            self._state_event(user, channel, u'online')
 
     def ctcpQuery_VERSION(self, user, channel, data):
         nick = user.split("!")[0]
@@ -369,6 +419,9 @@ class SourceFactory(protocol.ReconnectingClientFactory, IbidSourceFactory):
     def send(self, response):
         return self.proto.send(response)
 
+    def send_many(self, responses):
+        return self.proto.send_many(responses)
+
     def logging_name(self, identity):
         if identity is None:
             return u''
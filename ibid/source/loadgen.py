@@ -0,0 +1,199 @@
+# Copyright (c) 2011, Stefano Rivera
+# Released under terms of the MIT/X/Expat Licence. See COPYING for details.
+
+import logging
+from random import Random
+from time import time
+
+from twisted.application import internet
+
+import ibid
+from ibid import stats
+from ibid.config import IntOption, FloatOption, DictOption, ListOption
+from ibid.event import Event
+from ibid.source import IbidSourceFactory
+
+stats.descriptions.update({
+    'loadgen_event': 'Generated events, from dispatch until processed',
+    'loadgen_round_trip': 'Generated events, from dispatch until their '
+                          'responses reached the source',
+})
+
+class SourceFactory(IbidSourceFactory):
+    """Generate synthetic traffic, for load testing.
+
+    Events are dispatched in batches every step seconds, from identities
+    user0 ... userN in channels #loadgen0 ... #loadgenN.
+    """
+
+    supports = ('action', 'multiline', 'notice')
+
+    rate = FloatOption('rate', 'Events to generate per second', 10.0)
+    step = FloatOption('step', 'Seconds between batches of events', 0.1)
+    channels = IntOption('channels', 'Number of fake channels', 10)
+    identities = IntOption('identities', 'Number of fake users', 100)
+    mix = DictOption('mix', 'Relative weights of the types of events to '
+                     'generate', {
+        'message': 80, 'addressed': 10, 'private': 2, 'action': 5,
+        'state': 5, 'invite': 0,
+    })
+    messages = ListOption('messages', 'Messages to say', [
+        u'hello everyone', u'what is ibid?', u'ibid is a bot',
+        u'seen user1', u'karma for ibid', u'ibid++', u'time',
+        u'http://www.example.com/',
+    ])
+    max_pending = IntOption('max_pending', 'Skip generating events while '
+                            'this many are being processed', 1000)
+    report = IntOption('report', 'Seconds between log reports', 60)
+    seed = IntOption('seed', 'Random seed, for repeatable load', None)
+
+    def setup(self):
+        self.log = logging.getLogger('source.%s' % self.name)
+        self.random = Random(self.seed)
+        self.nicks = [u'user%i' % i for i in xrange(self.identities)]
+        self.owed = 0.0
+        self.pending = 0
+        self.generated = self.completed = self.responses = self.skipped = 0
+        self.last_report = time()
+
+        self.weights = []
+        total = 0.0
+        for kind, weight in sorted(self.mix.iteritems()):
+            total += float(weight)
+            self.weights.append((total, kind))
+
+    def setServiceParent(self, service):
+        self.s = internet.TimerService(self.step, self.tick)
+        if service is None:
+            self.s.startService()
+        else:
+            self.s.setServiceParent(service)
+
+    def disconnect(self):
+        self.s.stopService()
+        return True
+
+    def tick(self):
+        self.owed += self.rate * self.step
+        while self.owed >= 1:
+            self.owed -= 1
+            if self.pending >= self.max_pending:
+                self.skipped += 1
+                continue
+            for event in self._generate():
+                self.dispatch(event)
+
+        if self.report and time() - self.last_report >= self.report:
+            self.report_stats()
+
+    def dispatch(self, event):
+        self.pending += 1
+        self.generated += 1
+        ibid.dispatcher.dispatch(event).addCallback(self.respond, time()) \
+                .addErrback(self._failed)
+
+    def respond(self, event, start):
+        stats.timer('loadgen_event').observe_since(start)
+        self.pending -= 1
+        self.completed += 1
+        if event.responses:
+            for response in event.responses:
+                self.send(response)
+            stats.timer('loadgen_round_trip').observe_since(start)
+
+    def _failed(self, fail):
+        self.pending -= 1
+        self.log.error(u'Generated event failed: %s', fail.getTraceback())
+
+    def send(self, response):
+        self.responses += 1
+
+    def join(self, channel):
+        return True
+
+    def leave(self, channel):
+        return True
+
+    def report_stats(self):
+        now = time()
+        elapsed = now - self.last_report
+        rtt = stats.timer('loadgen_round_trip')
+        self.log.info(u'Generated %i events (%.1f/s), %i completed, '
+                      u'%i pending, %i skipped, %i responses. '
+                      u'Round trip p50 %.1fms, p99 %.1fms, max %.1fms',
+                      self.generated, self.generated / elapsed,
+                      self.completed, self.pending, self.skipped,
+                      self.responses, rtt.quantile(0.5) * 1000,
+                      rtt.quantile(0.99) * 1000, rtt.max * 1000)
+        self.generated = self.completed = self.responses = self.skipped = 0
+        self.last_report = now
+
+    def _choose_kind(self):
+        point = self.random.random() * self.weights[-1][0]
+        for bound, kind in self.weights:
+            if point < bound:
+                return kind
+        return self.weights[-1][1]
+
+    def _create_event(self, type, index, channel):
+        nick = self.nicks[index]
+        event = Event(self.name, type)
+        event.sender['connection'] = u'%s!%s@loadgen' % (nick, index)
+        event.sender['id'] = nick
+        event.sender['nick'] = nick
+        event.channel = channel
+        event.public = True
+        return event
+
+    def _generate(self):
+        "Return a list of events of a randomly chosen kind"
+        kind = self._choose_kind()
+        index = self.random.randrange(len(self.nicks))
+        channel = u'#loadgen%i' % self.random.randrange(self.channels)
+
+        if kind in ('message', 'addressed', 'private', 'action'):
+            event = self._create_event(kind == 'action' and u'action'
+                                       or u'message', index, channel)
+            event.message = self.random.choice(self.messages)
+            if kind == 'addressed':
+                event.message = u'%s: %s' % (ibid.config['botname'],
+                                             event.message)
+            elif kind == 'private':
+                event.addressed = True
+                event.public = False
+                event.channel = event.sender['connection']
+            return [event]
+
+        if kind == 'invite':
+            event = self._create_event(u'invite', index, None)
+            event.channel = event.sender['connection']
+            event.target_channel = channel
+            event.public = False
+            event.addressed = True
+            return [event]
+
+        action = self.random.choice(('join', 'part', 'quit', 'rename'))
+        if action == 'join':
+            event = self._create_event(u'state', index, channel)
+            event.state = u'online'
+        elif action == 'part':
+            event = self._create_event(u'state', index, channel)
+            event.state = u'offline'
+        elif action == 'quit':
+            event = self._create_event(u'state', index, None)
+            event.state = u'offline'
+            event.message = u'Quit: generated'
+        else:
+            oldnick = self.nicks[index]
+            newnick = oldnick.endswith(u'_') and oldnick[:-1] or oldnick + u'_'
+            event = self._create_event(u'state', index, None)
+            event.state = u'offline'
+            event.othername = newnick
+            self.nicks[index] = newnick
+            renamed = self._create_event(u'state', index, None)
+            renamed.state = u'online'
+            renamed.othername = oldnick
+            return [event, renamed]
+        return [event]
+
+# vi: set et sta sw=4 ts=4:
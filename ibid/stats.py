@@ -0,0 +1,308 @@
+# Copyright (c) 2011, Stefano Rivera
+# Released under terms of the MIT/X/Expat Licence. See COPYING for details.
+
+from bisect import bisect_left
+import os
+from threading import Lock
+from time import time
+
+from twisted.internet import defer
+
+from ibid.compat import json
+
+# Upper bounds of the latency buckets, in seconds.
+# The last bucket collects everything slower than BUCKETS[-1].
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+           1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+class Histogram(object):
+    "Count observations into the fixed BUCKETS"
+
+    __slots__ = ('buckets', 'count', 'total', 'max', 'lock')
+
+    def __init__(self):
+        self.buckets = [0] * (len(BUCKETS) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.lock = Lock()
+
+    def observe(self, seconds):
+        bucket = bisect_left(BUCKETS, seconds)
+        self.lock.acquire()
+        try:
+            self.buckets[bucket] += 1
+            self.count += 1
+            self.total += seconds
+            if seconds > self.max:
+                self.max = seconds
+        finally:
+            self.lock.release()
+
+    def observe_since(self, start):
+        self.observe(time() - start)
+
+    def quantile(self, q):
+        """Return the upper bound of the bucket containing quantile q.
+        Observations beyond the last bucket are reported as the maximum.
+        """
+        target = q * self.count
+        seen = 0
+        for bound, count in zip(BUCKETS, self.buckets):
+            seen += count
+            if count and seen >= target:
+                return bound
+        return self.max
+
+    def mean(self):
+        return self.count and self.total / self.count or 0.0
+
+    def snapshot(self):
+        self.lock.acquire()
+        try:
+            return {
+                'count': self.count,
+                'total': self.total,
+                'max': self.max,
+                'buckets': list(self.buckets),
+            }
+        finally:
+            self.lock.release()
+
+# Keyed on (plugin, processor class, handler name).
+# A handler of None is the processor as a whole.
+histograms = {}
+_histograms_lock = Lock()
+
+def histogram(plugin, processor, handler=None):
+    "Return the Histogram for this handler, creating it if necessary"
+    key = (plugin, processor, handler)
+    result = histograms.get(key)
+    if result is None:
+        _histograms_lock.acquire()
+        try:
+            result = histograms.setdefault(key, Histogram())
+        finally:
+            _histograms_lock.release()
+    return result
+
+def observe_result(hist, start, result):
+    """Record the time since start in hist.
+    If result is a Deferred, the time is recorded when it fires.
+    """
+    if isinstance(result, defer.Deferred):
+        def fired(value):
+            hist.observe_since(start)
+            return value
+        result.addBoth(fired)
+    else:
+        hist.observe_since(start)
+    return result
+
+# Other timings, keyed on name
+timers = {}
+
+def timer(name):
+    "Return the Histogram for the timer name, creating it if necessary"
+    result = timers.get(name)
+    if result is None:
+        _histograms_lock.acquire()
+        try:
+            result = timers.setdefault(name, Histogram())
+        finally:
+            _histograms_lock.release()
+    return result
+
+# Keyed on (name, ((label, value), ...))
+counters = {}
+_counters_lock = Lock()
+
+def increment(name, **labels):
+    "Increment the counter name, for the given labels"
+    key = (name, tuple(sorted(labels.iteritems())))
+    _counters_lock.acquire()
+    try:
+        counters[key] = counters.get(key, 0) + 1
+    finally:
+        _counters_lock.release()
+
+def cache_lookup(cache, hit):
+    "Count a hit or a miss in cache"
+    increment('cache_lookups', cache=cache, result=hit and 'hit' or 'miss')
+    return hit
+
+def reset():
+    _histograms_lock.acquire()
+    try:
+        histograms.clear()
+        timers.clear()
+    finally:
+        _histograms_lock.release()
+    _counters_lock.acquire()
+    try:
+        counters.clear()
+    finally:
+        _counters_lock.release()
+
+def snapshot():
+    """Return a list of dicts describing every Histogram, for machine
+    consumption.
+    """
+    result = []
+    for (plugin, processor, handler), hist in sorted(histograms.items()):
+        entry = hist.snapshot()
+        entry.update({
+            'plugin': plugin,
+            'processor': processor,
+            'handler': handler,
+        })
+        result.append(entry)
+    return result
+
+def dump():
+    "JSON dump of snapshot()"
+    return json.dumps({'buckets': BUCKETS, 'histograms': snapshot()})
+
+def get_memusage():
+    "Return the Vm* lines from /proc/<pid>/status, in kiB"
+    status = file('/proc/%i/status' % os.getpid(), 'r').readlines()
+    status = [x.strip().split(':', 1) for x in status if x.startswith('Vm')]
+    return dict((x, int(y.split()[0])) for (x, y) in status)
+
+def _rss():
+    try:
+        return get_memusage().get('VmRSS', None)
+    except IOError:
+        return None
+
+class StartupProfile(object):
+    """Wall time and resident memory growth of each step of startup.
+    Steps may be nested, in which case the outer step includes the inner.
+    """
+
+    def __init__(self):
+        self.steps = []
+
+    def call(self, kind, name, callable, *args, **kw):
+        "Call callable, recording it as a step"
+        rss = _rss()
+        start = time()
+        try:
+            return callable(*args, **kw)
+        finally:
+            elapsed = time() - start
+            memory = None
+            if rss is not None:
+                memory = _rss() - rss
+            self.steps.append((kind, name, elapsed, memory))
+
+    def report(self):
+        "Return the steps as lines of text, slowest first"
+        lines = ['%-10s %-40s %9s %10s' % ('Step', 'Name', 'Time (ms)',
+                                            'RSS (kiB)')]
+        for kind, name, elapsed, memory in sorted(self.steps,
+                key=lambda step: step[2], reverse=True):
+            lines.append('%-10s %-40s %9.1f %10s' % (kind, name,
+                    elapsed * 1000, memory is None and '?' or '%+i' % memory))
+        return lines
+
+# Set to a StartupProfile by ibid.setup() when requested
+startup = None
+
+def profile_startup(kind, name, callable, *args, **kw):
+    "Call callable, recording it as a step in the startup profile, if any"
+    profile = startup
+    if profile is None:
+        return callable(*args, **kw)
+    return profile.call(kind, name, callable, *args, **kw)
+
+descriptions = {
+    'cache_lookups': 'Cache lookups, by cache and result',
+    'db_commit': 'Database session commit duration',
+    'dropped_events': 'Events dropped by an overloaded dispatcher',
+    'events': 'Events dispatched, by source and type',
+    'factoid_lookups_skipped': 'Factoid lookups answered by the name index',
+    'handler_latency': 'Time spent in each handler',
+    'processor_latency': 'Time spent in each processor',
+    'responses': 'Responses sent, by destination source',
+    'sqlite_regexp': 'Time spent in the SQLite REGEXP function, per query',
+    'stuck_handlers': 'Processors abandoned for overrunning their time budget',
+    'write_behind_flush': 'Write-behind buffer flush duration',
+}
+
+def _labels(labels):
+    if not labels:
+        return ''
+    return '{%s}' % ','.join('%s="%s"' % (name, unicode(value)
+            .replace('\\', '\\\\').replace('"', '\\"')
+            .replace('\n', '\\n').encode('utf-8'))
+        for name, value in labels)
+
+def _histogram_lines(name, labels, hist):
+    snapshot = hist.snapshot()
+    seen = 0
+    for bound, count in zip(BUCKETS + ('+Inf',), snapshot['buckets']):
+        seen += count
+        yield '%s_bucket%s %i' % (name, _labels(labels + (('le', bound),)),
+                                  seen)
+    yield '%s_sum%s %s' % (name, _labels(labels), snapshot['total'])
+    yield '%s_count%s %i' % (name, _labels(labels), snapshot['count'])
+
+def _header(name, kind, description):
+    return ['# HELP %s %s' % (name, description), '# TYPE %s %s' % (name, kind)]
+
+def prometheus(gauges=()):
+    """Render all the statistics in the Prometheus text exposition format.
+    gauges is a sequence of (name, description, labels, value) tuples,
+    where labels is a sequence of (label, value) pairs.
+    """
+    lines = []
+
+    for name, handler in (('processor_latency', False),
+                          ('handler_latency', True)):
+        metric = 'ibid_%s_seconds' % name
+        lines.extend(_header(metric, 'histogram', descriptions[name]))
+        for (plugin, processor, method), hist in sorted(histograms.items()):
+            if (method is not None) != handler:
+                continue
+            labels = (('plugin', plugin), ('processor', processor))
+            if handler:
+                labels += (('handler', method),)
+            lines.extend(_histogram_lines(metric, labels, hist))
+
+    for name, hist in sorted(timers.items()):
+        metric = 'ibid_%s_seconds' % name
+        lines.extend(_header(metric, 'histogram', descriptions.get(name, name)))
+        lines.extend(_histogram_lines(metric, (), hist))
+
+    by_name = {}
+    for (name, labels), value in counters.items():
+        by_name.setdefault(name, []).append((labels, value))
+    for name, values in sorted(by_name.iteritems()):
+        metric = 'ibid_%s_total' % name
+        lines.extend(_header(metric, 'counter', descriptions.get(name, name)))
+        for labels, value in sorted(values):
+            lines.append('%s%s %i' % (metric, _labels(labels), value))
+
+    lookups = {}
+    for labels, value in by_name.get('cache_lookups', ()):
+        labels = dict(labels)
+        hits, total = lookups.get(labels['cache'], (0, 0))
+        if labels['result'] == 'hit':
+            hits += value
+        lookups[labels['cache']] = (hits, total + value)
+    gauges = list(gauges) + [('cache_hit_ratio', 'Cache hits / lookups',
+                              (('cache', cache),), float(hits) / total)
+                             for cache, (hits, total) in lookups.iteritems()]
+
+    seen = set()
+    for name, description, labels, value in sorted(gauges):
+        metric = 'ibid_%s' % name
+        if metric not in seen:
+            lines.extend(_header(metric, 'gauge', description))
+            seen.add(metric)
+        lines.append('%s%s %s' % (metric, _labels(labels), value))
+
+    return '\n'.join(lines) + '\n'
+
+# vi: set et sta sw=4 ts=4:
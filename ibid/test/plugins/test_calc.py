@@ -1,6 +1,7 @@
 # Copyright (c) 2010, Max Rabkin
 # Released under terms of the MIT/X/Expat Licence. See COPYING for details.
 
+import ibid
 from ibid.test import PluginTestCase
 
 class CalcTest(PluginTestCase):
@@ -11,3 +12,12 @@ class CalcTest(PluginTestCase):
 
     def test_too_big(self):
         self.assertResponseMatches(u'100**100**100', '.*big number.*')
+
+    def test_may_handle(self):
+        "Only expressions are sent to worker processes."
+        calc = [processor for processor in ibid.processors
+                if processor.__class__.__name__ == 'Calc'][0]
+        self.assertTrue(calc.may_handle(self.make_event(u'1+1')))
+        self.assertFalse(calc.may_handle(self.make_event(u'hello there')))
+        self.assertFalse(calc.may_handle(
+                self.make_event(u'__import__("os")')))
@@ -2,8 +2,14 @@
 # Copyright (c) 2011, Max Rabkin
 # Released under terms of the MIT/X/Expat Licence. See COPYING for details.
 
+from datetime import datetime
 import re
 
+import ibid
+import ibid.test
+from ibid import core, stats
+from ibid.db.models import Account, Identity
+from ibid.event import Event
 from ibid.test import PluginTestCase
 
 class FactoidTest(PluginTestCase):
@@ -133,3 +139,194 @@ class FactoidTest(PluginTestCase):
         self.assertResponseMatches('. is foo', '.*empty')
         self.failIfResponseMatches('', '.*foo')
         self.failIfResponseMatches('.', '.*foo')
+
+class FactoidIndexTest(ibid.test.TestCase):
+    """The in-memory index of factoid names, without the processors"""
+
+    def setUp(self):
+        super(FactoidIndexTest, self).setUp()
+        ibid.config['databases']['ibid'] = 'sqlite:///' + self.mktemp()
+        self.databases = ibid.databases
+        ibid.databases = core.DatabaseManager(check_schema_versions=False,
+                                              sqlite_synchronous=False)
+        self.session = ibid.databases.ibid()
+
+        from ibid.plugins import factoid
+        self.factoid = factoid
+        for model in (Account, Identity, factoid.Factpack, factoid.Factoid,
+                      factoid.FactoidName, factoid.FactoidValue,
+                      factoid.FactoidNamesVersion):
+            model.__table__.create(bind=self.session.bind)
+
+        self.index = factoid.factoid_index
+        factoid.factoid_index = factoid.FactoidIndex()
+        factoid.factoid_index.check_interval = 0
+
+        self.add_factoid(1, [u'foo'], [u'is foo'])
+        self.add_factoid(2, [u'foo $arg', u'$arg bar'], [u'is $1'])
+        self.session.commit()
+
+    def tearDown(self):
+        self.factoid.factoid_index = self.index
+        self.session.close()
+        ibid.databases.ibid().bind.engine.dispose()
+        ibid.databases = self.databases
+        super(FactoidIndexTest, self).tearDown()
+
+    def add_factoid(self, id, names, values):
+        factoid = self.factoid
+        self.session.execute(factoid.Factoid.__table__.insert().values(
+                id=id, time=datetime.utcnow()))
+        for name in names:
+            self.session.execute(factoid.FactoidName.__table__.insert()
+                .values(_name=factoid.escape_name(name), factoid_id=id,
+                        time=datetime.utcnow(), wild=u'$arg' in name))
+        for value in values:
+            # Inserting through FactoidValue.__table__ upsets later ORM
+            # inserts into factoid_values, on SQLAlchemy 0.6.0
+            self.session.execute(u'INSERT INTO factoid_values '
+                    u'(value, factoid_id, time) '
+                    u'VALUES (:value, :factoid_id, :time)',
+                    {'value': value, 'factoid_id': id,
+                     'time': datetime.utcnow()})
+        factoid.bump_names_version(self.session)
+
+    def get(self, name):
+        result = self.factoid.get_factoid(self.session, name, None, None,
+                                          None)
+        return result and (result[0].id, result[1].name)
+
+    def test_get(self):
+        self.assertEqual(self.get(u'foo'), (1, u'foo'))
+        self.assertEqual(self.get(u'FOO x'), (2, u'foo $arg'))
+        self.assertEqual(self.get(u'x bar'), (2, u'$arg bar'))
+        self.assertEqual(self.get(u'foox'), None)
+        self.assertEqual(self.get(u'bar'), None)
+
+    def test_external_change(self):
+        self.assertEqual(self.get(u'baz x'), None)
+        self.add_factoid(3, [u'baz $arg'], [u'is baz'])
+        self.session.commit()
+        self.assertEqual(self.get(u'baz x'), (3, u'baz $arg'))
+
+    def test_external_change_negative(self):
+        "Names added elsewhere are found before the next periodic check."
+        self.factoid.factoid_index.check_interval = 3600
+        self.assertEqual(self.get(u'baz'), None)
+        self.add_factoid(3, [u'baz', u'baz $arg'], [u'is baz'])
+        self.session.commit()
+        self.assertEqual(self.get(u'baz'), (3, u'baz'))
+        self.assertEqual(self.get(u'baz x'), (3, u'baz $arg'))
+
+    def test_update(self):
+        index = self.factoid.factoid_index
+        self.assertEqual(len(index.wild_matches(self.session, u'foo x')), 1)
+        name = self.session.query(self.factoid.FactoidName) \
+                .filter_by(name=u'foo _%').one()
+        removed = self.factoid.index_entries([name])
+        version = self.factoid.bump_names_version(self.session)
+        self.session.commit()
+        index.update(version, removed=removed)
+        self.assertEqual(index.wild_matches(self.session, u'foo x'), [])
+        self.assertEqual(index.version, version)
+
+    def test_random_value(self):
+        self.add_factoid(3, [u'dice'], [u'is 1', u'is 2', u'is 3'])
+        self.session.commit()
+        seen = set()
+        for i in xrange(50):
+            factoid = self.factoid.get_factoid(self.session, u'dice', None,
+                                               None, None)
+            seen.add(factoid[2].value)
+        self.assertEqual(seen, set([u'is 1', u'is 2', u'is 3']))
+
+    def test_random_value_single_query(self):
+        self.add_factoid(3, [u'dice'], [u'is 1', u'is 2', u'is 3'])
+        self.session.commit()
+        dialect = self.session.bind.engine.dialect
+        statements = []
+        def do_execute(cursor, statement, parameters, context=None):
+            # Ignore the factoid index's version checks
+            if 'factoid_values' in statement:
+                statements.append(statement)
+            return cursor.execute(statement, parameters)
+        dialect.do_execute = do_execute
+        try:
+            factoid = self.factoid.get_factoid(self.session, u'dice', None,
+                                               None, None)
+        finally:
+            del dialect.do_execute
+        self.assertEqual(factoid[1].name, u'dice')
+        self.assertEqual(1, len(statements), statements)
+
+    def search(self, pattern, search_type=None, start=None, fulltext=False):
+        event = Event(u'fakesource', u'message')
+        event.session = self.session
+        processor = self.factoid.Search(u'factoid')
+        processor.fulltext = fulltext
+        processor.search(event, None, search_type, pattern, start)
+        return event.responses[0]['reply']
+
+    def test_search(self):
+        self.add_factoid(3, [u'food'], [u'is edible', u'is good'])
+        self.session.commit()
+        self.assertEqual(self.search(u'foo'),
+                         u'foo [1]; foo $arg [1]; food [2]')
+        self.assertEqual(self.search(u'foo', start=u'3'), u'food [2]')
+        self.assertEqual(self.search(u'foo', start=u'4'),
+                         u"I could only find 3 things that matched 'foo'")
+        self.assertEqual(self.search(u'good', u'values'), u'food [2]')
+        self.assertEqual(self.search(u'/o+d/r'), u'food [2]')
+        self.assertTrue(self.search(u'/o+(/r').startswith(
+                u"Couldn't search. Invalid regex: "))
+
+    def test_search_fulltext(self):
+        for model, column in ((self.factoid.FactoidName, '_name'),
+                              (self.factoid.FactoidValue, 'value')):
+            schema = model.__table__.versioned_schema
+            schema.upgrade_session = self.session
+            self.assertTrue(schema.add_fulltext_index(
+                    model.__table__.c[column]))
+            del schema.upgrade_session
+        self.add_factoid(3, [u'food'], [u'is edible', u'is good'])
+        self.session.commit()
+        self.assertEqual(self.search(u'foo', fulltext=True),
+                         u'foo [1]; foo $arg [1]; food [2]')
+        self.assertEqual(self.search(u'EDIBLE', u'values', fulltext=True),
+                         u'food [2]')
+        # The index only matches the starts of words, the substring search
+        # takes over when it finds nothing
+        self.assertEqual(self.search(u'dible', u'values', fulltext=True),
+                         u'food [2]')
+        self.assertEqual(self.search(u'oo', fulltext=True),
+                         u'foo [1]; foo $arg [1]; food [2]')
+        self.assertEqual(self.search(u'/dible/r', u'values', fulltext=True),
+                         u'food [2]')
+
+        # Word prefix matches only, once any word matches
+        self.add_factoid(4, [u'ooze'], [u'is slime'])
+        self.session.commit()
+        self.assertEqual(self.search(u'oo', fulltext=True), u'ooze [1]')
+        self.assertEqual(self.search(u'oo'),
+                         u'foo [1]; foo $arg [1]; food [2]; ooze [1]')
+
+        self.session.execute(u'DELETE FROM factoid_values WHERE value = :v',
+                             {'v': u'is edible'})
+        self.session.commit()
+        self.assertEqual(self.search(u'edible', fulltext=True),
+                         u"I couldn't find anything that matched 'edible'")
+
+    def test_negative_lookup(self):
+        stats.reset()
+        self.assertEqual(self.get(u'Foo'), (1, u'foo'))
+        self.assertEqual(self.get(u'nothing here'), None)
+        self.assertEqual(stats.counters[('factoid_lookups_skipped', ())], 1)
+
+        index = self.factoid.factoid_index
+        self.assertTrue(index.may_exist(self.session, u'foo _%'))
+        self.assertFalse(index.may_exist(self.session, u'nothing here'))
+        self.add_factoid(3, [u'nothing here'], [u'is something'])
+        self.session.commit()
+        self.assertEqual(self.get(u'nothing here'), (3, u'nothing here'))
+
+# vi: set et sta sw=4 ts=4:
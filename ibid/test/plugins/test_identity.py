@@ -0,0 +1,72 @@
+# Copyright (c) 2011, Stefano Rivera
+# Released under terms of the MIT/X/Expat Licence. See COPYING for details.
+
+import ibid
+import ibid.test
+from ibid import core, stats
+from ibid.db.models import Account, Identity
+from ibid.event import Event
+
+class TestIdentifyMany(ibid.test.TestCase):
+
+    def setUp(self):
+        super(TestIdentifyMany, self).setUp()
+        ibid.config['databases']['ibid'] = 'sqlite:///' + self.mktemp()
+        self.databases = ibid.databases
+        ibid.databases = core.DatabaseManager(check_schema_versions=False,
+                                              sqlite_synchronous=False)
+        self.session = ibid.databases.ibid()
+        for model in (Account, Identity):
+            model.__table__.create(bind=self.session.bind)
+
+        from ibid.plugins import identity
+        self.identity = identity
+        identity.identify_cache.clear()
+        stats.reset()
+
+    def tearDown(self):
+        self.session.close()
+        ibid.databases.ibid().bind.engine.dispose()
+        ibid.databases = self.databases
+        self.identity.identify_cache.clear()
+        stats.reset()
+        super(TestIdentifyMany, self).tearDown()
+
+    def test_create_and_resolve(self):
+        alice = Identity(u'fakesource', u'Alice')
+        self.session.add(alice)
+        self.session.commit()
+
+        found = self.identity.identify_many(self.session, u'fakesource',
+                                            [u'alice', u'bob', u'Carol'])
+        self.assertEqual(sorted(found), [u'alice', u'bob', u'carol'])
+        self.assertEqual(found[u'alice'], (alice.id, None))
+
+        identities = self.session.query(Identity).all()
+        self.assertEqual(sorted(identity.identity for identity in identities),
+                         [u'Alice', u'Carol', u'bob'])
+        for name, value in found.iteritems():
+            self.assertEqual(value, self.identity.identify_cache.get(
+                    (u'fakesource', name)))
+
+    def test_names_event(self):
+        processor = self.identity.Identify(u'identity')
+        event = Event(u'fakesource', u'source')
+        event.status = u'names'
+        event.channel = u'#chan'
+        event.names = [u'alice', u'bob']
+        processor.process(event)
+        self.assertEqual(len(event.identities), 2)
+
+        # A message from them is identified from the cache
+        event = Event(u'fakesource', u'message')
+        event.sender['id'] = u'Bob'
+        event.sender['connection'] = u'Bob!bob@example.com'
+        processor.process(event)
+        bob = self.session.query(Identity).filter_by(identity=u'bob').one()
+        self.assertEqual(event.identity, bob.id)
+        self.assertEqual(event.account, None)
+        self.assertEqual(stats.counters[('cache_lookups',
+                (('cache', 'identity'), ('result', 'hit')))], 1)
+
+# vi: set et sta sw=4 ts=4:
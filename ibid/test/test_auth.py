@@ -0,0 +1,66 @@
+# Copyright (c) 2011, Stefano Rivera
+# Released under terms of the MIT/X/Expat Licence. See COPYING for details.
+
+import ibid
+import ibid.test
+# ibid.auth is the Auth instance
+from ibid.core import auth
+
+class PermissionSource(ibid.test.TestSource):
+    permissions = ['+factoid', '-karma', 'summon']
+
+class TestAuthCaches(ibid.test.TestCase):
+
+    def setUp(self):
+        super(TestAuthCaches, self).setUp()
+        ibid.test.set_config({'auth': {
+            'permissions': ['karma', '+accounts'],
+            'cache_size': 10,
+        }})
+        ibid.sources[u'permsource'] = PermissionSource()
+        auth.build_permission_tables()
+        self.auth = auth.Auth()
+
+    def tearDown(self):
+        del ibid.sources[u'permsource']
+        auth.permission_tables.clear()
+        super(TestAuthCaches, self).tearDown()
+
+    def test_permission_table(self):
+        self.assertEqual(auth.permission_table(u'PermSource'), {
+            'factoid': 'yes',
+            'karma': 'no',
+            'summon': 'auth',
+            'accounts': 'yes',
+        })
+        self.assertEqual(auth.permission(u'factoid', None, u'permsource',
+                                         None), 'yes')
+        self.assertEqual(auth.permission(u'admin', None, u'permsource',
+                                         None), 'no')
+
+    def test_drop_account(self):
+        for account in (1, 2):
+            self.auth.authentication_cache[u'user%i' % account] = account
+            self.auth.authorisation_cache[(u'admin', account,
+                                           u'permsource')] = 'yes'
+        self.auth.drop_caches(account=1)
+        self.assertEqual(self.auth.authentication_cache.keys(), [u'user2'])
+        self.assertEqual(self.auth.authorisation_cache.keys(),
+                         [(u'admin', 2, u'permsource')])
+
+        self.auth.drop_caches()
+        self.assertEqual(len(self.auth.authentication_cache), 0)
+        self.assertEqual(len(self.auth.authorisation_cache), 0)
+
+    def test_lifetimes(self):
+        self.assertEqual(self.auth.authentication_cache.ttl, 300)
+        # Permission checks live until drop_caches()
+        self.assertEqual(self.auth.authorisation_cache.ttl, None)
+
+    def test_bounded(self):
+        for account in xrange(20):
+            self.auth.authorisation_cache[(u'admin', account,
+                                           u'permsource')] = 'yes'
+        self.assertEqual(len(self.auth.authorisation_cache), 10)
+
+# vi: set et sta sw=4 ts=4:
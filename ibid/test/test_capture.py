@@ -0,0 +1,38 @@
+# Copyright (c) 2011, Stefano Rivera
+# Released under terms of the MIT/X/Expat Licence. See COPYING for details.
+
+from datetime import datetime
+
+import ibid.test
+from ibid.capture import EventCapture, read_events
+from ibid.event import Event
+
+class TestCapture(ibid.test.TestCase):
+    def test_round_trip(self):
+        "Captured events are read back with the same keys."
+        filename = self.mktemp()
+        capture = EventCapture(filename)
+        event = Event(u'fakesource', u'message')
+        event.sender = {'id': u'user', 'nick': u'user', 'connection': u'user'}
+        event.channel = u'#chan'
+        event.public = True
+        event.addressed = False
+        event.message = u'hello'
+        event.time = datetime(2011, 1, 1)
+        event.addresponse(u'hi')
+        capture.write(event)
+        capture.close()
+
+        events = list(read_events(filename))
+        self.assertEqual(1, len(events))
+        captured, replayed = events[0]
+        self.assertEqual(u'fakesource', replayed.source)
+        self.assertEqual(u'message', replayed.type)
+        self.assertEqual(u'user', replayed.sender['nick'])
+        self.assertEqual(u'hello', replayed.message)
+        self.assertEqual(True, replayed.public)
+        self.assertEqual(u'2011-01-01T00:00:00', replayed.time)
+        self.assertEqual([], replayed.responses)
+        self.assertFalse(replayed.processed)
+
+# vi: set et sta sw=4 ts=4:
@@ -1,12 +1,21 @@
 # Copyright (c) 2010, Jeremy Thurgood
 # Released under terms of the MIT/X/Expat Licence. See COPYING for details.
 from datetime import datetime, timedelta
+import logging
+import os
+import re
+import sqlite3
+import threading
 
 from twisted.trial import unittest
-from twisted.internet import defer, reactor
+from twisted.internet import defer, reactor, task
 
 import ibid
-from ibid import core, event
+import ibid.test
+from ibid import core, event, offload, stats
+from ibid.db.models import Account, Identity
+from ibid.plugins import Processor, handler, match, periodic
+from ibid.utils import reactor_call
 
 
 def _defer_cb(dfr, *args, **kw):
@@ -24,7 +33,7 @@ class TestProcessor(object):
         self.proc_func = proc_func
 
     def process(self, event):
-        self.proc_func(event)
+        return self.proc_func(event)
 
 
 class TestSource(object):
@@ -38,6 +47,18 @@ class TestSource(object):
         self._msgs.append(response)
 
 
+class TestBatchSource(TestSource):
+    """
+    A source object stub that records batches of responses.
+    """
+    def __init__(self):
+        TestSource.__init__(self)
+        self._batches = []
+
+    def send_many(self, responses):
+        self._batches.append(list(responses))
+
+
 class TestDispatcher(unittest.TestCase):
     """
     Test the Dispatcher class.
@@ -307,6 +328,64 @@ class TestDispatcher(unittest.TestCase):
                                 'conflate': True}], src._msgs)
         return self._dispatch_and_assert(_cb, ev)
 
+    def test_send_batched(self):
+        "Responses sent together reach each source in one batch."
+        src = TestBatchSource()
+        other = TestBatchSource()
+        ibid.sources['testsource'] = src
+        ibid.sources['othersource'] = other
+        def send():
+            self.dispatcher.send_many([
+                {'reply': u'foo', 'source': 'testsource', 'target': None},
+                {'reply': u'bar', 'source': 'othersource', 'target': None},
+                {'reply': u'baz', 'source': 'testsource', 'target': None},
+            ])
+        def _cb(_src, _self):
+            _self.assertEqual([[u'foo', u'baz']],
+                              [[response['reply'] for response in batch]
+                               for batch in _src._batches])
+            _self.assertEqual(1, len(other._batches))
+        return core.defer_to_thread(send).addCallback(
+                lambda result: self._defer_assertions(_cb, src))
+
+    def test_dispatch_deferred_processor(self):
+        "A processor can return a Deferred, and the chain waits for it."
+        ev = self._ev()
+        seen = []
+        def prc(e):
+            dfr = defer.Deferred()
+            dfr.addCallback(lambda result: e.addresponse(u'foo'))
+            reactor_call(reactor.callLater, 0.01, dfr.callback, None)
+            return dfr
+        def after(e):
+            seen.append(list(e.responses))
+        self._add_processor(prc)
+        self._add_processor(after)
+        def _cb(_ev, _self):
+            _self.assertEqual(ev, _ev)
+            _self.assertEqual(1, len(seen))
+            _self.assertEqual(u'foo', seen[0][0]['reply'])
+            _self.assertEqual(True, _ev.processed)
+        return self._dispatch_and_assert(_cb, ev)
+
+    def test_dispatch_deferred_failure(self):
+        "A processor's failing Deferred makes us complain and carry on."
+        ev = self._ev()
+        procs = [0]
+        def prc(e):
+            dfr = defer.Deferred()
+            reactor_call(reactor.callLater, 0.01, dfr.errback,
+                         IOError('tubes clogged'))
+            return dfr
+        def after(e):
+            procs[0] += 1
+        self._add_processor(prc)
+        self._add_processor(after)
+        def _cb(_ev, _self):
+            _self.assertEqual('network', _ev.complain)
+            _self.assertEqual([1], procs)
+        return self._dispatch_and_assert(_cb, ev)
+
     def test_call_later_no_args(self):
         "Calling later calls stuff later."
         ev = self._ev()
@@ -417,4 +496,550 @@ class TestDispatcher(unittest.TestCase):
         self.dispatcher.call_later(0.01, _cl, ev)
         return dfr
 
+
+class TestDispatchIndex(ibid.test.TestCase):
+    """
+    Test that the dispatch index only visits processors that can act on an
+    event.
+    """
+
+    def setUp(self):
+        super(TestDispatchIndex, self).setUp()
+        ibid.processors[:] = []
+        self.calls = []
+
+    def tearDown(self):
+        ibid.processors[:] = []
+        super(TestDispatchIndex, self).tearDown()
+
+    def _processor(self, name, **attrs):
+        "Add a Processor subclass that records its calls."
+        calls = self.calls
+        def record(self, event):
+            calls.append(name)
+        attrs['record'] = handler(record)
+        klass = type(name, (Processor,), attrs)
+        ibid.processors.append(klass(u'testplugin'))
+
+    def _process(self, type=u'message', **attrs):
+        ev = event.Event(u'fakesource', type)
+        for name, value in attrs.iteritems():
+            setattr(ev, name, value)
+        core.process(ev, None)
+        return ev
+
+    def test_event_types(self):
+        "Processors only see their event types."
+        self._processor('Messages', addressed=False)
+        self._processor('States', addressed=False,
+                        event_types=(u'state',))
+        self._process(u'state')
+        self.assertEqual(['States'], self.calls)
+
+    def test_addressed(self):
+        "Addressed processors skip unaddressed events."
+        self._processor('Addressed')
+        self._processor('Unaddressed', addressed=False)
+        self._process(addressed=False)
+        self.assertEqual(['Unaddressed'], self.calls)
+
+    def test_processed_during_chain(self):
+        "An event processed during the chain skips later processors."
+        def mark(self, event):
+            event.processed = True
+        self._processor('First', addressed=False, priority=-10,
+                        mark=handler(mark))
+        self._processor('Second', addressed=False)
+        self._processor('Late', addressed=False, processed=True,
+                        priority=10)
+        self._process()
+        self.assertEqual(['First', 'Late'], self.calls)
+
+    def test_periodic_sees_clock(self):
+        "Processors with periodic handlers are visited for clock events."
+        class Ticker(Processor):
+            @periodic(interval=60)
+            def tick(self, event):
+                pass
+        ibid.processors.append(Ticker(u'testplugin'))
+        self._processor('Messages', addressed=False)
+        ev = self._process(u'clock', time=datetime.utcnow())
+        self.assertEqual([], self.calls)
+        self.assertEqual(ev.time, Ticker.tick.last_called)
+
+    def test_stale_index(self):
+        "The index is rebuilt when ibid.processors changes under it."
+        self._processor('One', addressed=False)
+        self._process()
+        self._processor('Two', addressed=False)
+        self._process()
+        self.assertEqual(['One', 'One', 'Two'], self.calls)
+
+
+class TestOrderedDispatcher(TestDispatcher):
+    """
+    Test the OrderedDispatcher class.
+    """
+
+    def setUp(self):
+        super(TestOrderedDispatcher, self).setUp()
+        self.dispatcher = core.OrderedDispatcher()
+
+    def tearDown(self):
+        self.dispatcher.shutdown()
+        super(TestOrderedDispatcher, self).tearDown()
+
+    def test_no_shutdown_triggers(self):
+        "Dispatchers leave shutting down to shutdown_dispatcher()."
+        triggers = reactor._eventTriggers.get('shutdown')
+        before = triggers and len(triggers.before) or 0
+        dispatcher = core.OrderedDispatcher()
+        dispatcher.shutdown()
+        triggers = reactor._eventTriggers.get('shutdown')
+        self.assertEqual(before, triggers and len(triggers.before) or 0)
+
+    def test_dispatch_channel_order(self):
+        "Events from one channel are processed in order."
+        seen = []
+        def prc(e):
+            seen.append(e.n)
+        self._add_processor(prc)
+        dfrs = []
+        for n in range(20):
+            ev = self._ev()
+            ev.channel = u'#chan'
+            ev.n = n
+            dfrs.append(self.dispatcher.dispatch(ev))
+        def _cb(_result, _self):
+            _self.assertEqual(range(20), seen)
+        return defer.DeferredList(dfrs).addCallback(_cb, self)
+
+    def test_dispatch_deferred_order(self):
+        "A channel's events wait for an earlier event's Deferred."
+        seen = []
+        def wait(e):
+            if e.n == 0:
+                d = defer.Deferred()
+                reactor.callFromThread(reactor.callLater, 0.05,
+                                       d.callback, None)
+                return d
+        def prc(e):
+            seen.append((e.n, threading.currentThread().getName()
+                                      .startswith('ibid-worker-')))
+        self._add_processor(wait)
+        self._add_processor(prc)
+        dfrs = []
+        for n in range(2):
+            ev = self._ev()
+            ev.channel = u'#chan'
+            ev.n = n
+            dfrs.append(self.dispatcher.dispatch(ev))
+        def _cb(_result, _self):
+            _self.assertEqual([(0, True), (1, True)], seen)
+        return defer.DeferredList(dfrs).addCallback(_cb, self)
+
+    def test_dispatch_overflow(self):
+        "Sheddable events are dropped from full queues."
+        self.dispatcher.queue_depth = 0
+        procs = [0]
+        def prc(e):
+            procs[0] += 1
+        self._add_processor(prc)
+        clock = self._ev(type=u'clock')
+        message = self._ev()
+        message.public = False
+        def _cb(_result, _self):
+            _self.assertEqual([1], procs)
+        return defer.DeferredList([self.dispatcher.dispatch(clock),
+                                   self.dispatcher.dispatch(message)]) \
+                .addCallback(_cb, self)
+
+
+class TestScheduler(ibid.test.TestCase):
+    """
+    Test the periodic handler Scheduler.
+    """
+
+    def setUp(self):
+        super(TestScheduler, self).setUp()
+        ibid.processors[:] = []
+        self.dispatcher = ibid.dispatcher
+        ibid.dispatcher = core.Dispatcher()
+        self.scheduler = core.Scheduler()
+
+    def tearDown(self):
+        self.scheduler.stop()
+        ibid.dispatcher = self.dispatcher
+        ibid.processors[:] = []
+        super(TestScheduler, self).tearDown()
+
+    def test_runs_due_handlers(self):
+        "Periodic handlers run at their interval, without clock ticks."
+        calls = []
+        class Poller(Processor):
+            event_types = ()
+            @periodic(interval=0.05, initial_delay=0)
+            def poll(self, event):
+                calls.append(event.time)
+            @periodic(interval=60)
+            def rarely(self, event):
+                calls.append(None)
+        ibid.processors.append(Poller(u'testplugin'))
+        self.scheduler.reschedule()
+
+        dfr = defer.Deferred()
+        reactor.callLater(0.3, dfr.callback, None)
+        def _cb(_result, _self):
+            _self.assertTrue(len(calls) >= 3, calls)
+            _self.assertTrue(None not in calls)
+        return dfr.addCallback(_cb, self)
+
+    def test_clock_per_processor(self):
+        "Each processor's due handlers get their own clock event."
+        events = []
+        ibid.dispatcher.dispatch = lambda event: \
+                events.append(event) or defer.succeed(event)
+        calls = []
+        class Poller(Processor):
+            event_types = ()
+            @periodic(interval=60)
+            def poll(self, event):
+                calls.append(self)
+        class OtherPoller(Poller):
+            @periodic(interval=60)
+            def poll(self, event):
+                calls.append(self)
+        pollers = [Poller(u'testplugin'), OtherPoller(u'testplugin')]
+        ibid.processors.extend(pollers)
+        self.scheduler.reschedule()
+        # Make them due now
+        for method in (Poller.poll, OtherPoller.poll):
+            method.im_func.last_called -= timedelta(seconds=60)
+        self.scheduler.heap = [(datetime.utcnow(),) + entry[1:]
+                               for entry in self.scheduler.heap]
+        self.scheduler.call.cancel()
+        self.scheduler._fire()
+        self.assertEqual(set(pollers),
+                         set(event.periodic_for for event in events))
+        for ev in events:
+            core.process(ev, logging.getLogger('core.test'))
+        self.assertEqual([event.periodic_for for event in events], calls)
+
+    def test_disabled(self):
+        "Disabled handlers aren't scheduled."
+        class Poller(Processor):
+            event_types = ()
+            @periodic(interval=0.05, initial_delay=0)
+            def poll(self, event):
+                pass
+        Poller.poll.im_func.disabled = True
+        ibid.processors.append(Poller(u'testplugin'))
+        self.scheduler.reschedule()
+        self.assertEqual([], self.scheduler.heap)
+        self.assertEqual(None, self.scheduler.call)
+
+
+class TestUnitOfWork(ibid.test.TestCase):
+    """
+    Test committing once per event.
+    """
+
+    def setUp(self):
+        super(TestUnitOfWork, self).setUp()
+        ibid.processors[:] = []
+        ibid.config['dispatcher'] = {'commit': 'event'}
+        self.dbfile = self.mktemp()
+        ibid.config['databases']['ibid'] = 'sqlite:///' + self.dbfile
+        self.databases = ibid.databases
+        ibid.databases = core.DatabaseManager(check_schema_versions=False,
+                                              sqlite_synchronous=False)
+        for model in (Account, Identity):
+            model.__table__.create(bind=ibid.databases.ibid().bind)
+        stats.reset()
+
+    def tearDown(self):
+        ibid.databases.ibid().bind.engine.dispose()
+        ibid.databases = self.databases
+        ibid.processors[:] = []
+        stats.reset()
+        super(TestUnitOfWork, self).tearDown()
+
+    def _add_identity(self, name):
+        def add(event):
+            identity = Identity(u'fakesource', name)
+            event.session.add(identity)
+            event.session.commit()
+            # Flushed, so we have a primary key
+            self.assertNotEqual(None, identity.id)
+        ibid.processors.append(TestProcessor(add))
+
+    def _identities(self):
+        "Look at the committed identities, through a separate connection"
+        connection = sqlite3.connect(self.dbfile)
+        try:
+            return sorted(row[0] for row in
+                          connection.execute('SELECT identity FROM identities'))
+        finally:
+            connection.close()
+
+    def test_single_commit(self):
+        "Processors' commits are deferred to the end of the event."
+        self._add_identity(u'alice')
+        committed = []
+        ibid.processors.append(TestProcessor(
+                lambda event: committed.extend(self._identities())))
+        self._add_identity(u'bob')
+        ev = event.Event(u'fakesource', u'message')
+        core.process(ev, logging.getLogger('core.test'))
+        self.assertFalse('complain' in ev)
+        self.assertEqual([], committed)
+        self.assertEqual([u'alice', u'bob'], self._identities())
+        self.assertEqual(1, stats.timer('db_commit').count)
+
+    def test_failure(self):
+        "A failing processor doesn't leave the session deferring commits."
+        self._add_identity(u'alice')
+        def fail(event):
+            raise Exception('failed')
+        ibid.processors.append(TestProcessor(fail))
+        ev = event.Event(u'fakesource', u'message')
+        core.process(ev, logging.getLogger('core.test'))
+        self.assertEqual(u'exception', ev.complain)
+        self.assertFalse(ibid.databases.ibid().deferring_commits)
+
+    def test_reads_dont_lock(self):
+        "A session that has only read doesn't block other writers."
+        session = ibid.databases.ibid()
+        try:
+            self.assertEqual([], session.query(Identity).all())
+            connection = sqlite3.connect(self.dbfile, timeout=0)
+            try:
+                connection.execute("INSERT INTO identities (source, identity, "
+                                   "created) VALUES ('fakesource', 'alice', "
+                                   "'2011-01-01 00:00:00')")
+                connection.commit()
+            finally:
+                connection.close()
+        finally:
+            session.close()
+        self.assertEqual([u'alice'], self._identities())
+
+    def test_failure_isolated(self):
+        "A failing processor only loses its own changes."
+        self._add_identity(u'alice')
+        def fail(event):
+            event.session.add(Identity(u'fakesource', u'bob'))
+            event.session.flush()
+            raise Exception('failed')
+        ibid.processors.append(TestProcessor(fail))
+        self._add_identity(u'carol')
+        ev = event.Event(u'fakesource', u'message')
+        core.process(ev, logging.getLogger('core.test'))
+        self.assertEqual(u'exception', ev.complain)
+        self.assertEqual([u'alice', u'carol'], self._identities())
+
+
+class Squarer(Processor):
+    "Offloaded processor for TestOffload"
+    addressed = False
+    offload = True
+
+    @handler
+    def square(self, event):
+        event.addresponse(unicode(int(event.message) ** 2))
+        event.pid = os.getpid()
+        del event['scratch']
+
+
+class Picky(Processor):
+    "Offloaded processor for TestOffload"
+    addressed = False
+    offload = True
+
+    @match(r'^square\s+(\d+)$')
+    def square(self, event, number):
+        event.addresponse(unicode(int(number) ** 2))
+        event.pid = os.getpid()
+
+
+class Crasher(Processor):
+    "Offloaded processor for TestOffload"
+    addressed = False
+    offload = True
+
+    @handler
+    def crash(self, event):
+        raise Exception('crashed')
+
+
+class TestOffload(ibid.test.TestCase):
+    """
+    Test running processors in worker processes.
+    """
+
+    def setUp(self):
+        super(TestOffload, self).setUp()
+        ibid.processors[:] = []
+        self.dispatcher = ibid.dispatcher
+        ibid.dispatcher = core.Dispatcher()
+        ibid.dispatcher.processes = offload.ProcessPool(1, 30)
+
+    def tearDown(self):
+        ibid.dispatcher.processes.stop()
+        ibid.dispatcher = self.dispatcher
+        ibid.processors[:] = []
+        super(TestOffload, self).tearDown()
+
+    def _process(self):
+        ev = event.Event(u'fakesource', u'message')
+        ev.message = u'12'
+        ev.scratch = True
+        core.process(ev, logging.getLogger('core.test'))
+        return ev
+
+    def test_changes(self):
+        "Responses and changed attributes come back from the worker."
+        ibid.processors.append(Squarer(u'testplugin'))
+        ev = self._process()
+        self.assertEqual([u'144'],
+                         [response['reply'] for response in ev.responses])
+        self.assertNotEqual(os.getpid(), ev.pid)
+        self.assertFalse('scratch' in ev)
+
+    def test_prefilter(self):
+        "Events no handler could match stay in the parent."
+        ibid.processors.append(Picky(u'testplugin'))
+        offloaded = []
+        ibid.dispatcher.processes.process = \
+                lambda processor, event: offloaded.append(event)
+        ev = self._process()
+        self.assertEqual([], offloaded)
+        self.assertEqual([], ev.responses)
+
+    def test_failure(self):
+        "Exceptions in the worker are reported as processor failures."
+        ibid.processors.append(Crasher(u'testplugin'))
+        ibid.processors.append(TestProcessor(
+                lambda event: event.addresponse(u'after')))
+        ev = self._process()
+        self.assertEqual(u'exception', ev.complain)
+        self.assertEqual([u'after'],
+                         [response['reply'] for response in ev.responses])
+
+class Sleeper(Processor):
+    "Processor that overruns its time budget, for TestWatchdog"
+    addressed = False
+    time_budget = 0.1
+
+    @handler
+    def sleep(self, event):
+        self.wake.wait(30)
+        event.addresponse(u'too late')
+
+
+class TestWatchdog(ibid.test.TestCase):
+    """
+    Test abandoning processors that overrun their time budget.
+    """
+
+    def setUp(self):
+        super(TestWatchdog, self).setUp()
+        ibid.processors[:] = []
+        self.dispatcher = ibid.dispatcher
+        ibid.dispatcher = core.Dispatcher()
+        self.interval = core._watchdog.interval
+        core._watchdog.interval = 0.05
+        self.wake = threading.Event()
+
+    def tearDown(self):
+        self.wake.set()
+        core._watchdog.interval = self.interval
+        ibid.dispatcher = self.dispatcher
+        ibid.processors[:] = []
+        super(TestWatchdog, self).tearDown()
+
+    def test_abandon(self):
+        "The rest of the chain runs without an overrunning processor."
+        sleeper = Sleeper(u'testplugin')
+        sleeper.wake = self.wake
+        ibid.processors.append(sleeper)
+        ibid.processors.append(TestProcessor(
+                lambda event: event.addresponse(u'after', processed=False)))
+        ev = event.Event(u'fakesource', u'message')
+        ev.message = u'zzz'
+        def check(ev):
+            self.assertEqual(u'exception', ev.complain)
+            self.assertEqual([u'after'],
+                             [response['reply'] for response in ev.responses])
+            self.assertTrue(stats.counters.get(('stuck_handlers', (
+                    ('plugin', u'testplugin'), ('processor', 'Sleeper')))))
+        return ibid.dispatcher.dispatch(ev).addCallback(check)
+
+    def test_orphan(self):
+        "The abandoned processor is left with the original event."
+        sleeper = Sleeper(u'testplugin')
+        sleeper.wake = self.wake
+        ibid.processors.append(sleeper)
+        ev = event.Event(u'fakesource', u'message')
+        ev.message = u'zzz'
+        def woken(result, taken):
+            self.assertEqual([u'too late'],
+                             [response['reply'] for response in ev.responses])
+            self.assertEqual([], taken.responses)
+        def check(taken):
+            self.assertFalse(taken is ev)
+            self.wake.set()
+            return task.deferLater(reactor, 0.2, lambda: None) \
+                    .addCallback(woken, taken)
+        return ibid.dispatcher.dispatch(ev).addCallback(check)
+
+class TestRegexp(ibid.test.TestCase):
+
+    def setUp(self):
+        super(TestRegexp, self).setUp()
+        ibid.config['databases']['ibid'] = 'sqlite:///' + self.mktemp()
+        self.databases = ibid.databases
+        ibid.databases = core.DatabaseManager(check_schema_versions=False,
+                                              sqlite_synchronous=False)
+        stats.reset()
+
+    def tearDown(self):
+        ibid.databases.ibid().bind.engine.dispose()
+        ibid.databases = self.databases
+        stats.reset()
+        super(TestRegexp, self).tearDown()
+
+    def test_required_literal(self):
+        self.assertEqual(core.required_literal(u'^Foo.*bar'), u'foo')
+        self.assertEqual(core.required_literal(u'a(bcd)+e?'), u'bcd')
+        self.assertEqual(core.required_literal(u'foo|barbaz'), None)
+        self.assertEqual(core.required_literal(u'x*y?'), None)
+
+    def test_function(self):
+        function = core.RegexpFunction(cache_size=2)
+        self.assertTrue(function(u'fo+ BAR', u'a foooo bar'))
+        self.assertFalse(function(u'fo+ BAR', u'a foooo baz'))
+        self.assertFalse(function(u'fo+ BAR', None))
+        self.assertEqual(function.literal, u' bar')
+        self.assertTrue(function(u'[a-z]', u'X'))
+        self.assertEqual(function.patterns.keys(), [u'[a-z]', u'fo+ BAR'])
+        self.assertRaises(re.error, function, u'(', u'x')
+
+        function.flush()
+        self.assertEqual(function.rows, 0)
+        self.assertEqual(stats.timer('sqlite_regexp').count, 1)
+
+    def test_query(self):
+        session = ibid.databases.ibid()
+        session.execute('CREATE TABLE words (word TEXT)')
+        for word in (u'apple', u'banana', u'cherry'):
+            session.execute('INSERT INTO words VALUES (:word)',
+                            {'word': word})
+        result = session.execute(
+                "SELECT word FROM words WHERE word REGEXP 'AN+A'").fetchall()
+        self.assertEqual(result, [(u'banana',)])
+        session.commit()
+        session.close()
+        self.assertEqual(stats.timer('sqlite_regexp').count, 1)
+
 # vi: set et sta sw=4 ts=4:
@@ -0,0 +1,168 @@
+# Copyright (c) 2011, Stefano Rivera
+# Released under terms of the MIT/X/Expat Licence. See COPYING for details.
+
+from sqlalchemy.exc import IntegrityError
+from twisted.internet import defer, reactor
+
+import ibid
+import ibid.test
+from ibid.core import DatabaseManager
+from ibid.db.writebehind import WriteBehind
+
+def add(old, new):
+    return old + new
+
+class TestWriteBehind(ibid.test.TestCase):
+    def setUp(self):
+        super(TestWriteBehind, self).setUp()
+        ibid.config['databases']['ibid'] = 'sqlite:///' + self.mktemp()
+        ibid.config['write_behind'] = {'interval': 0.05, 'batch_size': 3}
+        self.databases = ibid.databases
+        ibid.databases = DatabaseManager(check_schema_versions=False,
+                                         sqlite_synchronous=False)
+        self.buffer = WriteBehind()
+        self.written = []
+
+    def tearDown(self):
+        if self.buffer.trigger is not None:
+            reactor.removeSystemEventTrigger(self.buffer.trigger)
+        if self.buffer.call is not None and self.buffer.call.active():
+            self.buffer.call.cancel()
+        ibid.databases.ibid().bind.engine.dispose()
+        ibid.databases = self.databases
+        super(TestWriteBehind, self).tearDown()
+
+    def write(self, session, items):
+        self.written.append(items)
+
+    def _later(self, check):
+        "Run check once the buffer has had a chance to flush"
+        dfr = defer.Deferred()
+        reactor.callLater(0.3, dfr.callback, None)
+        return dfr.addCallback(lambda result: check())
+
+    def test_merge(self):
+        "Writes to the same key are merged before they are written."
+        self.buffer.enqueue(self.write, u'a', 1, add)
+        self.buffer.enqueue(self.write, u'a', 2, add)
+        self.buffer.enqueue(self.write, u'b', 1, add)
+        self.assertEqual(3, self.buffer.get(self.write, u'a'))
+        def check():
+            self.assertEqual([{u'a': 3, u'b': 1}], self.written)
+            self.assertEqual(None, self.buffer.get(self.write, u'a'))
+        return self._later(check)
+
+    def test_unkeyed(self):
+        "Writes without a key are never merged."
+        self.buffer.enqueue(self.write, None, 1)
+        self.buffer.enqueue(self.write, None, 1)
+        def check():
+            self.assertEqual([[1, 1]],
+                             [items.values() for items in self.written])
+        return self._later(check)
+
+    def test_interval(self):
+        "Pending writes are flushed after the interval."
+        self.buffer.enqueue(self.write, u'a', 1, add)
+        def check():
+            self.assertEqual([{u'a': 1}], self.written)
+        return self._later(check)
+
+    def test_batch_size(self):
+        "A full batch is flushed straight away."
+        ibid.config['write_behind']['interval'] = 60
+        for key in (u'a', u'b', u'c'):
+            self.buffer.enqueue(self.write, key, 1, add)
+        def check():
+            self.assertEqual([{u'a': 1, u'b': 1, u'c': 1}], self.written)
+        return self._later(check)
+
+    def test_conflict(self):
+        "A conflicting write doesn't lose the rest of the batch."
+        def write(session, items):
+            if u'bad' in items:
+                raise IntegrityError('INSERT', {}, Exception('conflict'))
+            self.written.append(items)
+        for key in (u'a', u'bad', u'b'):
+            self.buffer.enqueue(write, key, 1, add)
+        def check():
+            self.assertEqual([{u'a': 1}, {u'b': 1}],
+                             sorted(self.written))
+        return self._later(check)
+
+    def test_batch_flushed_once(self):
+        "Writes after a full batch don't ask for more flushes."
+        ibid.config['write_behind']['interval'] = 60
+        flushes = []
+        flush_now = self.buffer._flush_now
+        def counting_flush_now():
+            flushes.append(True)
+            flush_now()
+        self.buffer._flush_now = counting_flush_now
+        for key in (u'a', u'b', u'c', u'd', u'e'):
+            self.buffer.enqueue(self.write, key, 1, add)
+        def check():
+            self.assertEqual(1, len(flushes))
+            self.assertEqual([{u'a': 1, u'b': 1, u'c': 1, u'd': 1, u'e': 1}],
+                             self.written)
+        return self._later(check)
+
+class TestAfterCommit(ibid.test.TestCase):
+    def setUp(self):
+        super(TestAfterCommit, self).setUp()
+        ibid.config['databases']['ibid'] = 'sqlite:///' + self.mktemp()
+        self.databases = ibid.databases
+        ibid.databases = DatabaseManager(check_schema_versions=False,
+                                         sqlite_synchronous=False)
+        self.session = ibid.databases.ibid()
+        self.called = []
+
+    def tearDown(self):
+        self.session.close()
+        ibid.databases.ibid().bind.engine.dispose()
+        ibid.databases = self.databases
+        super(TestAfterCommit, self).tearDown()
+
+    def callback(self, name):
+        self.session.after_commit(self.called.append, name)
+
+    def test_commit(self):
+        "Callbacks run when the transaction is committed."
+        self.callback(u'a')
+        self.assertEqual([], self.called)
+        self.session.commit()
+        self.assertEqual([u'a'], self.called)
+        self.session.commit()
+        self.assertEqual([u'a'], self.called)
+
+    def test_deferred(self):
+        "Commits that only flush don't run callbacks."
+        self.session.deferring_commits = True
+        self.callback(u'a')
+        self.session.commit()
+        self.assertEqual([], self.called)
+        self.session.deferring_commits = False
+        self.session.commit()
+        self.assertEqual([u'a'], self.called)
+
+    def test_rollback(self):
+        "Callbacks are dropped when the transaction is rolled back."
+        self.callback(u'a')
+        self.session.rollback()
+        self.session.commit()
+        self.assertEqual([], self.called)
+
+    def test_savepoints(self):
+        "Callbacks follow their savepoint's fate."
+        self.callback(u'a')
+        savepoint = self.session.begin_nested()
+        self.callback(u'b')
+        savepoint.rollback()
+        savepoint = self.session.begin_nested()
+        self.callback(u'c')
+        savepoint.commit()
+        self.assertEqual([], self.called)
+        self.session.commit()
+        self.assertEqual([u'a', u'c'], self.called)
+
+# vi: set et sta sw=4 ts=4:
@@ -0,0 +1,110 @@
+# Copyright (c) 2011, Stefano Rivera
+# Released under terms of the MIT/X/Expat Licence. See COPYING for details.
+
+import logging
+
+from twisted.internet import defer
+from twisted.words.protocols import irc
+
+import ibid
+import ibid.test
+
+class RecordingDispatcher(object):
+    def __init__(self):
+        self.events = []
+
+    def dispatch(self, event):
+        self.events.append(event)
+        return defer.succeed(event)
+
+class FakeFactory(object):
+    name = u'fakeirc'
+    log = logging.getLogger('source.fakeirc')
+    ping_interval = 60
+
+class RecordingTransport(object):
+    def __init__(self):
+        self.writes = []
+
+    def write(self, data):
+        self.writes.append([data])
+
+    def writeSequence(self, data):
+        self.writes.append(list(data))
+
+class TestNames(ibid.test.TestCase):
+
+    def setUp(self):
+        super(TestNames, self).setUp()
+        # Needs ibid.config
+        from ibid.source.irc import Ircbot
+        self.dispatcher = ibid.dispatcher
+        ibid.dispatcher = RecordingDispatcher()
+        self.bot = Ircbot()
+        self.bot.factory = FakeFactory()
+        self.bot.nickname = 'ibid'
+        self.bot.mode_prefixes = '@+'
+        self.bot.name_replies = {}
+        self.bot.respond = lambda event: None
+
+    def tearDown(self):
+        ibid.dispatcher = self.dispatcher
+        super(TestNames, self).tearDown()
+
+    def test_names(self):
+        "Members are identified in bulk, then announced as online."
+        self.bot.irc_RPL_NAMREPLY('server', ['ibid', '=', '#chan',
+                                             '@alice +bob ibid'])
+        self.bot.irc_RPL_NAMREPLY('server', ['ibid', '=', '#chan', 'carol'])
+        self.bot.irc_RPL_ENDOFNAMES('server', ['ibid', '#chan',
+                                               'End of /NAMES list.'])
+
+        events = ibid.dispatcher.events
+        self.assertEqual(u'names', events[0].status)
+        self.assertEqual([u'alice', u'bob', u'carol'], events[0].names)
+        self.assertEqual([(u'state', u'online', u'alice', u'#chan'),
+                          (u'state', u'online', u'bob', u'#chan'),
+                          (u'state', u'online', u'carol', u'#chan')],
+                         [(event.type, event.state, event.sender['id'],
+                           event.channel) for event in events[1:]])
+
+class TestSend(ibid.test.TestCase):
+
+    def setUp(self):
+        super(TestSend, self).setUp()
+        from ibid.source.irc import Ircbot
+        self.bot = Ircbot()
+        self.bot.factory = FakeFactory()
+        self.bot.transport = RecordingTransport()
+        # Normally set up by IRCClient.connectionMade
+        self.bot.supported = irc.ServerSupportedFeatures()
+        self.bot._queue = []
+
+    def test_send_many(self):
+        "A batch of responses is written to the transport in one call."
+        self.bot.send_many([
+            {'target': u'#chan', 'reply': u'hello'},
+            {'target': u'alice!a@example.com', 'reply': u'caf\xe9'},
+            {'target': u'#chan', 'reply': u'waves', 'action': True},
+        ])
+        self.assertEqual([['PRIVMSG #chan :hello\r\n',
+                           'PRIVMSG alice :caf\xc3\xa9\r\n',
+                           'PRIVMSG #chan :\x01ACTION waves\x01\r\n']],
+                         self.bot.transport.writes)
+
+    def test_send_many_empty(self):
+        "An empty batch writes nothing."
+        self.bot.send_many([])
+        self.assertEqual([], self.bot.transport.writes)
+
+    def test_send_many_rate(self):
+        "With lineRate set, lines go through IRCClient's queue."
+        self.bot.lineRate = 1
+        self.bot.send_many([{'target': u'#chan', 'reply': u'one'},
+                            {'target': u'#chan', 'reply': u'two'}])
+        self.assertEqual([['PRIVMSG #chan :one\r\n']],
+                         self.bot.transport.writes)
+        self.assertEqual(['PRIVMSG #chan :two'], self.bot._queue)
+        self.bot._queueEmptying.cancel()
+
+# vi: set et sta sw=4 ts=4:
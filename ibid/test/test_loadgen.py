@@ -0,0 +1,145 @@
+# Copyright (c) 2011, Stefano Rivera
+# Released under terms of the MIT/X/Expat Licence. See COPYING for details.
+
+from twisted.internet import defer
+
+import ibid
+import ibid.test
+from ibid import stats
+
+class RecordingDispatcher(object):
+    "Records events, and answers them with respond(event), if set"
+
+    def __init__(self):
+        self.events = []
+        self.respond = None
+        self.pending = None
+
+    def dispatch(self, event):
+        self.events.append(event)
+        if self.pending is not None:
+            deferred = defer.Deferred()
+            self.pending.append((deferred, event))
+            return deferred
+        if self.respond is not None:
+            self.respond(event)
+        return defer.succeed(event)
+
+class TestLoadGenerator(ibid.test.TestCase):
+
+    def setUp(self):
+        super(TestLoadGenerator, self).setUp()
+        self.dispatcher = ibid.dispatcher
+        ibid.dispatcher = RecordingDispatcher()
+        stats.reset()
+
+    def tearDown(self):
+        ibid.dispatcher = self.dispatcher
+        stats.reset()
+        super(TestLoadGenerator, self).tearDown()
+
+    def _source(self, **options):
+        from ibid.source.loadgen import SourceFactory
+        source = SourceFactory(u'loadgen')
+        options.setdefault('report', 0)
+        options.setdefault('seed', 42)
+        for name, value in options.iteritems():
+            setattr(source, name, value)
+        source.setup()
+        return source
+
+    def test_pacing(self):
+        "Events are generated at rate, carrying fractions between ticks."
+        source = self._source(rate=25.0, step=0.1, mix={'message': 1})
+        source.tick()
+        self.assertEqual(2, len(ibid.dispatcher.events))
+        for i in xrange(3):
+            source.tick()
+        self.assertEqual(10, len(ibid.dispatcher.events))
+        self.assertEqual(0, source.pending)
+        self.assertEqual(10, source.completed)
+
+    def test_max_pending(self):
+        "Events are skipped while too many are being processed."
+        ibid.dispatcher.pending = []
+        source = self._source(rate=100.0, step=0.1, max_pending=3,
+                              mix={'message': 1})
+        source.tick()
+        self.assertEqual(3, len(ibid.dispatcher.events))
+        self.assertEqual(3, source.pending)
+        self.assertEqual(7, source.skipped)
+
+        for deferred, event in ibid.dispatcher.pending:
+            deferred.callback(event)
+        self.assertEqual(0, source.pending)
+        self.assertEqual(3, source.completed)
+
+    def test_responses(self):
+        "Responses to generated events are counted and timed."
+        ibid.dispatcher.respond = lambda event: event.addresponse(u'hi')
+        source = self._source(rate=10.0, step=0.1, mix={'addressed': 1})
+        source.tick()
+        self.assertEqual(1, source.responses)
+        self.assertEqual(1, stats.timer('loadgen_round_trip').count)
+        self.assertEqual(1, stats.timer('loadgen_event').count)
+
+    def test_messages(self):
+        "Generated messages come from fake users in fake channels."
+        source = self._source(identities=5, channels=3, messages=[u'hi'],
+                              mix={'message': 1, 'addressed': 1,
+                                   'private': 1, 'action': 1})
+        for i in xrange(50):
+            for event in source._generate():
+                self.assertEqual(u'loadgen', event.source)
+                self.assertTrue(event.sender['nick'] in
+                                [u'user%i' % n for n in xrange(5)])
+                if event.public:
+                    self.assertTrue(event.channel in
+                                    (u'#loadgen0', u'#loadgen1', u'#loadgen2'))
+                    self.assertTrue(event.message in
+                                    (u'hi', u'%s: hi' % ibid.config['botname']))
+                else:
+                    self.assertTrue(event.addressed)
+                    self.assertEqual(event.sender['connection'],
+                                     event.channel)
+                    self.assertEqual(u'hi', event.message)
+                self.assertTrue(event.type in (u'message', u'action'))
+
+    def test_rename(self):
+        "Renames go offline and online, and change the nick for later events."
+        source = self._source(identities=1, mix={'state': 1})
+        renamed = False
+        for i in xrange(50):
+            events = source._generate()
+            self.assertTrue(all(event.type == u'state' for event in events))
+            if len(events) == 2:
+                offline, online = events
+                self.assertEqual((u'offline', u'online'),
+                                 (offline.state, online.state))
+                self.assertEqual(offline.othername, online.sender['nick'])
+                self.assertEqual(online.othername, offline.sender['nick'])
+                self.assertEqual(source.nicks[0], online.sender['nick'])
+                renamed = True
+        self.assertTrue(renamed)
+
+    def test_repeatable(self):
+        "The same seed generates the same events."
+        kinds = []
+        for i in xrange(2):
+            source = self._source(seed=7)
+            kinds.append([(event.type, event.sender['nick'],
+                           event.get('message'))
+                          for j in xrange(20)
+                          for event in source._generate()])
+        self.assertEqual(kinds[0], kinds[1])
+
+    def test_stop(self):
+        "The timer starts generating straight away, and stops cleanly."
+        source = self._source(rate=10.0, step=60.0, mix={'message': 1})
+        source.setServiceParent(None)
+        self.assertTrue(source.s.running)
+        self.assertEqual(600, len(ibid.dispatcher.events))
+        self.assertTrue(source.disconnect())
+        self.assertFalse(source.s.running)
+
+# vi: set et sta sw=4 ts=4:
@@ -0,0 +1,120 @@
+# Copyright (c) 2011, Stefano Rivera
+# Released under terms of the MIT/X/Expat Licence. See COPYING for details.
+
+import sys
+
+import ibid
+import ibid.test
+from ibid.event import Event
+from ibid.manifest import Manifest, LazyProcessor, describe_processor
+from ibid.plugins import Processor, handler, match, periodic
+
+class Commands(Processor):
+    features = ('commands',)
+    usage = u'calc <expression>'
+
+    @match(r'^(?:calc|calculate)\s+(.+)$')
+    def calc(self, event, expression):
+        pass
+
+    @match(r'^hello$', version='deaddressed')
+    def hello(self, event):
+        pass
+
+class Blind(Processor):
+    @handler
+    def everything(self, event):
+        pass
+
+class Unaddressed(Commands):
+    addressed = False
+
+class Periodic(Commands):
+    @periodic(interval=60)
+    def poll(self, event):
+        pass
+
+class TestDescribe(ibid.test.TestCase):
+    def test_keywords(self):
+        "Leading keywords of each handler are recorded."
+        description = describe_processor(Commands(u'testplugin'))
+        self.assertEqual(sorted(description['keywords']), [
+            ['clean', [u'calc', u'calculate']],
+            ['deaddressed', [u'hello']],
+        ])
+        self.assertTrue(description['lazy'])
+        self.assertEqual(['commands'], description['features'])
+
+    def test_blind_handler(self):
+        "A handler without a pattern has no keywords."
+        description = describe_processor(Blind(u'testplugin'))
+        self.assertEqual(None, description['keywords'])
+        self.assertTrue(description['lazy'])
+
+    def test_eager(self):
+        "Unaddressed and periodic processors can't be loaded lazily."
+        self.assertFalse(describe_processor(Unaddressed(u'testplugin'))['lazy'])
+        self.assertFalse(describe_processor(Periodic(u'testplugin'))['lazy'])
+
+class TestLazyProcessor(ibid.test.TestCase):
+    def _event(self, clean, deaddressed=None):
+        event = Event(u'fakesource', u'message')
+        event.message = {
+            'raw': clean,
+            'clean': clean,
+            'deaddressed': deaddressed or clean,
+            'stripped': clean,
+        }
+        return event
+
+    def test_may_match(self):
+        "Only events starting with a keyword need the plugin."
+        lazy = LazyProcessor(u'testplugin',
+                describe_processor(Commands(u'testplugin')), {}, {})
+        self.assertTrue(lazy.may_match(self._event(u'Calc 1+1')))
+        self.assertTrue(lazy.may_match(self._event(u'bot: hi', u'hello')))
+        self.assertFalse(lazy.may_match(self._event(u'hello', u'bye')))
+        self.assertFalse(lazy.may_match(self._event(u'what is calc')))
+
+    def test_loaded(self):
+        "Once the plugin is loaded, events are passed to the real processor."
+        real = Blind(u'testplugin')
+        real.process = lambda event: event.addresponse(u'real')
+        lazy = LazyProcessor(u'testplugin', describe_processor(real), {}, {})
+        lazy.real = real
+        event = self._event(u'anything')
+        lazy.process(event)
+        self.assertEqual(u'real', event.responses[0]['reply'])
+
+class TestManifest(ibid.test.TestCase):
+    selection = {'load': [], 'noload': [], 'load_all': False,
+                 'noload_all': False}
+
+    def _record(self, filename):
+        __import__('ibid.plugins.calc')
+        manifest = Manifest(filename)
+        manifest.record(u'calc', self.selection, [Commands(u'calc')],
+                        sys.modules['ibid.plugins.calc'])
+        manifest.save()
+        return Manifest(filename)
+
+    def test_round_trip(self):
+        "A saved manifest describes the plugin when read back."
+        manifest = self._record(self.mktemp())
+        entry = manifest.lookup(u'calc', self.selection)
+        self.assertNotEqual(None, entry)
+        self.assertEqual(u'Commands', entry['processors'][0]['class'])
+        self.assertTrue('calc' in entry['features'])
+
+    def test_stale(self):
+        "Entries aren't used when the selection or configuration changes."
+        manifest = self._record(self.mktemp())
+        selection = dict(self.selection, noload=['Calc'])
+        self.assertEqual(None, manifest.lookup(u'calc', selection))
+        ibid.config.plugins['calc'] = {'priority': 10}
+        try:
+            self.assertEqual(None, manifest.lookup(u'calc', self.selection))
+        finally:
+            del ibid.config.plugins['calc']
+
+# vi: set et sta sw=4 ts=4:
@@ -0,0 +1,140 @@
+# Copyright (c) 2011, Stefano Rivera
+# Released under terms of the MIT/X/Expat Licence. See COPYING for details.
+
+from twisted.internet import defer
+
+import ibid
+import ibid.test
+from ibid.nodes import Cluster, Node, RemoteProcessor
+from ibid.event import Event
+from ibid.manifest import describe_processor
+from ibid.offload import RemoteProcessorError
+from ibid.plugins import Processor, match
+
+class Poller(Processor):
+    "Runs on node beta only"
+
+    @match(r'^poll\s+(\S+)$')
+    def poll(self, event, what):
+        event.addresponse(u'Polled %s', what)
+        event.polled = what
+        event.polled_by = event.get('account', None)
+
+    @match(r'^break$')
+    def broken(self, event):
+        raise Exception('broken')
+
+class Loopback(object):
+    "A peer that is really the same bot, pretending to be node"
+
+    def __init__(self, cluster, node):
+        self.node = Node(cluster, node)
+
+    def callRemote(self, name, *args):
+        return defer.maybeDeferred(getattr(self.node, 'remote_' + name),
+                                   *args)
+
+config = {
+    'node': u'alpha',
+    'secret': u'sekrit',
+    'alpha': {'sources': [u'Atrum']},
+    'beta': {'plugins': [u'poller'], 'port': 8791},
+}
+
+class TestRouting(ibid.test.TestCase):
+    def test_sources(self):
+        "Sources run on the node they are assigned to, or all of them."
+        alpha = Cluster(dict(config))
+        beta = Cluster(dict(config, node=u'beta'))
+        self.assertTrue(alpha.owns_source(u'atrum'))
+        self.assertFalse(beta.owns_source(u'atrum'))
+        self.assertTrue(beta.owns_source(u'timer'))
+        self.assertEqual(None, alpha.route(u'atrum'))
+        self.assertEqual(u'alpha', beta.route(u'atrum'))
+        self.assertEqual(None, beta.route(u'timer'))
+
+    def test_plugins(self):
+        "Plugins run on the node they are assigned to, or all of them."
+        alpha = Cluster(dict(config))
+        self.assertFalse(alpha.runs_plugin(u'poller'))
+        self.assertTrue(alpha.runs_plugin(u'factoid'))
+        self.assertEqual(u'beta', alpha.plugin_owner(u'poller'))
+
+    def test_no_secret(self):
+        "Nodes must share a secret."
+        self.assertRaises(ibid.IbidException, Cluster,
+                          dict(config, secret=u''))
+
+    def test_unknown_node(self):
+        "This node must be described."
+        self.assertRaises(ibid.IbidException, Cluster,
+                          dict(config, node=u'gamma'))
+
+class TestRemoteProcessor(ibid.test.TestCase):
+    def setUp(self):
+        super(TestRemoteProcessor, self).setUp()
+        self.cluster = ibid.cluster
+        ibid.cluster = Cluster(dict(config))
+        ibid.processors[:] = [Poller(u'poller')]
+        ibid.cluster.peers[u'beta'] = Loopback(ibid.cluster, u'beta')
+        self.remote = RemoteProcessor(u'beta', u'poller',
+                describe_processor(ibid.processors[0]), {})
+
+    def tearDown(self):
+        ibid.cluster = self.cluster
+        ibid.processors[:] = []
+        super(TestRemoteProcessor, self).tearDown()
+
+    def _event(self, message):
+        event = Event(u'atrum', u'message')
+        event.addressed = True
+        event.message = {
+            'raw': message,
+            'clean': message,
+            'deaddressed': message,
+            'stripped': message,
+        }
+        return event
+
+    def test_describe(self):
+        "Only this node's own plugins are described to the others."
+        node = Cluster(dict(config, node=u'beta'))
+        self.assertEqual([u'poller'],
+                         [name for name, features, processors
+                          in node.describe()])
+        self.assertEqual([], ibid.cluster.describe())
+
+    def test_filtered(self):
+        "Events that can't match aren't sent."
+        self.assertEqual(None, self.remote.process(self._event(u'hello')))
+
+    def test_process(self):
+        "Changes made on the other node are applied to the event."
+        event = self._event(u'poll feeds')
+        def check(result):
+            self.assertEqual(u'feeds', event.polled)
+            self.assertEqual([u'Polled feeds'],
+                             [response['reply'] for response in event.responses])
+        return self.remote.process(event).addCallback(check)
+
+    def test_identity_not_trusted(self):
+        "The other node doesn't take our word for who the sender is."
+        event = self._event(u'poll feeds')
+        event.account = 1
+        event.identity = 2
+        def check(result):
+            self.assertEqual(None, event.polled_by)
+        return self.remote.process(event).addCallback(check)
+
+    def test_failure(self):
+        "Exceptions on the other node are raised here."
+        return self.assertFailure(self.remote.process(self._event(u'break')),
+                                  RemoteProcessorError)
+
+    def test_disconnected(self):
+        "Events for a node we aren't connected to fail."
+        del ibid.cluster.peers[u'beta']
+        return self.assertFailure(self.remote.process(self._event(u'poll x')),
+                                  RemoteProcessorError)
+
+# vi: set et sta sw=4 ts=4:
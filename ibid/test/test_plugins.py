@@ -0,0 +1,118 @@
+# Copyright (c) 2011, Stefano Rivera
+# Released under terms of the MIT/X/Expat Licence. See COPYING for details.
+
+import re
+
+import ibid
+import ibid.test
+from ibid import stats
+from ibid.event import Event
+from ibid.plugins import Processor, match, literal_prefixes, MatchIndex
+
+class TestLiteralPrefixes(ibid.test.TestCase):
+    def prefixes(self, regex, simple=True):
+        return literal_prefixes(match(regex, simple=simple)(lambda: None)
+                                .pattern)
+
+    def test_word(self):
+        self.assertEqual(self.prefixes(u'rfc {digits}'), set([u'rfc']))
+
+    def test_case(self):
+        self.assertEqual(self.prefixes(u'Seen {any}'), set([u'seen']))
+
+    def test_alternation(self):
+        self.assertEqual(self.prefixes(u'(?:karma|reputation) for {any}'),
+                         set([u'karma', u'reputation']))
+
+    def test_unanchored(self):
+        self.assertEqual(self.prefixes(u'rfc', simple=False), None)
+
+    def test_optional(self):
+        self.assertEqual(self.prefixes(u'(?:what is )?{any}'), None)
+
+class TestMatchIndex(ibid.test.TestCase):
+    def setUp(self):
+        super(TestMatchIndex, self).setUp()
+
+        class Lookup(Processor):
+            @match(u'rfc {digits}')
+            def rfc(self, event, number):
+                pass
+
+            @match(u'{any}')
+            def anything(self, event, text):
+                pass
+
+        self.processor = Lookup(u'testplugin')
+        self.index = MatchIndex([self.processor])
+
+    def test_candidate(self):
+        self.assertTrue(self.index.may_match(self.processor.rfc, u'RFC 1149'))
+
+    def test_not_candidate(self):
+        self.assertFalse(self.index.may_match(self.processor.rfc,
+                                              u'karma for ibid'))
+
+    def test_unindexed(self):
+        self.assertTrue(self.index.may_match(self.processor.anything,
+                                             u'karma for ibid'))
+
+    def test_swapped_pattern(self):
+        "Handlers whose pattern was replaced after indexing are searched."
+        old = self.processor.rfc.im_func.pattern
+        self.processor.rfc.im_func.pattern = re.compile(r'^ietf (\d+)$')
+        try:
+            self.assertTrue(self.index.may_match(self.processor.rfc,
+                                                 u'ietf 1149'))
+        finally:
+            self.processor.rfc.im_func.pattern = old
+
+    def test_process(self):
+        "Processors still call matching handlers through the prefilter."
+        calls = []
+        class Seen(Processor):
+            @match(u'seen {any}')
+            def seen(self, event, who):
+                calls.append(who)
+        processor = Seen(u'testplugin')
+        ibid.plugins.rebuild_match_index([processor])
+        try:
+            for message in (u'seen foo', u'karma foo'):
+                event = Event(u'fakesource', u'message')
+                event.addressed = True
+                event.message = {'clean': message}
+                processor.process(event)
+        finally:
+            ibid.plugins.rebuild_match_index([])
+        self.assertEqual([u'foo'], calls)
+
+class TestHandlerStats(ibid.test.TestCase):
+    def setUp(self):
+        super(TestHandlerStats, self).setUp()
+        stats.reset()
+
+    def tearDown(self):
+        super(TestHandlerStats, self).tearDown()
+        stats.reset()
+
+    def test_timed(self):
+        "Handlers that are called are timed"
+        class Seen(Processor):
+            @match(u'seen {any}')
+            def seen(self, event, who):
+                pass
+
+            @match(u'karma {any}')
+            def karma(self, event, who):
+                pass
+        processor = Seen(u'testplugin')
+        event = Event(u'fakesource', u'message')
+        event.addressed = True
+        event.message = {'clean': u'seen foo'}
+        processor.process(event)
+        self.assertEqual(stats.histogram(u'testplugin', 'Seen', 'seen').count,
+                         1)
+        self.assertEqual(stats.histogram(u'testplugin', 'Seen', 'karma').count,
+                         0)
+
+# vi: set et sta sw=4 ts=4:
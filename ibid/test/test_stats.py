@@ -0,0 +1,94 @@
+# Copyright (c) 2011, Stefano Rivera
+# Released under terms of the MIT/X/Expat Licence. See COPYING for details.
+
+from twisted.internet import defer
+
+import ibid.test
+from ibid import stats
+
+class TestHistogram(ibid.test.TestCase):
+    def setUp(self):
+        super(TestHistogram, self).setUp()
+        self.hist = stats.Histogram()
+
+    def test_buckets(self):
+        for seconds in (0.0005, 0.003, 0.003, 120):
+            self.hist.observe(seconds)
+        self.assertEqual(self.hist.count, 4)
+        self.assertEqual(self.hist.buckets[0], 1)
+        self.assertEqual(self.hist.buckets[2], 2)
+        self.assertEqual(self.hist.buckets[-1], 1)
+        self.assertEqual(self.hist.max, 120)
+
+    def test_quantile(self):
+        for i in range(19):
+            self.hist.observe(0.002)
+        self.hist.observe(0.2)
+        self.assertEqual(self.hist.quantile(0.5), 0.0025)
+        self.assertEqual(self.hist.quantile(1), 0.25)
+
+    def test_quantile_overflow(self):
+        self.hist.observe(90)
+        self.assertEqual(self.hist.quantile(0.95), 90)
+
+    def test_deferred(self):
+        "Deferred results are timed when they fire"
+        d = defer.Deferred()
+        stats.observe_result(self.hist, 0, d)
+        self.assertEqual(self.hist.count, 0)
+        d.callback(None)
+        self.assertEqual(self.hist.count, 1)
+
+class TestRegistry(ibid.test.TestCase):
+    def tearDown(self):
+        super(TestRegistry, self).tearDown()
+        stats.reset()
+
+    def test_histogram(self):
+        hist = stats.histogram(u'testplugin', u'Test', u'handler')
+        self.assertTrue(hist is stats.histogram(u'testplugin', u'Test',
+                                                u'handler'))
+        self.assertFalse(hist is stats.histogram(u'testplugin', u'Test'))
+
+    def test_snapshot(self):
+        stats.histogram(u'testplugin', u'Test', u'handler').observe(0.01)
+        entry, = stats.snapshot()
+        self.assertEqual(entry['plugin'], u'testplugin')
+        self.assertEqual(entry['handler'], u'handler')
+        self.assertEqual(entry['count'], 1)
+        self.assertEqual(sum(entry['buckets']), 1)
+
+    def test_prometheus(self):
+        stats.histogram(u'testplugin', u'Test').observe(0.003)
+        stats.increment('events', source=u'a"b', type=u'message')
+        stats.cache_lookup('test', True)
+        stats.cache_lookup('test', False)
+        text = stats.prometheus([('queued', 'Queued', (), 3)])
+        lines = text.splitlines()
+        self.assertTrue('ibid_processor_latency_seconds_bucket{plugin="testplugin",'
+                        'processor="Test",le="0.0025"} 0' in lines)
+        self.assertTrue('ibid_processor_latency_seconds_bucket{plugin="testplugin",'
+                        'processor="Test",le="+Inf"} 1' in lines)
+        self.assertTrue('ibid_events_total{source="a\\"b",type="message"} 1'
+                        in lines)
+        self.assertTrue('ibid_cache_hit_ratio{cache="test"} 0.5' in lines)
+        self.assertTrue('# TYPE ibid_queued gauge' in lines)
+        self.assertTrue('ibid_queued 3' in lines)
+
+    def test_startup_profile(self):
+        self.assertEqual(3, stats.profile_startup('import', 'x', max, 1, 3))
+
+        profile = stats.StartupProfile()
+        stats.startup = profile
+        try:
+            stats.profile_startup('import', 'fast', lambda: None)
+            self.assertRaises(ValueError, stats.profile_startup, 'init',
+                              'broken', int, 'x')
+        finally:
+            stats.startup = None
+        self.assertEqual(['fast', 'broken'],
+                         [name for kind, name, elapsed, memory
+                          in profile.steps])
+        self.assertEqual(3, len(profile.report()))
+
+# vi: set et sta sw=4 ts=4:
@@ -11,6 +11,48 @@ class TestUtils(ibid.test.TestCase):
         self.assertEqual(ibid.utils.ago(datetime.timedelta(seconds=60)), u'1 minute')
         self.assertEqual(ibid.utils.ago(datetime.timedelta(seconds=60000), 1), u'16 hours')
 
+class TestLRUCache(ibid.test.TestCase):
+    def setUp(self):
+        super(TestLRUCache, self).setUp()
+        self.cache = ibid.utils.LRUCache(3)
+        for key in 'abc':
+            self.cache[key] = key.upper()
+
+    def test_get(self):
+        self.assertEqual(self.cache.get('a'), 'A')
+        self.assertEqual(self.cache.get('z'), None)
+        self.assertEqual(self.cache.get('z', 'Z'), 'Z')
+
+    def test_evicts_least_recent(self):
+        self.cache.get('a')
+        self.cache['d'] = 'D'
+        self.assertEqual(self.cache.keys(), ['d', 'a', 'c'])
+        self.assertEqual(len(self.cache), 3)
+
+    def test_overwrite(self):
+        self.cache['a'] = 'X'
+        self.assertEqual(self.cache.keys(), ['a', 'c', 'b'])
+        self.assertEqual(self.cache.get('a'), 'X')
+
+    def test_discard(self):
+        self.cache.discard('b')
+        self.cache.discard('z')
+        self.assertEqual(self.cache.keys(), ['c', 'a'])
+        self.assertEqual(self.cache.discard_matching(
+                lambda key, value: value == 'A'), 1)
+        self.assertEqual(self.cache.keys(), ['c'])
+
+    def test_resize(self):
+        self.cache.resize(1)
+        self.assertEqual(self.cache.keys(), ['c'])
+
+    def test_ttl(self):
+        self.cache.ttl = 60
+        self.assertEqual(self.cache.get('a'), 'A')
+        self.cache.map['a'][self.cache._TIME] -= 61
+        self.assertEqual(self.cache.get('a'), None)
+        self.assertEqual(self.cache.keys(), ['c', 'b'])
+
 class TestUtilsNetwork(ibid.test.TestCase):
     network = True
 
@@ -16,7 +16,7 @@ import re
 import socket
 from StringIO import StringIO
 from sys import version_info
-from threading import Lock
+from threading import Lock, local
 import time
 from urllib import urlencode, quote
 import urllib2
@@ -27,8 +27,12 @@ from subprocess import Popen, PIPE
 import dateutil.parser
 from dateutil.tz import tzlocal, tzutc
 from pkg_resources import resource_exists, resource_filename
+from twisted.internet import defer, reactor
+from twisted.python.threadable import isInIOThread
+from twisted.web.client import getPage
 
 import ibid
+from ibid import stats
 from ibid.compat import defaultdict, json
 
 log = logging.getLogger('utils')
@@ -277,6 +281,77 @@ def json_webservice(url, params={}, headers={}):
     except ValueError, e:
         raise JSONException(e)
 
+_held_calls = local()
+
+def hold_reactor_calls():
+    """Queue up reactor_call()s made in this thread, until
+    release_reactor_calls() is called.
+    """
+    _held_calls.calls = []
+
+def release_reactor_calls():
+    "Make the reactor_call()s held since hold_reactor_calls()"
+    calls = getattr(_held_calls, 'calls', None)
+    _held_calls.calls = None
+    for callable, args, kw in calls or ():
+        reactor.callFromThread(callable, *args, **kw)
+
+def reactor_call(callable, *args, **kw):
+    """Call callable in the reactor thread.
+    In a dispatcher worker thread, the call is held until the handler has
+    returned, so that callbacks can safely be added to any Deferreds it
+    produces.
+    """
+    if isInIOThread():
+        callable(*args, **kw)
+        return
+
+    calls = getattr(_held_calls, 'calls', None)
+    if calls is None:
+        reactor.callFromThread(callable, *args, **kw)
+    else:
+        calls.append((callable, args, kw))
+
+def generic_webservice_deferred(url, params={}, headers={}, timeout=60):
+    """Retreive data from a webservice, without blocking.
+    Returns a Deferred that fires with the data.
+    """
+
+    for key in params:
+        if isinstance(params[key], unicode):
+            params[key] = params[key].encode('utf-8')
+
+    if params:
+        url = iri_to_uri(url) + '?' + urlencode(params)
+    if isinstance(url, unicode):
+        url = url.encode('utf-8')
+
+    headers = dict(headers)
+    agent = 'Ibid/' + (ibid_version() or 'dev')
+    for key in headers.keys():
+        if key.lower() == 'user-agent':
+            agent = headers.pop(key)
+
+    result = defer.Deferred()
+    def start():
+        getPage(url, agent=agent, headers=headers, timeout=timeout) \
+                .chainDeferred(result)
+    reactor_call(start)
+    return result
+
+def _json_loads(data):
+    try:
+        return json.loads(data)
+    except ValueError, e:
+        raise JSONException(e)
+
+def json_webservice_deferred(url, params={}, headers={}, timeout=60):
+    """Request data from a JSON webservice, and deserialise, without
+    blocking. Returns a Deferred that fires with the data.
+    """
+    return generic_webservice_deferred(url, params, headers, timeout) \
+            .addCallback(_json_loads)
+
 def human_join(items, separator=u',', conjunction=u'and'):
     "Create a list like: a, b, c and d"
     items = list(items)
@@ -396,4 +471,139 @@ def identity_name(event, identity):
     else:
         return u'%s on %s' % (identity.identity, identity.source)
 
+class LRUCache(object):
+    """A thread-safe mapping that holds at most size items, discarding the
+    least recently used when full.
+    If ttl is given, items expire that many seconds after they were set.
+    If name is given, lookups are counted in stats as that cache.
+    """
+
+    # Indexes into the [previous, next, key, value, set time] links
+    _PREV, _NEXT, _KEY, _VALUE, _TIME = range(5)
+
+    def __init__(self, size, name=None, ttl=None):
+        self.size = size
+        self.name = name
+        self.ttl = ttl
+        self.lock = Lock()
+        self.clear()
+
+    def clear(self):
+        self.lock.acquire()
+        try:
+            self.map = {}
+            # The root of a circular list, most recently used first
+            self.root = root = []
+            root[:] = [root, root, None, None, None]
+        finally:
+            self.lock.release()
+
+    def _unlink(self, link):
+        prev, next = link[self._PREV], link[self._NEXT]
+        prev[self._NEXT] = next
+        next[self._PREV] = prev
+
+    def _link_first(self, link):
+        root = self.root
+        first = root[self._NEXT]
+        link[self._PREV] = root
+        link[self._NEXT] = first
+        first[self._PREV] = link
+        root[self._NEXT] = link
+
+    def get(self, key, default=None):
+        self.lock.acquire()
+        try:
+            link = self.map.get(key, None)
+            if link is not None:
+                self._unlink(link)
+                if (self.ttl is not None
+                        and time.time() - link[self._TIME] > self.ttl):
+                    del self.map[key]
+                    link = None
+                else:
+                    self._link_first(link)
+                    value = link[self._VALUE]
+        finally:
+            self.lock.release()
+        if self.name is not None:
+            stats.cache_lookup(self.name, link is not None)
+        if link is None:
+            return default
+        return value
+
+    def __setitem__(self, key, value):
+        self.lock.acquire()
+        try:
+            link = self.map.get(key, None)
+            if link is not None:
+                self._unlink(link)
+            else:
+                link = [None, None, key, None, None]
+                self.map[key] = link
+            link[self._VALUE] = value
+            link[self._TIME] = time.time()
+            self._link_first(link)
+            self._trim()
+        finally:
+            self.lock.release()
+
+    def _trim(self):
+        while len(self.map) > self.size:
+            link = self.root[self._PREV]
+            self._unlink(link)
+            del self.map[link[self._KEY]]
+
+    def resize(self, size):
+        self.lock.acquire()
+        try:
+            self.size = size
+            self._trim()
+        finally:
+            self.lock.release()
+
+    def discard(self, key):
+        self.lock.acquire()
+        try:
+            link = self.map.pop(key, None)
+            if link is not None:
+                self._unlink(link)
+        finally:
+            self.lock.release()
+
+    def discard_matching(self, predicate):
+        """Remove the items for which predicate(key, value) is true.
+        Returns the number removed.
+        """
+        self.lock.acquire()
+        try:
+            removed = 0
+            for key, link in self.map.items():
+                if predicate(key, link[self._VALUE]):
+                    self._unlink(link)
+                    del self.map[key]
+                    removed += 1
+            return removed
+        finally:
+            self.lock.release()
+
+    def __contains__(self, key):
+        return key in self.map
+
+    def __len__(self):
+        return len(self.map)
+
+    def keys(self):
+        "Return the keys, most recently used first"
+        self.lock.acquire()
+        try:
+            result = []
+            link = self.root[self._NEXT]
+            while link is not self.root:
+                result.append(link[self._KEY])
+                link = link[self._NEXT]
+            return result
+        finally:
+            self.lock.release()
+
 # vi: set et sta sw=4 ts=4:
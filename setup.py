@@ -61,6 +61,7 @@ setup(
         'scripts/ibid-objgraph',
         'scripts/ibid-pb-client',
         'scripts/ibid-plugin',
+        'scripts/ibid-replay',
         'scripts/ibid-setup',
         'scripts/ibid.tac',
     ],
@@ -10,7 +10,9 @@ from twisted.application.service import IServiceMaker, MultiService
 import ibid
 
 class Options(usage.Options):
-    optFlags = [['debug', 'd', 'Output debug messages']]
+    optFlags = [['debug', 'd', 'Output debug messages'],
+                ['profile-startup', None,
+                 'Report the time and memory taken by each step of startup']]
 
     def parseArgs(self, config='ibid.ini'):
         self['config'] = config